@@ -5,24 +5,58 @@ Flask 全端使用者登入系統
 """
 import io
 import os
+import asyncio
+import inspect
+import sys
+import csv
+import json
+import re
+import tempfile
+import base64
 import sqlite3
 import hashlib
+import ipaddress
 import secrets
 import jwt
+import click
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import deque, OrderedDict
+from email.header import Header
+from email.utils import formataddr, parseaddr
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
-from functools import wraps
+from functools import wraps, lru_cache
+from contextlib import contextmanager
+from contextvars import ContextVar
 from urllib.parse import urlparse, unquote
-from flask import Flask, render_template, g, request, redirect, url_for, session, flash, jsonify, send_file
+from werkzeug.http import http_date
+from flask import Flask, Response, render_template, g, request, redirect, url_for, session, flash, jsonify, send_file, stream_with_context
+from flask import abort, has_request_context, before_render_template, template_rendered, request_started
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "your-secret-key-change-in-production")
 app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY", "jwt-secret-key-change-in-production")
 app.config["JWT_ALGORITHM"] = "HS256"
-app.config["JWT_EXPIRATION_DELTA"] = timedelta(hours=24)
+# Access token 短效期；長效期的 refresh token 以雜湊存於 tokens 表，可撤銷
+app.config["JWT_EXPIRATION_DELTA"] = timedelta(minutes=int(os.environ.get("JWT_ACCESS_TOKEN_MINUTES", "15")))
+app.config["JWT_REFRESH_EXPIRATION_DELTA"] = timedelta(days=int(os.environ.get("JWT_REFRESH_TOKEN_DAYS", "30")))
+app.config["TOKEN_REVOCATION_SYNC_INTERVAL"] = float(os.environ.get("TOKEN_REVOCATION_SYNC_INTERVAL", "5"))  # 秒
+# 每次同步重新讀取最近這麼多秒內的撤銷紀錄：涵蓋較晚 commit 的交易與各主機間的時鐘誤差
+app.config["TOKEN_REVOCATION_SYNC_WINDOW"] = float(os.environ.get("TOKEN_REVOCATION_SYNC_WINDOW", "300"))  # 秒
+app.config["TOKEN_SWEEP_INTERVAL"] = float(os.environ.get("TOKEN_SWEEP_INTERVAL", "3600"))  # 秒
+app.config["TOKEN_SWEEP_BATCH_SIZE"] = int(os.environ.get("TOKEN_SWEEP_BATCH_SIZE", "1000"))
+# 已驗證 JWT 的解碼結果快取（以 token 的 SHA-256 為 key，隨 exp 到期）
+app.config["JWT_CACHE_SIZE"] = int(os.environ.get("JWT_CACHE_SIZE", "10000"))
+app.config["JWT_CACHE_TTL"] = float(os.environ.get("JWT_CACHE_TTL", "300"))  # 秒，0 停用
+# 將不常變動的個人資料（email、email_verified、created_at）放入 JWT，/api/user-info 可不查資料庫；
+# 代價是 token 有效期間內資料變更不會反映在舊 token 上
+app.config["JWT_EMBED_PROFILE_CLAIMS"] = os.environ.get("JWT_EMBED_PROFILE_CLAIMS", "False").lower() == "true"
+# 批次 API（/api/verify-token/batch、/api/token/batch）單次請求可處理的 token／使用者數上限
+app.config["TOKEN_BATCH_MAX_SIZE"] = int(os.environ.get("TOKEN_BATCH_MAX_SIZE", "100"))
 
 # 郵件設定（可透過環境變數設定）
 app.config["MAIL_SERVER"] = os.environ.get("MAIL_SERVER", "smtp.gmail.com")
@@ -31,8 +65,22 @@ app.config["MAIL_USE_TLS"] = os.environ.get("MAIL_USE_TLS", "True").lower() == "
 app.config["MAIL_USERNAME"] = os.environ.get("MAIL_USERNAME", "")
 app.config["MAIL_PASSWORD"] = os.environ.get("MAIL_PASSWORD", "")
 app.config["MAIL_FROM"] = os.environ.get("MAIL_FROM", app.config["MAIL_USERNAME"])
+# 郵件佇列：off＝請求內同步發送；thread＝寫入 email_outbox 後由行程內背景執行緒發送；
+# worker＝只寫入 email_outbox，由獨立行程 `flask mail worker`（或排程 `flask mail drain`）發送
+app.config["MAIL_QUEUE_MODE"] = os.environ.get("MAIL_QUEUE_MODE", "off").lower()
+app.config["MAIL_QUEUE_BATCH_SIZE"] = int(os.environ.get("MAIL_QUEUE_BATCH_SIZE", "50"))
+app.config["MAIL_QUEUE_POLL_INTERVAL"] = float(os.environ.get("MAIL_QUEUE_POLL_INTERVAL", "5"))  # 秒
+app.config["MAIL_MAX_ATTEMPTS"] = int(os.environ.get("MAIL_MAX_ATTEMPTS", "5"))  # 超過即標記為 dead
+app.config["MAIL_RETRY_BASE_SECONDS"] = int(os.environ.get("MAIL_RETRY_BASE_SECONDS", "30"))  # 退避：base * 2^(次數-1)
+app.config["MAIL_SMTP_IDLE_TIMEOUT"] = float(os.environ.get("MAIL_SMTP_IDLE_TIMEOUT", "60"))  # SMTP 連線閒置多久後關閉
+app.config["MAIL_OUTBOX_RETENTION_DAYS"] = int(os.environ.get("MAIL_OUTBOX_RETENTION_DAYS", "7"))  # 已寄出紀錄保留天數
 
 # 資料庫：開發用 SQLite，生產（Vercel）用 Postgres（環境變數 POSTGRES_URL / DATABASE_URL）
+# Postgres 連線池：整個行程共用，避免每個請求都重新做 TCP/TLS/認證握手
+app.config["PG_POOL_MIN_SIZE"] = int(os.environ.get("PG_POOL_MIN_SIZE", "0"))
+app.config["PG_POOL_MAX_SIZE"] = int(os.environ.get("PG_POOL_MAX_SIZE", "10"))
+app.config["PG_POOL_IDLE_TIMEOUT"] = float(os.environ.get("PG_POOL_IDLE_TIMEOUT", "300"))  # 秒，閒置超過即關閉
+app.config["PG_POOL_CHECKOUT_TIMEOUT"] = float(os.environ.get("PG_POOL_CHECKOUT_TIMEOUT", "10"))  # 秒，池滿時最長等待
 _postgres_url = (os.environ.get("POSTGRES_URL") or os.environ.get("DATABASE_URL") or "").strip()
 USE_POSTGRES = bool(_postgres_url and _postgres_url.lower().startswith("postgres"))
 
@@ -49,8 +97,124 @@ else:
     else:
         DATABASE = Path(__file__).parent / "instance" / "app.db"
 
+# SQLite 持久連線模式（選用）：每個 worker 執行緒保留一條連線跨請求重用，並啟用 WAL 等調校
+app.config["SQLITE_PERSISTENT"] = os.environ.get("SQLITE_PERSISTENT", "False").lower() == "true"
+app.config["SQLITE_MMAP_SIZE"] = int(os.environ.get("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))  # bytes
+app.config["SQLITE_CACHE_SIZE_KB"] = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "16384"))
+app.config["SQLITE_BUSY_TIMEOUT_MS"] = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# 資料庫管理頁每頁筆數（可由 ?per_page= 覆寫，上限 DB_MANAGE_MAX_PAGE_SIZE）
+app.config["DB_MANAGE_PAGE_SIZE"] = int(os.environ.get("DB_MANAGE_PAGE_SIZE", "50"))
+app.config["DB_MANAGE_MAX_PAGE_SIZE"] = int(os.environ.get("DB_MANAGE_MAX_PAGE_SIZE", "500"))
+# 匯出時每批從資料庫讀取的筆數（記憶體用量只與此值有關，與總筆數無關）
+app.config["EXPORT_BATCH_SIZE"] = int(os.environ.get("EXPORT_BATCH_SIZE", "1000"))
+# 匯入時每個交易處理的列數（每批驗證、預先查詢既有資料、寫入後 commit）
+app.config["IMPORT_CHUNK_SIZE"] = int(os.environ.get("IMPORT_CHUNK_SIZE", "500"))
+# 匯入／匯出背景工作：off＝在請求內完成；thread＝行程內執行緒池處理；
+# worker＝只建立工作，由獨立行程 `flask jobs worker` 處理（上傳檔案暫存於 JOBS_DIR，須與 Web 行程共用）
+app.config["JOBS_MODE"] = os.environ.get("JOBS_MODE", "off").lower()
+app.config["JOBS_MAX_WORKERS"] = int(os.environ.get("JOBS_MAX_WORKERS", "2"))
+app.config["JOBS_RETENTION_HOURS"] = int(os.environ.get("JOBS_RETENTION_HOURS", "24"))  # 完成後暫存檔保留時間
+# 執行中超過此分鐘數（依 started_at）視為行程已中止，標記為失敗；thread 模式下排入超過此時間仍未開始的工作重新交給執行緒池
+app.config["JOBS_STALE_MINUTES"] = int(os.environ.get("JOBS_STALE_MINUTES", "60"))
+if os.environ.get("JOBS_DIR"):
+    app.config["JOBS_DIR"] = Path(os.environ["JOBS_DIR"])
+elif os.environ.get("VERCEL"):
+    app.config["JOBS_DIR"] = Path("/tmp/jobs")
+else:
+    app.config["JOBS_DIR"] = Path(__file__).parent / "instance" / "jobs"
+# 使用者授權屬性快取（role、email_verified、username）：每個行程各自快取，
+# 本行程內寫入時立即失效，其他行程最多延遲 USER_CACHE_TTL 秒；USER_CACHE_TTL=0 停用
+app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+app.config["USER_CACHE_TTL"] = float(os.environ.get("USER_CACHE_TTL", "60"))
+# Session 存放位置：database（sessions 表，預設，多行程共用）、memory（行程內 LRU，僅適合單一行程）、
+# cookie（Flask 預設的簽章 cookie，無法伺服器端撤銷）或 "模組:類別"。database／memory 時 cookie 只存隨機 session id
+app.config["SESSION_BACKEND"] = os.environ.get("SESSION_BACKEND", "database")
+app.config["SESSION_MEMORY_MAX_ENTRIES"] = int(os.environ.get("SESSION_MEMORY_MAX_ENTRIES", "10000"))
+# 伺服器端 session 閒置多久後失效（剩餘效期不到一半時，下次請求會自動延長）
+app.config["SESSION_IDLE_TIMEOUT"] = timedelta(hours=float(os.environ.get("SESSION_IDLE_TIMEOUT_HOURS", "168")))
+# 頁面渲染快取（主畫面、選項頁）：鍵含登入者 username／role 與使用者資料版本，PAGE_CACHE_TTL=0 停用
+app.config["PAGE_CACHE_SIZE"] = int(os.environ.get("PAGE_CACHE_SIZE", "2000"))
+app.config["PAGE_CACHE_TTL"] = float(os.environ.get("PAGE_CACHE_TTL", "300"))
+# 密碼雜湊：pbkdf2_sha256 或 scrypt（雜湊字串自帶演算法與參數，調整成本後舊雜湊仍可驗證，
+# 並於下次登入成功時自動改用新參數重新雜湊；舊版無鹽 SHA-256 亦同）
+app.config["PASSWORD_HASHER"] = os.environ.get("PASSWORD_HASHER", "pbkdf2_sha256").lower()
+app.config["PASSWORD_PBKDF2_ITERATIONS"] = int(os.environ.get("PASSWORD_PBKDF2_ITERATIONS", "600000"))
+app.config["PASSWORD_SCRYPT_N"] = int(os.environ.get("PASSWORD_SCRYPT_N", "16384"))
+app.config["PASSWORD_SCRYPT_R"] = int(os.environ.get("PASSWORD_SCRYPT_R", "8"))
+app.config["PASSWORD_SCRYPT_P"] = int(os.environ.get("PASSWORD_SCRYPT_P", "1"))
+# 密碼雜湊在獨立的執行緒池中計算：同時計算數不超過 PASSWORD_HASH_WORKERS，
+# 排隊（含計算中）超過 PASSWORD_HASH_MAX_PENDING 時等待至多 PASSWORD_HASH_WAIT_TIMEOUT 秒，仍無空位即回 503
+app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+app.config["PASSWORD_HASH_MAX_PENDING"] = int(
+    os.environ.get("PASSWORD_HASH_MAX_PENDING", str(app.config["PASSWORD_HASH_WORKERS"] * 4))
+)
+app.config["PASSWORD_HASH_WAIT_TIMEOUT"] = float(os.environ.get("PASSWORD_HASH_WAIT_TIMEOUT", "5"))  # 秒
+# 匯入含密碼的列時另用一個執行緒池計算雜湊（每列一次完整 KDF），不佔用登入的 PASSWORD_HASH_WORKERS；
+# 等待超過 IMPORT_PASSWORD_HASH_WAIT_TIMEOUT 秒的列記為錯誤列
+app.config["IMPORT_PASSWORD_HASH_WORKERS"] = int(
+    os.environ.get("IMPORT_PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2)))
+)
+app.config["IMPORT_PASSWORD_HASH_WAIT_TIMEOUT"] = float(os.environ.get("IMPORT_PASSWORD_HASH_WAIT_TIMEOUT", "60"))  # 秒
+# 登入／取得 token／忘記密碼的頻率限制（滑動視窗）：規則格式為「次數/秒數」，空字串停用該規則。
+# 後端：memory＝每個行程各自計數；sqlite＝多個 worker 共用同一個 SQLite 檔（RATE_LIMIT_SQLITE_PATH）；
+# 也可指定 "模組:類別" 使用自訂的共用後端（例如 Redis）
+app.config["RATE_LIMIT_ENABLED"] = os.environ.get("RATE_LIMIT_ENABLED", "True").lower() == "true"
+app.config["RATE_LIMIT_BACKEND"] = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+app.config["RATE_LIMIT_MEMORY_MAX_KEYS"] = int(os.environ.get("RATE_LIMIT_MEMORY_MAX_KEYS", "100000"))
+app.config["RATE_LIMIT_LOGIN_PER_IP"] = os.environ.get("RATE_LIMIT_LOGIN_PER_IP", "20/60")
+app.config["RATE_LIMIT_LOGIN_PER_IDENTIFIER"] = os.environ.get("RATE_LIMIT_LOGIN_PER_IDENTIFIER", "10/300")
+app.config["RATE_LIMIT_FORGOT_PASSWORD_PER_IP"] = os.environ.get("RATE_LIMIT_FORGOT_PASSWORD_PER_IP", "10/3600")
+app.config["RATE_LIMIT_FORGOT_PASSWORD_PER_EMAIL"] = os.environ.get("RATE_LIMIT_FORGOT_PASSWORD_PER_EMAIL", "3/3600")
+# 位於反向代理後方時，從 X-Forwarded-For 右側數來第 N 個位址取得用戶端 IP（0＝直接使用連線位址）
+app.config["RATE_LIMIT_TRUSTED_PROXIES"] = int(os.environ.get("RATE_LIMIT_TRUSTED_PROXIES", "1" if os.environ.get("VERCEL") else "0"))
+if os.environ.get("RATE_LIMIT_SQLITE_PATH"):
+    app.config["RATE_LIMIT_SQLITE_PATH"] = Path(os.environ["RATE_LIMIT_SQLITE_PATH"])
+elif os.environ.get("VERCEL"):
+    app.config["RATE_LIMIT_SQLITE_PATH"] = Path("/tmp/ratelimit.db")
+else:
+    app.config["RATE_LIMIT_SQLITE_PATH"] = Path(__file__).parent / "instance" / "ratelimit.db"
+# 效能量測（啟動時決定，皆關閉時不安裝任何掛鉤）：METRICS_ENABLED 開啟 /metrics（Prometheus 文字格式），
+# SERVER_TIMING_ENABLED 在回應加上 Server-Timing 標頭；METRICS_TOKEN 設定後 /metrics 須帶 Bearer token，
+# 未設定時只接受本機直接連線（經反向代理轉送、帶 X-Forwarded-For 的請求一律拒絕）
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "False").lower() == "true"
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN", "")
+app.config["SERVER_TIMING_ENABLED"] = os.environ.get("SERVER_TIMING_ENABLED", "False").lower() == "true"
+app.config["METRICS_MAX_STATEMENTS"] = int(os.environ.get("METRICS_MAX_STATEMENTS", "200"))  # 超過的語句歸入 other
+# 慢查詢記錄：單一 SQL（含 fetch）超過此毫秒數即記錄 warning（參數只記型別與長度），0 停用
+app.config["SLOW_QUERY_MS"] = float(os.environ.get("SLOW_QUERY_MS", "0"))
+# N+1 偵測：同一請求內相同形狀的 SQL 執行超過此次數即視為 N+1，0 停用；
+# QUERY_REPEAT_ACTION=log 記錄 warning，raise 拋出 QueryRepeatError（開發／測試用，讓該請求失敗）
+app.config["QUERY_REPEAT_THRESHOLD"] = int(os.environ.get("QUERY_REPEAT_THRESHOLD", "0"))
+app.config["QUERY_REPEAT_ACTION"] = os.environ.get("QUERY_REPEAT_ACTION", "log").lower()
+# 回應壓縮（WSGI middleware）：依 Accept-Encoding 選擇 COMPRESS_ALGORITHMS 中第一個可用的演算法
+# （br 需安裝 brotli、zstd 需安裝 zstandard），只壓縮 COMPRESS_MIMETYPES 內、且大於 COMPRESS_MIN_SIZE 位元組的回應
+app.config["COMPRESS_ENABLED"] = os.environ.get("COMPRESS_ENABLED", "True").lower() == "true"
+app.config["COMPRESS_ALGORITHMS"] = [a.strip() for a in os.environ.get("COMPRESS_ALGORITHMS", "br,zstd,gzip").split(",") if a.strip()]
+app.config["COMPRESS_MIN_SIZE"] = int(os.environ.get("COMPRESS_MIN_SIZE", "500"))
+app.config["COMPRESS_LEVEL"] = int(os.environ.get("COMPRESS_LEVEL", "6"))  # gzip 等級；br／zstd 換算為相近的速度取向等級
+app.config["COMPRESS_MIMETYPES"] = {
+    m.strip() for m in os.environ.get(
+        "COMPRESS_MIMETYPES",
+        "text/html,text/css,text/plain,text/csv,text/javascript,application/javascript,"
+        "application/json,application/x-ndjson,application/xml,image/svg+xml",
+    ).split(",") if m.strip()
+}
+# ASGI 模式（uvicorn app:asgi_app）下執行同步 view 的執行緒數，run_sync／SQLite 查詢另用同樣大小的執行緒池（每個 worker 行程）
+app.config["ASGI_SYNC_THREADS"] = int(os.environ.get("ASGI_SYNC_THREADS", "32"))
+
 # 統一 IntegrityError（SQLite / Postgres）
 DBIntegrityError = pg8000.IntegrityError if USE_POSTGRES else sqlite3.IntegrityError
+DBDatabaseError = pg8000.DatabaseError if USE_POSTGRES else sqlite3.DatabaseError
+
+
+def is_data_error(e):
+    """資料本身有誤（違反約束、格式／長度／範圍錯誤）而非連線或 SQL 問題。
+    pg8000 只把 23505 轉為 IntegrityError，其餘伺服器錯誤都是 ProgrammingError，須依 SQLSTATE 類別（22、23）判斷"""
+    if USE_POSTGRES:
+        info = e.args[0] if e.args else None
+        return isinstance(info, dict) and info.get("C", "")[:2] in ("22", "23")
+    return isinstance(e, (sqlite3.IntegrityError, sqlite3.DataError))
 
 
 def _parse_postgres_url(url):
@@ -75,6 +239,7 @@ class _DictCursorWrapper:
     def __init__(self, cursor):
         self._cur = cursor
         self._names = [d[0] for d in (cursor.description or [])]
+        self.rowcount = cursor.rowcount
 
     def fetchone(self):
         row = self._cur.fetchone()
@@ -85,9 +250,13 @@ class _DictCursorWrapper:
 
 
 class _PostgresDbWrapper:
-    """Postgres 連線包裝：提供與 SQLite 相容的 execute(?)/commit/cursor/close（使用 pg8000）"""
-    def __init__(self, conn):
+    """Postgres 連線包裝：提供與 SQLite 相容的 execute(?)/commit/cursor/close（使用 pg8000）
+
+    若由連線池取得（pool 不為 None），close() 會把連線歸還連線池而非真正關閉。
+    """
+    def __init__(self, conn, pool=None):
         self._conn = conn
+        self._pool = pool
 
     def execute(self, sql, params=()):
         sql = sql.replace("?", "%s")
@@ -98,11 +267,25 @@ class _PostgresDbWrapper:
     def commit(self):
         self._conn.commit()
 
+    def rollback(self):
+        self._conn.rollback()
+
+    @property
+    def in_transaction(self):
+        """與 sqlite3.Connection.in_transaction 相同：交易進行中（含已中止、等待 rollback 的交易）"""
+        return self._conn._in_transaction
+
     def cursor(self):
         return _PostgresCursorWrapper(self._conn)
 
     def close(self):
-        self._conn.close()
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._pool is not None:
+            self._pool.release(conn)
+        else:
+            conn.close()
 
 
 class _PostgresCursorWrapper:
@@ -116,48 +299,752 @@ class _PostgresCursorWrapper:
         cur.execute(sql, params)
 
 
+class _PostgresConnectionPool:
+    """行程層級的 pg8000 連線池
+
+    - min_size / max_size：最少保留的閒置連線數與同時存在的連線上限
+    - 取出時做健康檢查（SELECT 1），失效連線直接丟棄並重新建立
+    - 閒置超過 idle_timeout 秒的連線在取出/歸還時關閉（不低於 min_size）
+    - 池滿時最多等待 checkout_timeout 秒，逾時拋出 PoolExhaustedError
+    - stats() 回傳取用次數、等待次數、耗盡次數等統計
+    """
+
+    class PoolExhaustedError(Exception):
+        """連線池已滿且等待逾時"""
+
+    def __init__(self, connect_kwargs, min_size=0, max_size=10, idle_timeout=300.0, checkout_timeout=10.0):
+        self._connect_kwargs = connect_kwargs
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self._idle = deque()  # (conn, 最後歸還時間)
+        self._size = 0  # 目前存在的連線數（閒置 + 使用中）
+        self._cond = threading.Condition()
+        self._stats = {
+            "created": 0,
+            "closed": 0,
+            "checkouts": 0,
+            "health_check_failures": 0,
+            "waits": 0,
+            "exhausted": 0,
+        }
+
+    def _connect(self):
+        conn = pg8000.connect(**self._connect_kwargs)
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        """關閉連線並釋出名額（呼叫者不可持有鎖）"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats["closed"] += 1
+            self._cond.notify()
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchall()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _pop_expired(self, now):
+        """取出閒置過久的連線（呼叫者須持有鎖）"""
+        expired = []
+        while len(self._idle) > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+        return expired
+
+    def fill(self):
+        """預先建立至 min_size 條閒置連線"""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def acquire(self):
+        """取出一條可用連線"""
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            conn = None
+            waited = False
+            with self._cond:
+                expired = self._pop_expired(time.monotonic())
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["exhausted"] += 1
+                        raise self.PoolExhaustedError(
+                            f"Postgres 連線池已滿（max_size={self.max_size}），等待 {self.checkout_timeout} 秒仍無可用連線"
+                        )
+                    if not waited:
+                        self._stats["waits"] += 1
+                        waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn = self._idle.pop()[0]  # LIFO：優先使用最近歸還、最可能仍存活的連線
+                else:
+                    self._size += 1
+            for old in expired:
+                self._discard(old)
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                self._discard(conn)
+                continue
+            with self._cond:
+                self._stats["checkouts"] += 1
+            return conn
+
+    def release(self, conn):
+        """歸還連線；未提交的交易一律 rollback，失敗則丟棄"""
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            expired = self._pop_expired(time.monotonic())
+            self._cond.notify()
+        for old in expired:
+            self._discard(old)
+
+    def close_all(self):
+        """關閉所有閒置連線（使用中的連線歸還後仍會被放回池中）"""
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """連線池統計（供監控使用）"""
+        with self._cond:
+            data = dict(self._stats)
+            data.update({
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+            })
+        return data
+
+
+_pg_pool = None
+_pg_pool_pid = None
+_pg_pool_lock = threading.Lock()
+
+
+def get_pg_pool():
+    """取得（必要時建立）行程共用的 Postgres 連線池；fork 後的子行程會重新建立"""
+    global _pg_pool, _pg_pool_pid
+    pid = os.getpid()
+    if _pg_pool is None or _pg_pool_pid != pid:
+        with _pg_pool_lock:
+            if _pg_pool is None or _pg_pool_pid != pid:
+                _pg_pool = _PostgresConnectionPool(
+                    _parse_postgres_url(_postgres_url),
+                    min_size=app.config["PG_POOL_MIN_SIZE"],
+                    max_size=app.config["PG_POOL_MAX_SIZE"],
+                    idle_timeout=app.config["PG_POOL_IDLE_TIMEOUT"],
+                    checkout_timeout=app.config["PG_POOL_CHECKOUT_TIMEOUT"],
+                )
+                _pg_pool_pid = pid
+                try:
+                    _pg_pool.fill()
+                except Exception as e:
+                    import sys
+                    print(f"[pg_pool] 預先建立連線失敗: {e}", file=sys.stderr)
+    return _pg_pool
+
+
+_sqlite_local = threading.local()
+_sqlite_dir_ready = False
+
+
+def _connect_sqlite(check_same_thread=True):
+    """建立 SQLite 連線；資料夾只在行程內第一次連線時建立（check_same_thread=False 供跨執行緒依序使用）"""
+    global _sqlite_dir_ready
+    if not _sqlite_dir_ready:
+        try:
+            DATABASE.parent.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            pass
+        _sqlite_dir_ready = True
+    conn = sqlite3.connect(
+        str(DATABASE), timeout=app.config["SQLITE_BUSY_TIMEOUT_MS"] / 1000, check_same_thread=check_same_thread
+    )
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _get_persistent_sqlite():
+    """取得目前執行緒的持久 SQLite 連線（WAL、synchronous=NORMAL、mmap、加大 page cache）"""
+    conn = getattr(_sqlite_local, "conn", None)
+    if conn is None or getattr(_sqlite_local, "pid", None) != os.getpid():
+        conn = _connect_sqlite()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={int(app.config['SQLITE_MMAP_SIZE'])}")
+        conn.execute(f"PRAGMA cache_size=-{int(app.config['SQLITE_CACHE_SIZE_KB'])}")  # 負值單位為 KiB
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _sqlite_local.conn = conn
+        _sqlite_local.pid = os.getpid()
+    return conn
+
+
+def insert_returning_id(db, sql, params=()):
+    """執行 INSERT 並回傳新資料的 id（Postgres：RETURNING id，SQLite：lastrowid）"""
+    if USE_POSTGRES:
+        return db.execute(sql + " RETURNING id", params).fetchone()["id"]
+    return db.execute(sql, params).lastrowid
+
+
 def get_db():
     """取得資料庫連線（開發：SQLite，生產：Vercel Postgres）"""
     if "db" not in g:
         if USE_POSTGRES:
-            g.db = _PostgresDbWrapper(pg8000.connect(**_parse_postgres_url(_postgres_url)))
+            pool = get_pg_pool()
+            g.db = _PostgresDbWrapper(pool.acquire(), pool)
+        elif app.config["SQLITE_PERSISTENT"]:
+            g.db = _get_persistent_sqlite()
         else:
-            try:
-                DATABASE.parent.mkdir(parents=True, exist_ok=True)
-            except OSError:
-                pass
-            conn = sqlite3.connect(str(DATABASE))
-            conn.row_factory = sqlite3.Row
-            g.db = conn
+            g.db = _connect_sqlite()
+        if INSTRUMENTATION_ENABLED:
+            g.db = _InstrumentedDb(g.db)
     return g.db
 
 
 @app.teardown_appcontext
 def close_db(exception=None):
-    """關閉資料庫連線"""
+    """關閉資料庫連線（Postgres：歸還連線池；SQLite 持久模式：保留連線供同執行緒下次使用）"""
     db = g.pop("db", None)
-    if db is not None:
-        db.close()
+    if db is None:
+        return
+    db = getattr(db, "wrapped_db", db)
+    if db is getattr(_sqlite_local, "conn", None):
+        if db.in_transaction:
+            db.rollback()
+        return
+    db.close()
+
+
+# ==================== 效能量測 ====================
+#
+# 每個請求記錄 SQL（正規化語句、耗時、筆數）與各項操作（render、password_hash、send_email）的耗時，
+# 回應前彙總為 Server-Timing 標頭並累計到 Prometheus histogram。
+# 皆為行程內統計；多個 worker 行程時請分別抓取或由 Prometheus 彙總。
+
+INSTRUMENTATION_ENABLED = bool(
+    app.config["METRICS_ENABLED"] or app.config["SERVER_TIMING_ENABLED"]
+    or app.config["SLOW_QUERY_MS"] > 0 or app.config["QUERY_REPEAT_THRESHOLD"] > 0
+)
+
+_HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _prom_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class _Histogram:
+    """Prometheus histogram：依標籤組合分別累計各 bucket 次數、總和與總次數"""
+
+    def __init__(self, name, help_text, label_names, buckets=_HISTOGRAM_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self._series = {}  # labels -> [各 bucket 次數（非累計）..., +Inf 次數, 總和]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        import bisect
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_prom_labels(self.label_names + ('le',), labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_prom_labels(self.label_names, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_prom_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class _Counter:
+    """Prometheus counter（依標籤組合累計）"""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        lines.extend(f"{self.name}{_prom_labels(self.label_names, labels)} {value}" for labels, value in items)
+        return lines
+
+
+request_duration_histogram = _Histogram(
+    "http_request_duration_seconds", "請求處理時間（至回應開始傳送）", ("method", "route", "status")
+)
+query_duration_histogram = _Histogram("db_query_duration_seconds", "SQL 執行時間（依正規化語句）", ("statement",))
+query_rows_counter = _Counter("db_query_rows_total", "SQL 讀取或影響的資料列數（依正規化語句）", ("statement",))
+operation_duration_histogram = _Histogram(
+    "app_operation_duration_seconds", "應用程式操作耗時（render、password_hash、send_email）", ("operation",)
+)
+
+_SQL_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SQL_PLACEHOLDER_LIST_RE = re.compile(r"\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)")
+_SQL_REPEATED_LIST_RE = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_statement_labels = set()
+_statement_labels_lock = threading.Lock()
+
+
+@lru_cache(maxsize=2048)
+def normalize_sql(sql):
+    """SQL 正規化：常值改為 ?、IN / VALUES 的參數串收斂為 (...)、合併空白，同形狀的語句得到相同文字"""
+    shape = _SQL_NUMBER_RE.sub("?", _SQL_STRING_RE.sub("?", sql))
+    shape = _SQL_REPEATED_LIST_RE.sub("(...)", _SQL_PLACEHOLDER_LIST_RE.sub("(...)", shape))
+    return " ".join(shape.split())
+
+
+def _statement_label(shape):
+    """限制 statement 標籤的種類數，避免動態 SQL 讓 /metrics 無限膨脹"""
+    if shape in _statement_labels:
+        return shape
+    with _statement_labels_lock:
+        if len(_statement_labels) < app.config["METRICS_MAX_STATEMENTS"]:
+            _statement_labels.add(shape)
+            return shape
+    return "other"
+
+
+class _RequestPerf:
+    """單一請求的量測資料（放在 g.perf）"""
+    __slots__ = ("start", "queries", "operations", "finished")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = []  # [正規化語句, 參數, 耗時秒數, 筆數, 是否已計入]
+        self.operations = {}  # 操作名稱 -> [總耗時秒數, 次數]
+        self.finished = False
+
+
+def _current_perf():
+    """目前請求的量測資料；不在請求內或回應已送出（串流中）時回傳 None"""
+    if not has_request_context():
+        return None
+    perf = g.get("perf")
+    return perf if perf is not None and not perf.finished else None
+
+
+_query_captures = threading.local()
+
+
+class QueryRepeatError(Exception):
+    """同一請求內相同形狀的 SQL 執行次數超過 QUERY_REPEAT_THRESHOLD（QUERY_REPEAT_ACTION=raise）"""
+
+
+@contextmanager
+def capture_queries():
+    """收集區塊內（同一執行緒）執行的所有 SQL 紀錄，供測試檢查各路由的查詢次數：
+
+        with capture_queries() as queries:
+            client.post("/profile/edit", data=...)
+        assert len(queries) <= 4
+
+    每筆為 (正規化語句, 耗時秒數, 筆數)；需啟用任一量測設定（INSTRUMENTATION_ENABLED）。
+    """
+    if not INSTRUMENTATION_ENABLED:
+        raise RuntimeError("capture_queries 需開啟 METRICS_ENABLED、SERVER_TIMING_ENABLED、SLOW_QUERY_MS 或 QUERY_REPEAT_THRESHOLD")
+    stack = _query_captures.__dict__.setdefault("stack", [])
+    queries = []
+    stack.append(queries)
+    try:
+        yield queries
+    finally:
+        stack.remove(queries)
+
+
+def allow_query_repeats(f):
+    """裝飾器：路由本身即以固定大小分批處理（匯入、匯出），重複的語句是刻意的批次而非 N+1，略過 N+1 偵測"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.allow_query_repeats = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def _redact_params(params):
+    """參數只保留型別與長度（避免密碼雜湊、token、個資寫入日誌）"""
+    if isinstance(params, dict):
+        params = params.values()
+    redacted = []
+    for value in params or ():
+        if value is None:
+            redacted.append("NULL")
+        elif isinstance(value, (str, bytes)):
+            redacted.append(f"<{type(value).__name__}:{len(value)}>")
+        else:
+            redacted.append(f"<{type(value).__name__}>")
+    return "(" + ", ".join(redacted) + ")"
+
+
+def _finish_query(record):
+    shape, params, duration, rows, _ = record
+    record[4] = True
+    if app.config["METRICS_ENABLED"]:
+        label = (_statement_label(shape),)
+        query_duration_histogram.observe(label, duration)
+        if rows > 0:
+            query_rows_counter.inc(label, rows)
+    if app.config["SLOW_QUERY_MS"] > 0 and duration * 1000 >= app.config["SLOW_QUERY_MS"]:
+        where = f"{request.method} {request.path}" if has_request_context() else "（請求外）"
+        app.logger.warning("慢查詢 %.1f ms [%s]：%s 參數=%s", duration * 1000, where, shape, _redact_params(params))
+    for queries in getattr(_query_captures, "stack", ()):
+        queries.append((shape, duration, rows))
+
+
+def _check_query_repeats(perf):
+    """N+1 偵測：回傳超過門檻的 [(語句, 次數)]"""
+    threshold = app.config["QUERY_REPEAT_THRESHOLD"]
+    if threshold <= 0 or len(perf.queries) <= threshold or g.get("allow_query_repeats"):
+        return []
+    counts = {}
+    for record in perf.queries:
+        counts[record[0]] = counts.get(record[0], 0) + 1
+    return [(shape, count) for shape, count in counts.items() if count > threshold]
+
+
+def _record_operation(operation, duration):
+    if app.config["METRICS_ENABLED"]:
+        operation_duration_histogram.observe((operation,), duration)
+    perf = _current_perf()
+    if perf is not None:
+        total = perf.operations.setdefault(operation, [0.0, 0])
+        total[0] += duration
+        total[1] += 1
+
+
+def timed_operation(operation):
+    """裝飾器：量測函式耗時並計入 operation；未啟用量測時直接回傳原函式"""
+    def decorator(f):
+        if not INSTRUMENTATION_ENABLED:
+            return f
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                _record_operation(operation, time.perf_counter() - start)
+        return decorated_function
+    return decorator
+
+
+class _InstrumentedCursor:
+    """包裝 cursor：fetch 的時間與筆數累加回該筆 SQL 紀錄"""
+
+    def __init__(self, cursor, record):
+        self._cursor = cursor
+        self._record = record
+
+    def _add(self, duration, rows):
+        record = self._record
+        record[2] += duration
+        record[3] += rows
+        if record[4] and rows and app.config["METRICS_ENABLED"]:
+            # 已計入 histogram 的紀錄（請求外或串流回應中），筆數直接累加
+            query_rows_counter.inc((_statement_label(record[0]),), rows)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._add(time.perf_counter() - start, 0 if row is None else 1)
+        return row
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._add(time.perf_counter() - start, len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _InstrumentedDb:
+    """包裝資料庫連線（SQLite 連線或 _PostgresDbWrapper）：記錄每個 execute 的語句形狀、參數、耗時與筆數
+
+    請求內的紀錄在回應前統一彙總（含之後 fetch 的時間）；請求外（CLI、背景執行緒）則立即計入。
+    """
+
+    def __init__(self, db):
+        self.wrapped_db = db
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        cursor = self.wrapped_db.execute(sql, params)
+        rowcount = cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+        record = [normalize_sql(sql), params, time.perf_counter() - start, rowcount, False]
+        perf = _current_perf()
+        if perf is not None:
+            perf.queries.append(record)
+        else:
+            _finish_query(record)
+        return _InstrumentedCursor(cursor, record)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped_db, name)
+
+
+def _server_timing_header(perf, total):
+    parts = [f"total;dur={total * 1000:.1f}"]
+    if perf.queries:
+        db_time = sum(record[2] for record in perf.queries)
+        parts.append(f'db;dur={db_time * 1000:.1f};desc="{len(perf.queries)} queries"')
+    for operation, (duration, count) in perf.operations.items():
+        parts.append(f'{operation};dur={duration * 1000:.1f};desc="{count}x"')
+    return ", ".join(parts)
+
+
+def _start_request_perf():
+    g.perf = _RequestPerf()
+
+
+def _finish_request_perf(response):
+    perf = g.pop("perf", None)
+    if perf is None:
+        return response
+    perf.finished = True
+    total = time.perf_counter() - perf.start
+    for record in perf.queries:
+        _finish_query(record)
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    if app.config["METRICS_ENABLED"]:
+        request_duration_histogram.observe((request.method, route, str(response.status_code)), total)
+    if app.config["SERVER_TIMING_ENABLED"]:
+        response.headers["Server-Timing"] = _server_timing_header(perf, total)
+    repeats = _check_query_repeats(perf)
+    if repeats:
+        detail = "；".join(f"{count} 次：{shape}" for shape, count in repeats)
+        message = f"疑似 N+1 查詢 [{request.method} {route}]（共 {len(perf.queries)} 個查詢）{detail}"
+        if app.config["QUERY_REPEAT_ACTION"] == "raise":
+            raise QueryRepeatError(message)
+        app.logger.warning(message)
+    return response
+
+
+def _template_render_started(sender, template, context, **extra):
+    perf = _current_perf()
+    if perf is not None:
+        g.setdefault("render_starts", []).append(time.perf_counter())
+
+
+def _template_render_finished(sender, template, context, **extra):
+    starts = g.get("render_starts") if has_request_context() else None
+    if starts:
+        _record_operation("render", time.perf_counter() - starts.pop())
+
+
+if INSTRUMENTATION_ENABLED:
+    app.before_request(_start_request_perf)
+    app.after_request(_finish_request_perf)
+    before_render_template.connect(_template_render_started, app)
+    template_rendered.connect(_template_render_finished, app)
+
+
+def _metrics_gauge(name, help_text, metric_type, samples):
+    """samples: [(標籤名稱, 標籤值, 數值)]"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    lines.extend(f"{name}{_prom_labels(names, values)} {value}" for names, values, value in samples)
+    return lines
+
+
+class LruTtlCache:
+    """執行緒安全的 LRU + TTL 快取，附命中／未命中統計"""
+    _MISSING = object()
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (到期時間, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, self._MISSING)
+            if item is not self._MISSING and item[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not self._MISSING:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+user_auth_cache = LruTtlCache(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+user_info_cache = LruTtlCache(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+
+# 使用者資料版本：每次寫入使用者資料時遞增，快取內容記錄建立時的版本，版本不符即視為過期
+_user_versions = {}
+_user_versions_epoch = 0
+_user_versions_lock = threading.Lock()
+
+
+def user_version(user_id):
+    """目前的使用者資料版本（全域 epoch 與個別版本）"""
+    return _user_versions_epoch, _user_versions.get(user_id, 0)
+
+
+def get_user_auth(user_id):
+    """取得使用者授權屬性 {"username", "role", "email_verified"}（優先使用快取），使用者不存在回傳 None"""
+    auth = user_auth_cache.get(user_id)
+    if auth is None:
+        row = get_db().execute(USER_AUTH_SQL, (user_id,)).fetchone()
+        if row is None:
+            return None
+        auth = {"username": row["username"], "role": row["role"] or DEFAULT_ROLE, "email_verified": bool(row["email_verified"])}
+        user_auth_cache.set(user_id, auth)
+    return auth
+
+
+def invalidate_user_auth(user_id=None):
+    """使用者資料寫入後呼叫：清除單一使用者（或 user_id=None 時全部）的快取並遞增資料版本"""
+    global _user_versions_epoch
+    with _user_versions_lock:
+        if user_id is None:
+            _user_versions_epoch += 1
+            _user_versions.clear()
+        else:
+            _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
+    if user_id is None:
+        user_auth_cache.clear()
+        user_info_cache.clear()
+    else:
+        user_auth_cache.invalidate(user_id)
+        user_info_cache.invalidate(user_id)
 
 
 @app.before_request
 def ensure_session_role():
-    """若已登入但 session 沒有 role（例如舊登入），從資料庫補上，供側邊欄判斷是否顯示資料庫管理"""
+    """cookie session：若已登入但 session 沒有 role（例如舊登入），從資料庫補上，供側邊欄判斷是否顯示資料庫管理。
+    伺服器端 session 登入時即寫入 role，不需檢查（也避免每個請求都載入 session）"""
+    if SERVER_SIDE_SESSIONS:
+        return
     if "user_id" in session and "role" not in session:
         try:
-            db = get_db()
-            row = db.execute("SELECT role FROM users WHERE id = ?", (session["user_id"],)).fetchone()
-            if row:
-                session["role"] = row["role"] or DEFAULT_ROLE
+            auth = get_user_auth(session["user_id"])
+            if auth:
+                session["role"] = auth["role"]
         except Exception:
             pass
 
 
-def init_db():
-    """初始化資料庫（開發：SQLite，生產：Postgres）"""
-    db = get_db()
-    cursor = db.cursor()
+# ==================== 資料庫結構版本與遷移 ====================
+#
+# schema_version 表只有一列，記錄目前已套用到的遷移版本。
+# 啟動時只讀這一列；尚未套用的遷移請以 `flask db upgrade` 執行
+# （DB_AUTO_MIGRATE=True 時啟動會自動套用，SQLite 預設開啟）。
 
+app.config["DB_AUTO_MIGRATE"] = os.environ.get(
+    "DB_AUTO_MIGRATE", "False" if USE_POSTGRES else "True"
+).lower() == "true"
+# 模組載入時是否讀取結構版本；建置時（`flask assets ...`，見 vercel.json）設為 False，不連線資料庫
+app.config["DB_CHECK_ON_LOAD"] = os.environ.get("DB_CHECK_ON_LOAD", "True").lower() == "true"
+
+
+def _sqlite_columns(db, table):
+    """SQLite 表的既有欄位名稱"""
+    return {row[1] for row in db.execute(f"PRAGMA table_info({table})").fetchall()}
+
+
+def _migration_0001_create_tables(db):
+    """建立 users / tokens 資料表"""
+    cursor = db.cursor()
     if USE_POSTGRES:
         # Postgres DDL（Vercel Postgres / Neon）
         cursor.execute("""
@@ -209,18 +1096,6 @@ def init_db():
                 updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        # 既有 SQLite 補加新欄位（遷移）
-        for col_sql in [
-            "ALTER TABLE users ADD COLUMN birthday DATE",
-            "ALTER TABLE users ADD COLUMN phone TEXT",
-            "ALTER TABLE users ADD COLUMN address TEXT",
-            "ALTER TABLE users ADD COLUMN work_region TEXT",
-            "ALTER TABLE users ADD COLUMN role TEXT DEFAULT '一般使用者'",
-        ]:
-            try:
-                cursor.execute(col_sql)
-            except sqlite3.OperationalError:
-                pass  # 欄位已存在
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS tokens (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -231,202 +1106,2044 @@ def init_db():
                 FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
             )
         """)
-    db.commit()
 
 
-def hash_password(password):
-    """密碼雜湊"""
-    return hashlib.sha256(password.encode()).hexdigest()
+def _migration_0002_profile_columns(db):
+    """舊版 users 表補加個人資料欄位（生日、手機、住址、工作轄區、身分）"""
+    columns = [
+        ("birthday", "DATE", "DATE"),
+        ("phone", "TEXT", "VARCHAR(50)"),
+        ("address", "TEXT", "TEXT"),
+        ("work_region", "TEXT", "VARCHAR(50)"),
+        ("role", "TEXT DEFAULT '一般使用者'", "VARCHAR(50) DEFAULT '一般使用者'"),
+    ]
+    cursor = db.cursor()
+    if USE_POSTGRES:
+        for name, _, pg_type in columns:
+            cursor.execute(f"ALTER TABLE users ADD COLUMN IF NOT EXISTS {name} {pg_type}")
+    else:
+        existing = _sqlite_columns(db, "users")
+        for name, sqlite_type, _ in columns:
+            if name not in existing:
+                cursor.execute(f"ALTER TABLE users ADD COLUMN {name} {sqlite_type}")
 
 
-def generate_token(length=32):
-    """產生隨機 token"""
-    return secrets.token_urlsafe(length)
+def _migration_0003_lookup_indexes(db):
+    """token 查詢與不分大小寫登入用的次要索引"""
+    cursor = db.cursor()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_verification_token ON users (verification_token)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_reset_token ON users (reset_token)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_email_lower ON users (lower(email))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tokens_user_id ON tokens (user_id)")
 
 
-def generate_jwt_token(user_id, username):
-    """產生 JWT token"""
-    payload = {
-        "user_id": user_id,
-        "username": username,
-        "exp": datetime.utcnow() + app.config["JWT_EXPIRATION_DELTA"],
-        "iat": datetime.utcnow()
-    }
-    return jwt.encode(payload, app.config["JWT_SECRET_KEY"], algorithm=app.config["JWT_ALGORITHM"])
+def _migration_0004_email_outbox(db):
+    """郵件寄送佇列（email_outbox）"""
+    cursor = db.cursor()
+    if USE_POSTGRES:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                id SERIAL PRIMARY KEY,
+                to_email VARCHAR(255) NOT NULL,
+                subject VARCHAR(255) NOT NULL,
+                html_body TEXT NOT NULL,
+                text_body TEXT,
+                status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMP NOT NULL,
+                locked_at TIMESTAMP,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        """)
+    else:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                to_email TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                html_body TEXT NOT NULL,
+                text_body TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at DATETIME NOT NULL,
+                locked_at DATETIME,
+                last_error TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                sent_at DATETIME
+            )
+        """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_status ON email_outbox (status, next_attempt_at)")
 
 
-def verify_jwt_token(token):
-    """驗證 JWT token"""
-    try:
-        payload = jwt.decode(token, app.config["JWT_SECRET_KEY"], algorithms=[app.config["JWT_ALGORITHM"]])
-        return payload
-    except jwt.ExpiredSignatureError:
-        return None
-    except jwt.InvalidTokenError:
-        return None
+def _migration_0005_user_list_indexes(db):
+    """資料庫管理頁篩選與 keyset 分頁用索引"""
+    cursor = db.cursor()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_role_id ON users (role, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_work_region_id ON users (work_region, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_email_verified_id ON users (email_verified, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at_id ON users (created_at, id)")
+    if USE_POSTGRES:
+        # 前綴搜尋（LIKE 'abc%'）在非 C collation 下需 text_pattern_ops 索引
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username_pattern ON users (username text_pattern_ops)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_email_lower_pattern ON users (lower(email) text_pattern_ops)")
 
 
-def login_required(f):
-    """登入驗證裝飾器"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if "user_id" not in session:
-            flash("請先登入", "warning")
-            return redirect(url_for("index"))
-        return f(*args, **kwargs)
-    return decorated_function
+def _migration_0006_jobs(db):
+    """匯入／匯出背景工作（jobs）"""
+    cursor = db.cursor()
+    if USE_POSTGRES:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id SERIAL PRIMARY KEY,
+                kind VARCHAR(20) NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                file_path TEXT,
+                result_path TEXT,
+                dry_run SMALLINT NOT NULL DEFAULT 0,
+                total INTEGER,
+                processed INTEGER NOT NULL DEFAULT 0,
+                added INTEGER NOT NULL DEFAULT 0,
+                updated INTEGER NOT NULL DEFAULT 0,
+                error_count INTEGER NOT NULL DEFAULT 0,
+                errors TEXT,
+                message TEXT,
+                created_by INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """)
+    else:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                file_path TEXT,
+                result_path TEXT,
+                dry_run INTEGER NOT NULL DEFAULT 0,
+                total INTEGER,
+                processed INTEGER NOT NULL DEFAULT 0,
+                added INTEGER NOT NULL DEFAULT 0,
+                updated INTEGER NOT NULL DEFAULT 0,
+                error_count INTEGER NOT NULL DEFAULT 0,
+                errors TEXT,
+                message TEXT,
+                created_by INTEGER,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                started_at DATETIME,
+                finished_at DATETIME
+            )
+        """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)")
+
+
+def _migration_0007_token_store(db):
+    """tokens 表加上種類與撤銷時間，供 refresh token 與撤銷清單使用"""
+    cursor = db.cursor()
+    if USE_POSTGRES:
+        cursor.execute("ALTER TABLE tokens ADD COLUMN IF NOT EXISTS kind VARCHAR(20) NOT NULL DEFAULT 'refresh'")
+        cursor.execute("ALTER TABLE tokens ADD COLUMN IF NOT EXISTS revoked_at TIMESTAMP")
+    else:
+        existing = _sqlite_columns(db, "tokens")
+        if "kind" not in existing:
+            cursor.execute("ALTER TABLE tokens ADD COLUMN kind TEXT NOT NULL DEFAULT 'refresh'")
+        if "revoked_at" not in existing:
+            cursor.execute("ALTER TABLE tokens ADD COLUMN revoked_at DATETIME")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tokens_expires_at ON tokens (expires_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tokens_kind_id ON tokens (kind, id)")
+
+
+def _migration_0008_sessions(db):
+    """建立 sessions 表（伺服器端 session；id 為 session id 的 SHA-256）"""
+    cursor = db.cursor()
+    if USE_POSTGRES:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id VARCHAR(64) PRIMARY KEY,
+                user_id INTEGER,
+                data TEXT NOT NULL,
+                expires_at TIMESTAMP NOT NULL
+            )
+        """)
+    else:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                data TEXT NOT NULL,
+                expires_at DATETIME NOT NULL
+            )
+        """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)")
+
+
+def _migration_0009_token_revoked_at_index(db):
+    """撤銷清單改依 revoked_at 同步（id 在 Postgres 上不保證依 commit 順序可見）"""
+    db.cursor().execute("CREATE INDEX IF NOT EXISTS idx_tokens_kind_revoked_at ON tokens (kind, revoked_at)")
+
+
+# 依版本排序的遷移清單：(版本, 說明, 函式)；新增遷移只能附加在最後
+MIGRATIONS = [
+    (1, "建立 users / tokens 資料表", _migration_0001_create_tables),
+    (2, "users 補加個人資料欄位", _migration_0002_profile_columns),
+    (3, "建立 token 查詢與 lower(email) 索引", _migration_0003_lookup_indexes),
+    (4, "建立 email_outbox 郵件佇列", _migration_0004_email_outbox),
+    (5, "建立資料庫管理頁篩選與分頁索引", _migration_0005_user_list_indexes),
+    (6, "建立 jobs 背景工作表", _migration_0006_jobs),
+    (7, "tokens 表加上 kind / revoked_at", _migration_0007_token_store),
+    (8, "建立 sessions 表", _migration_0008_sessions),
+    (9, "建立 tokens (kind, revoked_at) 索引", _migration_0009_token_revoked_at_index),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(db=None):
+    """讀取目前資料庫結構版本（schema_version 表不存在時為 0）"""
+    db = db or get_db()
+    try:
+        row = db.execute("SELECT version FROM schema_version").fetchone()
+    except Exception:
+        db.rollback()  # Postgres 查詢失敗後須 rollback 才能繼續使用連線
+        return 0
+    return row["version"] if row else 0
+
+
+def upgrade_db(db=None, echo=None):
+    """依序套用尚未執行的遷移，每個遷移各自 commit；回傳套用的版本清單"""
+    db = db or get_db()
+    db.cursor().execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    if db.execute("SELECT version FROM schema_version").fetchone() is None:
+        db.execute("INSERT INTO schema_version (version) VALUES (0)")
+    db.commit()
+    current = get_schema_version(db)
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        if echo:
+            echo(f"套用遷移 {version:04d}：{description}")
+        migrate(db)
+        db.execute("UPDATE schema_version SET version = ?", (version,))
+        db.commit()
+        applied.append(version)
+    return applied
+
+
+# 以帳號或信箱登入：拆成兩段 UNION ALL，各自走 username 唯一索引與 lower(email) 索引，
+# 避免 (username = ? OR email = ?) 在部分查詢規劃器退化為全表掃描。
+# 雜湊帶有隨機鹽，無法在 SQL 中比對，先依識別碼取出候選列（至多兩列）再於應用程式端驗證
+LOGIN_LOOKUP_SQL = """
+    SELECT {columns} FROM users WHERE username = ?
+    UNION ALL
+    SELECT {columns} FROM users WHERE lower(email) = ?
+"""
+
+# 其餘熱門查詢：路由與 HOT_QUERIES 共用同一份 SQL，`flask db check-plans` 檢查的就是實際執行的查詢
+USER_AUTH_SQL = "SELECT username, role, email_verified FROM users WHERE id = ?"
+USER_BY_VERIFICATION_TOKEN_SQL = "SELECT id, email_verified FROM users WHERE verification_token = ?"
+USER_BY_RESET_TOKEN_SQL = "SELECT id, reset_token_expires FROM users WHERE reset_token = ?"
+USER_BY_EMAIL_SQL = "SELECT id, username FROM users WHERE email = ?"
+USERNAME_TAKEN_SQL = "SELECT id FROM users WHERE username = ?"
+EMAIL_TAKEN_SQL = "SELECT id FROM users WHERE email = ?"
+SESSION_LOAD_SQL = "SELECT user_id, data, expires_at FROM sessions WHERE id = ?"
+SESSION_DELETE_USERS_SQL = "DELETE FROM sessions WHERE user_id IN ({placeholders})"
+TOKEN_REVOCATION_SYNC_SQL = """
+    SELECT id, user_id, kind, token, expires_at, created_at, revoked_at FROM tokens
+    WHERE kind IN ('revoked_access', 'user_revocation') AND revoked_at >= ?
+"""
+
+
+def find_login_user(db, identifier, password, columns="id, username"):
+    """以使用者名稱或電子信箱（不分大小寫）查詢使用者並驗證密碼，失敗回傳 None
+
+    驗證成功且雜湊需要升級（舊版 SHA-256 或成本參數已調整）時，順帶以目前設定重新雜湊並寫回。
+    """
+    rows = db.execute(
+        LOGIN_LOOKUP_SQL.format(columns=f"{columns}, password_hash"),
+        (identifier, identifier.lower()),
+    ).fetchall()
+    if not rows:
+        # 查無帳號時仍以相同成本驗證一次，回應時間與「密碼錯誤」相同，無法以耗時判斷帳號／信箱是否存在
+        verify_password(password, _dummy_password_hash())
+        return None
+    seen = set()
+    for row in rows:
+        if row["id"] in seen:
+            continue
+        seen.add(row["id"])
+        if not verify_password(password, row["password_hash"]):
+            continue
+        if password_needs_rehash(row["password_hash"]):
+            try:
+                db.execute(
+                    "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                    (hash_password(password), row["id"], row["password_hash"]),
+                )
+                db.commit()
+            except PasswordHashBusyError:
+                pass  # 升級可留待下次登入，不影響本次登入
+        return row
+    return None
+
+
+# 熱門查詢清單（供 `flask db check-plans` 檢查是否皆走索引）：(名稱, SQL, 範例參數)
+HOT_QUERIES = [
+    ("login", LOGIN_LOOKUP_SQL.format(columns="id, username, email, email_verified, role, password_hash"), ("u", "u")),
+    ("user_by_id", USER_AUTH_SQL, (1,)),
+    ("verify_email", USER_BY_VERIFICATION_TOKEN_SQL, ("t",)),
+    ("reset_password", USER_BY_RESET_TOKEN_SQL, ("t",)),
+    ("forgot_password", USER_BY_EMAIL_SQL, ("e",)),
+    ("register_username", USERNAME_TAKEN_SQL, ("u",)),
+    ("register_email", EMAIL_TAKEN_SQL, ("e",)),
+    ("session_load", SESSION_LOAD_SQL, ("s",)),
+    ("token_revocation_sync", TOKEN_REVOCATION_SYNC_SQL, ("2000-01-01",)),
+    ("session_user_invalidate", SESSION_DELETE_USERS_SQL.format(placeholders="?"), (1,)),
+]
+
+
+def check_query_plans(db=None):
+    """以 EXPLAIN 檢查 HOT_QUERIES，回傳 [(名稱, 是否走索引, 計畫文字)]"""
+    db = db or get_db()
+    results = []
+    if USE_POSTGRES:
+        # 小表時 Postgres 可能偏好 Seq Scan；關閉後若仍是 Seq Scan 代表根本沒有可用索引
+        db.execute("SET LOCAL enable_seqscan = off")
+    for name, sql, params in HOT_QUERIES:
+        if USE_POSTGRES:
+            rows = db.execute("EXPLAIN " + sql, params).fetchall()
+            plan = "\n".join(str(next(iter(r.values()))) for r in rows)
+            ok = "Seq Scan" not in plan
+        else:
+            rows = db.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            details = [r["detail"] for r in rows]
+            plan = "\n".join(details)
+            ok = not any(d.startswith("SCAN ") and not d.startswith("SCAN CONSTANT") for d in details)
+        results.append((name, ok, plan))
+    db.rollback()
+    return results
+
+
+def init_db():
+    """初始化資料庫（開發：SQLite，生產：Postgres）：套用所有尚未執行的遷移"""
+    return upgrade_db()
+
+
+@app.cli.group("db")
+def db_cli():
+    """資料庫結構管理"""
+
+
+@db_cli.command("upgrade")
+def db_upgrade_command():
+    """套用所有尚未執行的遷移"""
+    import click
+    applied = upgrade_db(echo=click.echo)
+    click.echo(f"資料庫結構已是最新版本（{SCHEMA_VERSION}）" if not applied else f"已套用 {len(applied)} 個遷移，目前版本 {SCHEMA_VERSION}")
+
+
+@db_cli.command("check-plans")
+def db_check_plans_command():
+    """檢查熱門查詢的執行計畫，任何一個退化為全表掃描即以非 0 結束"""
+    import click
+    failed = []
+    for name, ok, plan in check_query_plans():
+        click.echo(f"[{'OK' if ok else 'SCAN'}] {name}")
+        for line in plan.splitlines():
+            click.echo(f"    {line}")
+        if not ok:
+            failed.append(name)
+    if failed:
+        raise click.ClickException(f"以下查詢未使用索引：{', '.join(failed)}")
+
+
+@db_cli.command("version")
+def db_version_command():
+    """顯示目前資料庫結構版本"""
+    import click
+    current = get_schema_version()
+    click.echo(f"目前版本 {current}，最新版本 {SCHEMA_VERSION}")
+
+
+# ==================== 密碼雜湊 ====================
+
+def _b64encode(raw):
+    return base64.b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _b64decode(text):
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+class _Pbkdf2Sha256Hasher:
+    """PBKDF2-HMAC-SHA256，格式：pbkdf2_sha256$<iterations>$<salt>$<hash>"""
+    algorithm = "pbkdf2_sha256"
+
+    def __init__(self, iterations):
+        self.iterations = iterations
+
+    def hash(self, password):
+        salt = secrets.token_bytes(16)
+        derived = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, self.iterations)
+        return f"{self.algorithm}${self.iterations}${_b64encode(salt)}${_b64encode(derived)}"
+
+    def verify(self, password, encoded):
+        _, iterations, salt, expected = encoded.split("$")
+        derived = hashlib.pbkdf2_hmac("sha256", password.encode(), _b64decode(salt), int(iterations))
+        return secrets.compare_digest(derived, _b64decode(expected))
+
+    def needs_update(self, encoded):
+        return int(encoded.split("$")[1]) != self.iterations
+
+
+class _ScryptHasher:
+    """scrypt，格式：scrypt$<n>$<r>$<p>$<salt>$<hash>"""
+    algorithm = "scrypt"
+
+    def __init__(self, n, r, p):
+        self.n, self.r, self.p = n, r, p
+
+    @staticmethod
+    def _derive(password, salt, n, r, p):
+        # hashlib 預設 maxmem 只有 32 MiB，依參數放寬（scrypt 約需 128 * r * n bytes）
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=32, maxmem=256 * r * n + 1024 * 1024)
+
+    def hash(self, password):
+        salt = secrets.token_bytes(16)
+        derived = self._derive(password, salt, self.n, self.r, self.p)
+        return f"{self.algorithm}${self.n}${self.r}${self.p}${_b64encode(salt)}${_b64encode(derived)}"
+
+    def verify(self, password, encoded):
+        _, n, r, p, salt, expected = encoded.split("$")
+        derived = self._derive(password, _b64decode(salt), int(n), int(r), int(p))
+        return secrets.compare_digest(derived, _b64decode(expected))
+
+    def needs_update(self, encoded):
+        return tuple(int(x) for x in encoded.split("$")[1:4]) != (self.n, self.r, self.p)
+
+
+class _LegacySha256Hasher:
+    """舊版無鹽 SHA-256（64 位十六進位字串），只用於驗證既有雜湊，登入成功後即升級"""
+    algorithm = "sha256"
+
+    def verify(self, password, encoded):
+        return secrets.compare_digest(hashlib.sha256(password.encode()).hexdigest(), encoded)
+
+    def needs_update(self, encoded):
+        return True
+
+
+def _build_password_hashers():
+    hashers = {
+        "pbkdf2_sha256": _Pbkdf2Sha256Hasher(app.config["PASSWORD_PBKDF2_ITERATIONS"]),
+        "scrypt": _ScryptHasher(
+            app.config["PASSWORD_SCRYPT_N"], app.config["PASSWORD_SCRYPT_R"], app.config["PASSWORD_SCRYPT_P"]
+        ),
+    }
+    if app.config["PASSWORD_HASHER"] not in hashers:
+        raise RuntimeError(f"未知的 PASSWORD_HASHER：{app.config['PASSWORD_HASHER']}（可用：{', '.join(hashers)}）")
+    return hashers
+
+
+PASSWORD_HASHERS = _build_password_hashers()
+_legacy_password_hasher = _LegacySha256Hasher()
+
+
+def _hasher_for(encoded):
+    """依雜湊字串前綴選擇演算法；無前綴者視為舊版 SHA-256，無法辨識者回傳 None"""
+    if "$" in encoded:
+        return PASSWORD_HASHERS.get(encoded.split("$", 1)[0])
+    return _legacy_password_hasher if len(encoded) == 64 else None
+
+
+class PasswordHashBusyError(Exception):
+    """密碼雜湊執行緒池已滿且等待逾時"""
+
+
+class _PasswordKdfPool:
+    """有界的密碼雜湊執行緒池
+
+    hashlib 的 pbkdf2_hmac / scrypt 計算時會釋放 GIL，集中在固定數量的執行緒上可限制同時佔用的 CPU，
+    大量請求湧入時只會排隊或快速失敗（PasswordHashBusyError），不會拖垮其他請求。
+    """
+
+    def __init__(self, name, workers, max_pending, wait_timeout):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.wait_timeout = wait_timeout
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        pid = os.getpid()
+        if self._executor is None or self._pid != pid:
+            with self._lock:
+                if self._executor is None or self._pid != pid:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+                    self._slots = threading.BoundedSemaphore(self.max_pending)
+                    self._pid = pid
+        return self._executor, self._slots
+
+    def submit(self, fn, *args):
+        """排入計算並回傳 Future；排隊數已達上限且等待逾時則拋出 PasswordHashBusyError"""
+        executor, slots = self._ensure_executor()
+        if not slots.acquire(timeout=self.wait_timeout):
+            raise PasswordHashBusyError()
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+
+_login_kdf_pool = _PasswordKdfPool(
+    "password-hash",
+    app.config["PASSWORD_HASH_WORKERS"],
+    app.config["PASSWORD_HASH_MAX_PENDING"],
+    app.config["PASSWORD_HASH_WAIT_TIMEOUT"],
+)
+_import_kdf_pool = _PasswordKdfPool(
+    "import-password-hash",
+    app.config["IMPORT_PASSWORD_HASH_WORKERS"],
+    app.config["IMPORT_PASSWORD_HASH_WORKERS"] * 4,
+    app.config["IMPORT_PASSWORD_HASH_WAIT_TIMEOUT"],
+)
+
+
+@timed_operation("password_hash")
+def _run_password_kdf(fn, *args):
+    """在登入用的密碼雜湊執行緒池中計算並等待結果"""
+    return _login_kdf_pool.submit(fn, *args).result()
+
+
+def hash_password(password):
+    """以目前設定的演算法與成本參數雜湊密碼（含隨機鹽）"""
+    return _run_password_kdf(PASSWORD_HASHERS[app.config["PASSWORD_HASHER"]].hash, password)
+
+
+def verify_password(password, encoded):
+    """驗證密碼是否符合已儲存的雜湊（支援所有已知格式）"""
+    hasher = _hasher_for(encoded or "")
+    if hasher is None:
+        return False
+    try:
+        return _run_password_kdf(hasher.verify, password, encoded)
+    except (ValueError, TypeError):
+        return False  # 雜湊字串格式損毀
+
+
+@lru_cache(maxsize=1)
+def _dummy_password_hash():
+    """以目前演算法與成本參數雜湊的隨機密碼（供查無帳號時耗費相同的驗證時間）"""
+    return hash_password(secrets.token_urlsafe(16))
+
+
+def password_needs_rehash(encoded):
+    """雜湊是否非目前設定的演算法或成本參數"""
+    hasher = _hasher_for(encoded or "")
+    if hasher is None or hasher.algorithm != app.config["PASSWORD_HASHER"]:
+        return True
+    try:
+        return hasher.needs_update(encoded)
+    except (ValueError, IndexError):
+        return True
+
+
+@app.errorhandler(PasswordHashBusyError)
+def handle_password_hash_busy(e):
+    """密碼雜湊排隊逾時：API 回 JSON，頁面回純文字，皆帶 Retry-After"""
+    if request.path.startswith("/api/"):
+        response = jsonify({"ok": False, "message": "系統忙碌中，請稍後再試"})
+    else:
+        response = Response("系統忙碌中，請稍後再試", mimetype="text/plain")
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+def generate_token(length=32):
+    """產生隨機 token"""
+    return secrets.token_urlsafe(length)
+
+
+def _json_datetime(value):
+    """與 Flask jsonify 相同的日期格式（SQLite 回傳字串則原樣保留）"""
+    if isinstance(value, (datetime, date)):
+        return http_date(value)
+    return value
+
+
+def generate_jwt_token(user_id, username, profile=None):
+    """產生 JWT token；JWT_EMBED_PROFILE_CLAIMS 開啟且提供 profile（含 email、email_verified、created_at）時一併放入"""
+    payload = {
+        "user_id": user_id,
+        "username": username,
+        "jti": secrets.token_urlsafe(12),
+        "exp": datetime.utcnow() + app.config["JWT_EXPIRATION_DELTA"],
+        "iat": datetime.utcnow()
+    }
+    if profile is not None and app.config["JWT_EMBED_PROFILE_CLAIMS"]:
+        payload["profile"] = {
+            "email": profile["email"],
+            "email_verified": bool(profile["email_verified"]),
+            "created_at": _json_datetime(profile["created_at"]),
+        }
+    return jwt.encode(payload, app.config["JWT_SECRET_KEY"], algorithm=app.config["JWT_ALGORITHM"])
+
+
+jwt_cache = LruTtlCache(app.config["JWT_CACHE_SIZE"], app.config["JWT_CACHE_TTL"])
+
+
+def verify_jwt_token(token):
+    """驗證 JWT token；同一 token 重複驗證時直接使用快取的解碼結果（回傳的 dict 為共用物件，請勿修改）"""
+    key = hashlib.sha256(token.encode()).digest()
+    payload = jwt_cache.get(key)
+    if payload is not None:
+        return None if token_revocations.is_revoked(payload) else payload
+    try:
+        payload = jwt.decode(token, app.config["JWT_SECRET_KEY"], algorithms=[app.config["JWT_ALGORITHM"]])
+    except jwt.ExpiredSignatureError:
+        return None
+    except jwt.InvalidTokenError:
+        return None
+    # 快取時間不超過 token 剩餘有效期，token 過期後快取也一併失效
+    remaining = payload["exp"] - time.time() if "exp" in payload else app.config["JWT_CACHE_TTL"]
+    jwt_cache.set(key, payload, min(app.config["JWT_CACHE_TTL"], remaining))
+    return None if token_revocations.is_revoked(payload) else payload
+
+
+def _bearer_token():
+    """從 Authorization 標頭取出 token（接受 "Bearer <token>" 或單純 token）"""
+    auth = request.headers.get("Authorization", "").strip()
+    if auth[:7].lower() == "bearer ":
+        auth = auth[7:].strip()
+    return auth
+
+
+def _authenticate_token():
+    """驗證 Bearer token 並把解碼內容放在 g.jwt_payload；失敗時回傳錯誤回應"""
+    token = _bearer_token()
+    if not token:
+        return jsonify({"ok": False, "message": "請提供 token"}), 400
+    payload = verify_jwt_token(token)
+    if not payload:
+        return jsonify({"ok": False, "message": "無效或過期的 token"}), 401
+    g.jwt_payload = payload
+    return None
+
+
+def token_required(f):
+    """API Token 驗證裝飾器：驗證通過後解碼內容放在 g.jwt_payload（可用於 async view）"""
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def decorated_coroutine(*args, **kwargs):
+            return _authenticate_token() or await f(*args, **kwargs)
+        return decorated_coroutine
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        return _authenticate_token() or f(*args, **kwargs)
+    return decorated_function
+
+
+# ==================== 伺服器端 Session ====================
+#
+# cookie 只存隨機 session id，資料（user_id、username、role、flash 訊息）存在 SESSION_BACKEND，
+# 鍵為 session id 的 SHA-256（後端內容外洩也無法冒用）。第一次讀寫 session 時才向後端載入，
+# 內容有變更（或剩餘效期不到一半）才寫回。使用者的 username／role／密碼被變更時以 invalidate_user_sessions()
+# 刪除其所有 session，因此 session 內的 role 即為最新，權限檢查不需查詢資料庫。
+
+class ServerSession(SessionMixin):
+    """延遲載入的 session：第一次存取時才呼叫 loader 讀取後端"""
+
+    def __init__(self, sid=None, loader=None):
+        self.sid = sid
+        self._loader = loader
+        self._data = None
+        self.loaded_user_id = None
+        self.expires_at = None
+        self.stale_cookie = False  # cookie 帶的 id 在後端已不存在（過期、登出或被撤銷）
+        self.invalidated = False  # 本請求內 invalidate_user_sessions() 已撤銷此 session，結束時不得寫回
+        self.deferred_save = None  # ASGI 模式的 async view：(app, response)，由 asgi_app 在執行緒中寫回
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def _items(self):
+        self.accessed = True
+        if self._data is None:
+            record = self._loader() if self._loader else None
+            if record is None:
+                self._data = {}
+                if self.sid:
+                    # 不沿用用戶端提供但後端沒有的 id，寫入時一律產生新 id（避免 session fixation）
+                    self.sid, self.stale_cookie, self.new = None, True, True
+            else:
+                self.loaded_user_id, self._data, self.expires_at = record
+        return self._data
+
+    def __getitem__(self, key):
+        return self._items()[key]
+
+    def __setitem__(self, key, value):
+        self._items()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._items()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._items())
+
+    def __len__(self):
+        return len(self._items())
+
+    def clear(self):
+        self._items().clear()
+        self.modified = True
+
+
+class _MemorySessionBackend:
+    """行程內 LRU（超過上限淘汰最久未使用者）；重新啟動即全部登出，且不跨行程共用"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (user_id, 序列化資料, 到期 unix 秒)
+        self._by_user = {}  # user_id -> {key}
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        record = self._data.pop(key, None)
+        if record is not None and record[0] is not None:
+            keys = self._by_user.get(record[0])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_user[record[0]]
+
+    def load(self, key):
+        with self._lock:
+            record = self._data.get(key)
+            if record is None:
+                return None
+            if record[2] <= time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return record
+
+    def save(self, key, user_id, data, expires_at, create):
+        with self._lock:
+            if not create and key not in self._data:
+                return False  # 已被刪除（登出或撤銷），不可寫回
+            self._remove(key)
+            self._data[key] = (user_id, data, expires_at)
+            if user_id is not None:
+                self._by_user.setdefault(user_id, set()).add(key)
+            while len(self._data) > self.max_entries:
+                self._remove(next(iter(self._data)))
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def delete_users(self, user_ids, keep=None):
+        with self._lock:
+            keys = [key for user_id in user_ids for key in self._by_user.get(user_id, ()) if key != keep]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [key for key, record in self._data.items() if record[2] <= now]
+            for key in expired:
+                self._remove(key)
+            return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "users": len(self._by_user)}
+
+
+class _DatabaseSessionBackend:
+    """sessions 表（遷移 0008），使用請求的資料庫連線；多行程、多機共用
+
+    寫入前先 rollback 視圖留下的未提交交易（請求結束時本來就會被捨棄），session 寫入自成一個交易：
+    不會替視圖提交半途的資料，也不會因視圖已中止的交易（Postgres 捕捉 IntegrityError 後）而失敗。
+    """
+
+    def load(self, key):
+        row = get_db().execute(SESSION_LOAD_SQL, (key,)).fetchone()
+        if row is None:
+            return None
+        expires_at = _parse_db_datetime(row["expires_at"]).timestamp()
+        if expires_at <= time.time():
+            return None  # 過期資料列由 `flask sessions sweep` 清除
+        return row["user_id"], row["data"], expires_at
+
+    def _write(self, sql, params):
+        db = get_db()
+        if db.in_transaction:
+            db.rollback()
+        try:
+            cur = db.execute(sql, params)
+            db.commit()
+            return cur.rowcount
+        except Exception:
+            db.rollback()
+            raise
+
+    def save(self, key, user_id, data, expires_at, create):
+        expires = _db_timestamp(datetime.utcfromtimestamp(expires_at))
+        if create:
+            self._write(
+                "INSERT INTO sessions (id, user_id, data, expires_at) VALUES (?, ?, ?, ?)",
+                (key, user_id, data, expires),
+            )
+            return True
+        # 既有 id 只更新不插入：請求進行中被 invalidate_user_sessions() 刪除的 session 不會以舊內容（舊 role）復活
+        return self._write(
+            "UPDATE sessions SET user_id = ?, data = ?, expires_at = ? WHERE id = ?", (user_id, data, expires, key)
+        ) > 0
+
+    def delete(self, key):
+        self._write("DELETE FROM sessions WHERE id = ?", (key,))
+
+    def delete_users(self, user_ids, keep=None):
+        sql = SESSION_DELETE_USERS_SQL.format(placeholders=", ".join("?" * len(user_ids)))
+        if keep:
+            return self._write(sql + " AND id <> ?", [*user_ids, keep])
+        return self._write(sql, list(user_ids))
+
+    def sweep(self):
+        return self._write("DELETE FROM sessions WHERE expires_at < ?", (_db_timestamp(datetime.utcnow()),))
+
+
+def _load_session_backend(spec):
+    """依設定建立後端：memory、database，或 "模組:類別"（類別須提供 load、save、delete、delete_users、sweep；
+    save(key, user_id, data, expires_at, create) 在 create 為 False 且 key 已不存在時不得寫入，並回傳 False）"""
+    if spec == "memory":
+        return _MemorySessionBackend(app.config["SESSION_MEMORY_MAX_ENTRIES"])
+    if spec == "database":
+        return _DatabaseSessionBackend()
+    import importlib
+    module_name, _, attr = spec.partition(":")
+    if not attr:
+        raise RuntimeError(f"未知的 SESSION_BACKEND：{spec}（可用：database、memory、cookie 或 模組:類別）")
+    return getattr(importlib.import_module(module_name), attr)()
+
+
+class ServerSessionInterface(SessionInterface):
+    """以 ServerSession 取代簽章 cookie session"""
+    serializer = TaggedJSONSerializer()  # 與 Flask cookie session 相同，可存 tuple、Markup、datetime 等
+
+    def __init__(self, backend, idle_timeout):
+        self.backend = backend
+        self.idle_timeout = idle_timeout.total_seconds()
+
+    @staticmethod
+    def storage_key(sid):
+        return hashlib.sha256(sid.encode("utf-8")).hexdigest()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return ServerSession()
+        key = self.storage_key(sid)
+
+        def loader():
+            record = self.backend.load(key)
+            if record is None:
+                return None
+            user_id, data, expires_at = record
+            try:
+                return user_id, self.serializer.loads(data), expires_at
+            except ValueError:
+                return None
+
+        return ServerSession(sid, loader)
+
+    @property
+    def blocking(self):
+        """後端讀寫是否會阻塞（資料庫等）：ASGI 模式的 async view 須在執行緒中讀寫"""
+        return not isinstance(self.backend, _MemorySessionBackend)
+
+    def save_session(self, app, session, response):
+        if session.loaded and self.blocking and _native_asgi.get():
+            session.deferred_save = (app, response)  # 不在事件迴圈上查詢資料庫，由 asgi_app 以 run_sync() 寫回
+            return
+        self.write_session(app, session, response)
+
+    def write_session(self, app, session, response):
+        if session.accessed:
+            response.vary.add("Cookie")
+        if not session.loaded:
+            return  # 本請求未讀寫 session：不查詢也不寫入後端
+        cookie = {
+            "domain": self.get_cookie_domain(app),
+            "path": self.get_cookie_path(app),
+            "secure": self.get_cookie_secure(app),
+            "httponly": self.get_cookie_httponly(app),
+            "samesite": self.get_cookie_samesite(app),
+        }
+        name = self.get_cookie_name(app)
+        if session.invalidated:
+            response.delete_cookie(name, **cookie)
+            return
+        if not session:
+            if session.sid:
+                self.backend.delete(self.storage_key(session.sid))
+            if session.sid or session.stale_cookie:
+                response.delete_cookie(name, **cookie)
+            return
+        if session.sid and session.get("user_id") != session.loaded_user_id:
+            # 登入／切換使用者時換發新 id，舊 id 即失效
+            self.backend.delete(self.storage_key(session.sid))
+            session.sid = None
+        now = time.time()
+        refresh = session.expires_at is None or session.expires_at - now < self.idle_timeout / 2
+        if not (session.modified or session.sid is None or refresh):
+            return
+        issue_cookie = session.sid is None
+        if issue_cookie:
+            session.sid = secrets.token_urlsafe(32)
+        saved = self.backend.save(
+            self.storage_key(session.sid), session.get("user_id"),
+            self.serializer.dumps(dict(session)), now + self.idle_timeout, issue_cookie,
+        )
+        if not saved:
+            # 請求進行中已被其他請求撤銷（改身分、刪除使用者等）：視同登出
+            response.delete_cookie(name, **cookie)
+            return
+        if issue_cookie or session.permanent:
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session), **cookie)
+
+
+SERVER_SIDE_SESSIONS = app.config["SESSION_BACKEND"] != "cookie"
+if SERVER_SIDE_SESSIONS:
+    app.session_interface = ServerSessionInterface(
+        _load_session_backend(app.config["SESSION_BACKEND"]), app.config["SESSION_IDLE_TIMEOUT"]
+    )
+
+
+def invalidate_user_sessions(*user_ids, keep_current=False):
+    """刪除使用者所有伺服器端 session（所有裝置須重新登入），回傳刪除數；keep_current 時保留目前請求的 session。
+    SESSION_BACKEND=cookie 時無法撤銷，不做任何事"""
+    if not SERVER_SIDE_SESSIONS or not user_ids:
+        return 0
+    keep = None
+    if has_request_context() and isinstance(session._get_current_object(), ServerSession):
+        if keep_current and session.sid:
+            keep = ServerSessionInterface.storage_key(session.sid)
+        elif not keep_current and session.get("user_id") in user_ids:
+            session.invalidated = True  # 目前請求稍後的 flash() 等不得把已刪除的 session 寫回
+    return app.session_interface.backend.delete_users(user_ids, keep)
+
+
+@app.cli.group("sessions")
+def sessions_cli():
+    """伺服器端 session 管理"""
+
+
+@sessions_cli.command("sweep")
+def sessions_sweep_command():
+    """刪除已過期的 session"""
+    if not SERVER_SIDE_SESSIONS:
+        raise click.ClickException("SESSION_BACKEND=cookie 時沒有伺服器端 session")
+    click.echo(f"已刪除 {app.session_interface.backend.sweep()} 筆過期 session")
+
+
+# ==================== Token 儲存與撤銷 ====================
+#
+# tokens 表的 kind：
+#   refresh          refresh token（token 欄存 SHA-256 雜湊，revoked_at 非空即已撤銷）
+#   revoked_access   已撤銷的 access token（token 欄存 jti）
+#   user_revocation  撤銷某使用者在 created_at 之前簽發的所有 access token
+# 後兩者以 id 遞增同步到各行程的記憶體撤銷清單，驗證 token 時不需查詢資料庫。
+
+class _TokenRevocationList:
+    """記憶體中的撤銷清單：背景執行緒定期依 revoked_at 增量同步，並批次刪除過期資料列
+
+    不以 id > 上次位置同步：Postgres 的 SERIAL 在交易開始寫入時就配號，較小的 id 可能較晚 commit，
+    會被永遠略過。改為每次重新讀取 revoked_at 在「已同步的最新時間 - TOKEN_REVOCATION_SYNC_WINDOW」之後的紀錄，
+    以 id 去除已處理者。
+    """
+    def __init__(self):
+        self._revoked_jtis = {}  # jti -> exp（unix 秒）
+        self._not_before = {}  # user_id -> (簽發時間下限, 到期時間)
+        self._synced_until = None  # 已同步紀錄中最新的 revoked_at
+        self._seen_ids = {}  # 視窗內已處理的 id -> revoked_at（unix 秒）
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._last_sweep = 0.0
+
+    def is_revoked(self, payload):
+        self._ensure_started()
+        if not self._revoked_jtis and not self._not_before:
+            return False
+        jti = payload.get("jti")
+        if jti is not None and jti in self._revoked_jtis:
+            return True
+        not_before = self._not_before.get(payload.get("user_id"))
+        return bool(not_before and payload.get("iat", 0) < not_before[0])
+
+    def add_jti(self, jti, exp):
+        with self._lock:
+            self._revoked_jtis[jti] = exp
+
+    def add_user(self, user_id, not_before, exp):
+        with self._lock:
+            current = self._not_before.get(user_id)
+            if not current or current[0] < not_before:
+                self._not_before[user_id] = (not_before, exp)
+
+    def _prune(self):
+        now = time.time()
+        with self._lock:
+            self._revoked_jtis = {j: e for j, e in self._revoked_jtis.items() if e > now}
+            self._not_before = {u: v for u, v in self._not_before.items() if v[1] > now}
+
+    def sync(self, db):
+        """讀取同步視窗內（含較晚 commit 的）撤銷紀錄"""
+        window = app.config["TOKEN_REVOCATION_SYNC_WINDOW"]
+        since = datetime(1970, 1, 1) if self._synced_until is None else \
+            datetime.utcfromtimestamp(self._synced_until - window)
+        rows = db.execute(TOKEN_REVOCATION_SYNC_SQL, (_db_timestamp(since),)).fetchall()
+        for row in rows:
+            revoked_at = _parse_db_datetime(row["revoked_at"]).timestamp()
+            if self._synced_until is None or revoked_at > self._synced_until:
+                self._synced_until = revoked_at
+            if row["id"] in self._seen_ids:
+                continue
+            self._seen_ids[row["id"]] = revoked_at
+            exp = _parse_db_datetime(row["expires_at"]).timestamp()
+            if row["kind"] == "revoked_access":
+                self.add_jti(row["token"], exp)
+            else:
+                self.add_user(row["user_id"], _revocation_not_before(_parse_db_datetime(row["created_at"])), exp)
+        db.rollback()
+        if self._synced_until is not None:
+            horizon = self._synced_until - window
+            self._seen_ids = {i: t for i, t in self._seen_ids.items() if t >= horizon}
+        self._prune()
+
+    def _ensure_started(self):
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name="token-revocation-sync", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with app.app_context():
+                    db = get_db()
+                    self.sync(db)
+                    if time.monotonic() - self._last_sweep > app.config["TOKEN_SWEEP_INTERVAL"]:
+                        self._last_sweep = time.monotonic()
+                        sweep_expired_tokens(db)
+            except Exception as e:
+                print(f"[token revocation] {e}")
+            time.sleep(app.config["TOKEN_REVOCATION_SYNC_INTERVAL"])
+
+
+token_revocations = _TokenRevocationList()
+
+
+def _parse_db_datetime(value):
+    """資料庫時間欄位轉 datetime（SQLite 回傳字串，視為 UTC）"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace(" ", "T"))
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def _revocation_not_before(revoked_at):
+    """iat 以秒為單位：撤銷當秒（含）之前簽發的 token 一律無效"""
+    return int(revoked_at.timestamp()) + 1
+
+
+def _hash_refresh_token(raw):
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def issue_refresh_token(db, user_id):
+    """產生 refresh token（資料庫只存雜湊），回傳原始字串"""
+    raw = secrets.token_urlsafe(32)
+    db.execute(
+        "INSERT INTO tokens (user_id, token, kind, expires_at) VALUES (?, ?, 'refresh', ?)",
+        (user_id, _hash_refresh_token(raw), _db_timestamp(datetime.utcnow() + app.config["JWT_REFRESH_EXPIRATION_DELTA"])),
+    )
+    return raw
+
+
+def revoke_access_token(db, payload):
+    """撤銷單一 access token（以 jti 記錄，到期後由清理程序刪除）"""
+    if not payload.get("jti"):
+        return
+    db.execute(
+        "INSERT INTO tokens (user_id, token, kind, expires_at, revoked_at) VALUES (?, ?, 'revoked_access', ?, ?)",
+        (payload["user_id"], payload["jti"], _db_timestamp(datetime.utcfromtimestamp(payload["exp"])),
+         _db_timestamp(datetime.utcnow())),
+    )
+    token_revocations.add_jti(payload["jti"], payload["exp"])
+
+
+def revoke_user_tokens(db, user_id):
+    """撤銷使用者所有 refresh token 與目前為止簽發的 access token（例如變更密碼後）"""
+    now = datetime.utcnow()
+    db.execute(
+        "UPDATE tokens SET revoked_at = ? WHERE user_id = ? AND kind = 'refresh' AND revoked_at IS NULL",
+        (_db_timestamp(now), user_id),
+    )
+    expires = now + app.config["JWT_EXPIRATION_DELTA"]
+    db.execute(
+        "INSERT INTO tokens (user_id, token, kind, expires_at, created_at, revoked_at) VALUES (?, ?, 'user_revocation', ?, ?, ?)",
+        (user_id, f"user:{user_id}:{secrets.token_hex(8)}", _db_timestamp(expires), _db_timestamp(now), _db_timestamp(now)),
+    )
+    token_revocations.add_user(
+        user_id, _revocation_not_before(now.replace(tzinfo=timezone.utc)), expires.replace(tzinfo=timezone.utc).timestamp()
+    )
+
+
+def sweep_expired_tokens(db, batch_size=None):
+    """分批刪除已過期的 tokens 資料列，回傳刪除筆數"""
+    batch_size = batch_size or app.config["TOKEN_SWEEP_BATCH_SIZE"]
+    now = _db_timestamp(datetime.utcnow())
+    total = 0
+    while True:
+        cur = db.execute(
+            "DELETE FROM tokens WHERE id IN (SELECT id FROM tokens WHERE expires_at < ? LIMIT ?)",
+            (now, batch_size),
+        )
+        db.commit()
+        total += cur.rowcount
+        if cur.rowcount < batch_size:
+            return total
+
+
+@app.cli.group("tokens")
+def tokens_cli():
+    """API token 管理"""
+
+
+@tokens_cli.command("sweep")
+def tokens_sweep_command():
+    """刪除所有已過期的 tokens 資料列"""
+    import click
+    click.echo(f"已刪除 {sweep_expired_tokens(get_db())} 筆過期 token")
+
+
+def login_required(f):
+    """登入驗證裝飾器"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if "user_id" not in session:
+            flash("請先登入", "warning")
+            return redirect(url_for("index"))
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def admin_required(f):
+    """管理者驗證裝飾器（須為登入且 role 為管理者）"""
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        if SERVER_SIDE_SESSIONS:
+            # role 變更時該使用者的 session 皆已刪除，session 內的 role 即為最新
+            is_admin = session.get("role") == "管理者"
+        else:
+            auth = get_user_auth(session["user_id"])
+            is_admin = bool(auth) and auth["role"] == "管理者"
+        if not is_admin:
+            flash("僅管理者可存取此功能", "error")
+            return redirect(url_for("home"))
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def email_verified_required(f):
+    """信箱驗證裝飾器"""
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        auth = get_user_auth(session["user_id"])
+        if not auth or not auth["email_verified"]:
+            flash("請先驗證您的電子信箱", "warning")
+            return redirect(url_for("verify_email"))
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def _db_timestamp(dt):
+    """datetime 轉為資料庫比較用字串（SQLite 以文字比較，格式須一致）"""
+    return dt.isoformat(sep=" ", timespec="seconds")
+
+
+def _encode_header_value(value):
+    """非 ASCII 標頭值以 RFC 2047 編碼"""
+    return value if value.isascii() else Header(value, "utf-8").encode()
+
+
+def _encode_address(value):
+    """編碼 "名稱 <地址>" 格式的信箱標頭（名稱可為中文）"""
+    name, addr = parseaddr(value)
+    return formataddr((name, addr)) if addr else _encode_header_value(value)
+
+
+def _base64_body(body):
+    """utf-8 內文轉為 base64（每行 76 字元、CRLF 換行）"""
+    return base64.encodebytes(body.encode("utf-8")).replace(b"\n", b"\r\n")
+
+
+class _EmailSkeleton:
+    """同一類郵件（相同主旨與寄件者）的 MIME 骨架
+
+    主旨、寄件者等固定標頭與各段的 MIME 標頭只編碼一次並快取，
+    每封郵件只需填入收件人並以 base64 編碼內文，不必每次重建 MIMEMultipart。
+    """
+    _PART_HEADER = (
+        'Content-Type: text/{subtype}; charset="utf-8"\r\n'
+        "MIME-Version: 1.0\r\n"
+        "Content-Transfer-Encoding: base64\r\n\r\n"
+    )
+
+    def __init__(self, subject, mail_from):
+        self.envelope_from = parseaddr(mail_from)[1] or mail_from
+        self._head = (
+            f"Subject: {_encode_header_value(subject)}\r\n"
+            f"From: {_encode_address(mail_from)}\r\n"
+            "MIME-Version: 1.0\r\n"
+        ).encode("ascii")
+        self._plain_header = self._PART_HEADER.format(subtype="plain").encode("ascii")
+        self._html_header = self._PART_HEADER.format(subtype="html").encode("ascii")
+
+    def render(self, to_email, html_body, text_body=None):
+        """產生可直接交給 SMTP 的郵件 bytes"""
+        boundary = ("===============" + secrets.token_hex(12) + "==").encode("ascii")
+        parts = [
+            self._head,
+            b"To: ", _encode_address(to_email).encode("ascii"), b"\r\n",
+            b'Content-Type: multipart/alternative; boundary="', boundary, b'"\r\n\r\n',
+        ]
+        # 添加文字和 HTML 內容
+        if text_body:
+            parts += [b"--", boundary, b"\r\n", self._plain_header, _base64_body(text_body)]
+        parts += [b"--", boundary, b"\r\n", self._html_header, _base64_body(html_body)]
+        parts += [b"--", boundary, b"--\r\n"]
+        return b"".join(parts)
+
+
+@lru_cache(maxsize=64)
+def _email_skeleton(subject, mail_from):
+    return _EmailSkeleton(subject, mail_from)
+
+
+def _build_email_message(to_email, subject, html_body, text_body=None):
+    """建立郵件：回傳 (信封寄件者, 郵件 bytes)"""
+    skeleton = _email_skeleton(subject, app.config["MAIL_FROM"])
+    return skeleton.envelope_from, skeleton.render(to_email, html_body, text_body)
+
+
+class _SmtpSession:
+    """可重複使用的 SMTP 連線：第一次發送時連線、STARTTLS、登入，之後沿用直到閒置逾時或斷線"""
+    def __init__(self, idle_timeout=60.0):
+        self.idle_timeout = idle_timeout
+        self._server = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        server = smtplib.SMTP(app.config["MAIL_SERVER"], app.config["MAIL_PORT"], timeout=30)
+        # has_extn() 只反映最近一次 EHLO 的回覆，STARTTLS 後功能清單會被清空，須重新 EHLO 才能判斷是否支援 AUTH
+        server.ehlo()
+        if app.config["MAIL_USE_TLS"]:
+            server.starttls()
+            server.ehlo()
+        # 本機測試用 SMTP（例如 aiosmtpd）未提供 AUTH 時略過登入
+        if app.config["MAIL_USERNAME"] and server.has_extn("auth"):
+            server.login(app.config["MAIL_USERNAME"], app.config["MAIL_PASSWORD"])
+        return server
+
+    def send(self, to_email, message):
+        """message 為 _build_email_message() 的回傳值 (信封寄件者, 郵件 bytes)"""
+        envelope_from, raw = message
+        if self._server is not None and time.monotonic() - self._last_used > self.idle_timeout:
+            self.close()
+        if self._server is None:
+            self._server = self._connect()
+        try:
+            self._server.sendmail(envelope_from, [to_email], raw)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            raise
+        except OSError as e:
+            # 連線層級錯誤（socket 逾時等）丟棄連線，下一封重新連線；
+            # 收件人被拒等 SMTPException 僅影響該封郵件，連線可繼續使用
+            if not isinstance(e, smtplib.SMTPException):
+                self.close()
+            raise
+        finally:
+            self._last_used = time.monotonic()
+
+    def close_if_idle(self):
+        if self._server is not None and time.monotonic() - self._last_used > self.idle_timeout:
+            self.close()
+
+    def close(self):
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                try:
+                    server.close()
+                except Exception:
+                    pass
+
+
+def _print_dev_email(to_email, subject, html_body, text_body):
+    print(f"[開發模式] 郵件不會實際發送")
+    print(f"收件人: {to_email}")
+    print(f"主旨: {subject}")
+    print(f"內容: {text_body or html_body}")
+
+
+@timed_operation("send_email")
+def send_email(to_email, subject, html_body, text_body=None):
+    """發送電子郵件（MAIL_QUEUE_MODE 非 off 時只寫入 email_outbox，由背景寄送）"""
+    # 如果沒有設定郵件帳號，則不發送（開發環境）
+    if not app.config["MAIL_USERNAME"] or not app.config["MAIL_PASSWORD"]:
+        _print_dev_email(to_email, subject, html_body, text_body)
+        return True
+
+    if app.config["MAIL_QUEUE_MODE"] != "off":
+        try:
+            enqueue_email(to_email, subject, html_body, text_body)
+            return True
+        except Exception as e:
+            print(f"郵件寫入佇列失敗: {e}")
+            return False
+
+    session_ = _SmtpSession()
+    try:
+        session_.send(to_email, _build_email_message(to_email, subject, html_body, text_body))
+        return True
+    except Exception as e:
+        print(f"發送郵件失敗: {e}")
+        return False
+    finally:
+        session_.close()
+
+
+# ==================== 郵件佇列（email_outbox） ====================
+
+def enqueue_email(to_email, subject, html_body, text_body=None, db=None):
+    """寫入 email_outbox 並喚醒背景寄送執行緒（thread 模式）"""
+    db = db or get_db()
+    db.execute(
+        """INSERT INTO email_outbox (to_email, subject, html_body, text_body, status, attempts, next_attempt_at)
+           VALUES (?, ?, ?, ?, 'pending', 0, ?)""",
+        (to_email, subject, html_body, text_body, _db_timestamp(datetime.utcnow())),
+    )
+    db.commit()
+    if app.config["MAIL_QUEUE_MODE"] == "thread":
+        ensure_outbox_worker().wake()
+
+
+class _EmailOutboxWorker:
+    """從 email_outbox 批次取出待寄郵件，透過同一條 SMTP 連線寄送；失敗時指數退避重試，超過上限標記為 dead"""
+    STALE_LOCK = timedelta(minutes=10)  # 標記 sending 後超過此時間仍未完成（行程中斷）則重新領取
+
+    def __init__(self):
+        self._smtp = _SmtpSession(app.config["MAIL_SMTP_IDLE_TIMEOUT"])
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _claim_batch(self, db):
+        now = datetime.utcnow()
+        rows = db.execute(
+            """SELECT id, to_email, subject, html_body, text_body, attempts, status FROM email_outbox
+               WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND locked_at <= ?)
+               ORDER BY id LIMIT ?""",
+            (_db_timestamp(now), _db_timestamp(now - self.STALE_LOCK), app.config["MAIL_QUEUE_BATCH_SIZE"]),
+        ).fetchall()
+        claimed = []
+        for row in rows:
+            # 以原狀態為條件更新，多個 worker 同時領取時只有一個成功
+            cur = db.execute(
+                "UPDATE email_outbox SET status = 'sending', locked_at = ? WHERE id = ? AND status = ?",
+                (_db_timestamp(now), row["id"], row["status"]),
+            )
+            if cur.rowcount == 1:
+                claimed.append(row)
+        db.commit()
+        return claimed
+
+    def _record_result(self, db, row, error):
+        attempts = row["attempts"] + 1
+        if error is None:
+            db.execute(
+                "UPDATE email_outbox SET status = 'sent', attempts = ?, sent_at = ?, locked_at = NULL, last_error = NULL WHERE id = ?",
+                (attempts, _db_timestamp(datetime.utcnow()), row["id"]),
+            )
+        elif attempts >= app.config["MAIL_MAX_ATTEMPTS"]:
+            db.execute(
+                "UPDATE email_outbox SET status = 'dead', attempts = ?, locked_at = NULL, last_error = ? WHERE id = ?",
+                (attempts, str(error)[:1000], row["id"]),
+            )
+        else:
+            delay = app.config["MAIL_RETRY_BASE_SECONDS"] * (2 ** (attempts - 1))
+            db.execute(
+                "UPDATE email_outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, locked_at = NULL, last_error = ? WHERE id = ?",
+                (attempts, _db_timestamp(datetime.utcnow() + timedelta(seconds=delay)), str(error)[:1000], row["id"]),
+            )
+        db.commit()
+
+    def _purge_sent(self, db):
+        cutoff = datetime.utcnow() - timedelta(days=app.config["MAIL_OUTBOX_RETENTION_DAYS"])
+        db.execute("DELETE FROM email_outbox WHERE status = 'sent' AND sent_at < ?", (_db_timestamp(cutoff),))
+        db.commit()
+
+    def drain(self):
+        """寄出目前所有到期的郵件，回傳 (成功數, 失敗數)"""
+        sent = failed = 0
+        with app.app_context():
+            db = get_db()
+            while True:
+                batch = self._claim_batch(db)
+                if not batch:
+                    break
+                for row in batch:
+                    error = None
+                    try:
+                        self._smtp.send(
+                            row["to_email"],
+                            _build_email_message(row["to_email"], row["subject"], row["html_body"], row["text_body"]),
+                        )
+                    except Exception as e:
+                        error = e
+                        print(f"發送郵件失敗（outbox #{row['id']}）: {e}")
+                    self._record_result(db, row, error)
+                    if error is None:
+                        sent += 1
+                    else:
+                        failed += 1
+            if sent:
+                self._purge_sent(db)
+        return sent, failed
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                print(f"[mail worker] {e}")
+            self._smtp.close_if_idle()
+            self._wake.wait(app.config["MAIL_QUEUE_POLL_INTERVAL"])
+            self._wake.clear()
+        self._smtp.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name="email-outbox-worker", daemon=True)
+        self._thread.start()
+        return self
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+_outbox_worker = None
+_outbox_worker_pid = None
+_outbox_worker_lock = threading.Lock()
+
+
+def ensure_outbox_worker():
+    """取得（必要時啟動）行程內的背景寄送執行緒；fork 後的子行程會重新啟動"""
+    global _outbox_worker, _outbox_worker_pid
+    pid = os.getpid()
+    if _outbox_worker is None or _outbox_worker_pid != pid:
+        with _outbox_worker_lock:
+            if _outbox_worker is None or _outbox_worker_pid != pid:
+                _outbox_worker = _EmailOutboxWorker().start()
+                _outbox_worker_pid = pid
+    return _outbox_worker
+
+
+@app.cli.group("mail")
+def mail_cli():
+    """郵件佇列管理"""
+
+
+@mail_cli.command("worker")
+def mail_worker_command():
+    """持續寄送 email_outbox 中的郵件（前景執行，Ctrl+C 結束）"""
+    import click
+    click.echo("郵件寄送 worker 已啟動")
+    worker = _EmailOutboxWorker()
+    try:
+        worker.run_forever()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+@mail_cli.command("drain")
+def mail_drain_command():
+    """寄出目前到期的郵件後結束（適合排程執行）"""
+    import click
+    sent, failed = _EmailOutboxWorker().drain()
+    click.echo(f"寄出 {sent} 封，失敗 {failed} 封")
+
+
+@mail_cli.command("status")
+def mail_status_command():
+    """顯示 email_outbox 各狀態筆數"""
+    import click
+    rows = get_db().execute("SELECT status, COUNT(*) AS n FROM email_outbox GROUP BY status ORDER BY status").fetchall()
+    for row in rows:
+        click.echo(f"{row['status']}: {row['n']}")
+
+
+@mail_cli.command("retry-dead")
+def mail_retry_dead_command():
+    """將 dead 狀態的郵件重新排入佇列"""
+    import click
+    db = get_db()
+    cur = db.execute(
+        "UPDATE email_outbox SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'dead'",
+        (_db_timestamp(datetime.utcnow()),),
+    )
+    db.commit()
+    click.echo(f"已重新排入 {cur.rowcount} 封")
+
+
+_email_templates = {}
+
+
+def render_email(name, **context):
+    """以 templates/emails/<name>.html 與 .txt 產生 (html_body, text_body)；模板只編譯一次後快取"""
+    templates = _email_templates.get(name)
+    if templates is None:
+        templates = (
+            app.jinja_env.get_template(f"emails/{name}.html"),
+            app.jinja_env.get_template(f"emails/{name}.txt"),
+        )
+        _email_templates[name] = templates
+    html_template, text_template = templates
+    return html_template.render(**context), text_template.render(**context)
+
+
+def send_verification_email(email, username, verification_token):
+    """發送驗證郵件"""
+    verification_url = url_for("verify_email", token=verification_token, _external=True)
+    html_body, text_body = render_email("verification", username=username, url=verification_url)
+    return send_email(email, "請驗證您的電子信箱 - Flask 登入系統", html_body, text_body)
+
+
+def send_password_reset_email(email, username, reset_token):
+    """發送重設密碼郵件"""
+    reset_url = url_for("reset_password", token=reset_token, _external=True)
+    html_body, text_body = render_email("password_reset", username=username, url=reset_url)
+    return send_email(email, "重設您的密碼 - Flask 登入系統", html_body, text_body)
+
+
+# ==================== 頻率限制 ====================
+
+def _sliding_window_decision(prev_count, curr_count, limit, window, now):
+    """滑動視窗計數：以「前一個固定視窗 × 剩餘比例 + 目前視窗」估算最近 window 秒內的次數
+
+    回傳 (是否允許, 需等待秒數)；允許時等待秒數為 0。
+    """
+    elapsed = (now % window) / window
+    if prev_count * (1 - elapsed) + curr_count + 1 <= limit:
+        return True, 0
+    if curr_count + 1 <= limit:
+        # 本視窗內等到前一視窗的權重降到足夠低即可
+        wait = ((1 - (limit - 1 - curr_count) / prev_count) - elapsed) * window
+    else:
+        # 須等到下一個視窗，且本視窗（屆時的前一視窗）權重降到足夠低
+        wait = (1 - elapsed) * window + max(0.0, 1 - (limit - 1) / curr_count) * window
+    return False, max(1, int(wait + 0.999))
+
+
+class _MemoryRateLimitBackend:
+    """行程內計數（多個 worker 行程時各自計算，實際上限為 worker 數 × limit）"""
+
+    def __init__(self, max_keys):
+        self._max_keys = max_keys
+        self._windows = OrderedDict()  # key -> [window_id, 目前視窗次數, 前一視窗次數]
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        window_id = int(now // window)
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is None:
+                entry = [window_id, 0, 0]
+                self._windows[key] = entry
+                while len(self._windows) > self._max_keys:
+                    self._windows.popitem(last=False)
+            else:
+                self._windows.move_to_end(key)
+            if entry[0] != window_id:
+                entry[2] = entry[1] if entry[0] == window_id - 1 else 0
+                entry[1] = 0
+                entry[0] = window_id
+            allowed, retry_after = _sliding_window_decision(entry[2], entry[1], limit, window, now)
+            if allowed:
+                entry[1] += 1
+            return allowed, retry_after
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+
+class _SqliteRateLimitBackend:
+    """以共用 SQLite 檔計數，同一台主機上的多個 worker 行程共享上限（Redis 等共用後端的替代品）"""
+
+    def __init__(self, path):
+        self._path = Path(path)
+        self._local = threading.local()
+        self._hits = 0
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS rate_limits (
+                       key TEXT NOT NULL,
+                       window_start INTEGER NOT NULL,
+                       count INTEGER NOT NULL,
+                       expires_at INTEGER NOT NULL,
+                       PRIMARY KEY (key, window_start)
+                   )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_expires ON rate_limits(expires_at)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def hit(self, key, limit, window, now):
+        conn = self._connect()
+        window_start = int(now // window) * window
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            counts = dict(conn.execute(
+                "SELECT window_start, count FROM rate_limits WHERE key = ? AND window_start IN (?, ?)",
+                (key, window_start, window_start - window),
+            ).fetchall())
+            allowed, retry_after = _sliding_window_decision(
+                counts.get(window_start - window, 0), counts.get(window_start, 0), limit, window, now
+            )
+            if allowed:
+                conn.execute(
+                    """INSERT INTO rate_limits (key, window_start, count, expires_at) VALUES (?, ?, 1, ?)
+                       ON CONFLICT (key, window_start) DO UPDATE SET count = count + 1""",
+                    (key, window_start, window_start + 2 * window),
+                )
+            self._hits += 1
+            if self._hits % 1000 == 0:
+                conn.execute("DELETE FROM rate_limits WHERE expires_at < ?", (int(now),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, retry_after
+
+    def clear(self):
+        self._connect().execute("DELETE FROM rate_limits")
+
+
+def _load_rate_limit_backend(spec):
+    """依設定建立後端：memory、sqlite，或 "模組:類別"（類別須提供 hit(key, limit, window, now) 與 clear()）"""
+    if spec == "memory":
+        return _MemoryRateLimitBackend(app.config["RATE_LIMIT_MEMORY_MAX_KEYS"])
+    if spec == "sqlite":
+        return _SqliteRateLimitBackend(app.config["RATE_LIMIT_SQLITE_PATH"])
+    import importlib
+    module_name, _, attr = spec.partition(":")
+    if not attr:
+        raise RuntimeError(f"未知的 RATE_LIMIT_BACKEND：{spec}（可用：memory、sqlite 或 模組:類別）")
+    return getattr(importlib.import_module(module_name), attr)()
+
+
+def _parse_rate_limit(value):
+    """「次數/秒數」轉為 (limit, window)；空字串表示停用"""
+    if not value:
+        return None
+    limit, _, window = value.partition("/")
+    limit, window = int(limit), int(window)
+    if limit < 1 or window < 1:
+        raise RuntimeError(f"頻率限制規則須為正整數「次數/秒數」：{value}")
+    return limit, window
+
+
+class RateLimiter:
+    """具名規則的頻率限制器，並統計各規則的允許／拒絕次數
+
+    後端發生錯誤時一律放行（fail open），避免計數儲存故障導致無法登入，並計入 errors。
+    """
+
+    def __init__(self, backend, rules):
+        self.backend = backend
+        self.rules = {name: rule for name, rule in rules.items() if rule}
+        self._stats = {name: {"allowed": 0, "blocked": 0, "errors": 0} for name in self.rules}
+        self._lock = threading.Lock()
+
+    def hit(self, rule_name, value):
+        """記錄一次嘗試，回傳需等待秒數（0 表示允許）"""
+        rule = self.rules.get(rule_name)
+        if rule is None or not value:
+            return 0
+        limit, window = rule
+        # 識別碼（信箱等）只以雜湊作為 key，共用後端不會存放明文
+        key = f"{rule_name}:{hashlib.sha256(value.encode()).hexdigest()[:32]}"
+        try:
+            allowed, retry_after = self.backend.hit(key, limit, window, time.time())
+        except Exception as e:
+            app.logger.warning("頻率限制後端錯誤（放行）：%s", e)
+            outcome, retry_after = "errors", 0
+        else:
+            outcome = "allowed" if allowed else "blocked"
+        with self._lock:
+            self._stats[rule_name][outcome] += 1
+        return retry_after
+
+    def check(self, *checks):
+        """依序檢查 (規則名稱, 值)，遇到第一個超限即停止並回傳需等待秒數，全部通過回傳 0"""
+        if not app.config["RATE_LIMIT_ENABLED"]:
+            return 0
+        for rule_name, value in checks:
+            retry_after = self.hit(rule_name, value)
+            if retry_after:
+                return retry_after
+        return 0
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._stats.items()}
+
+
+rate_limiter = RateLimiter(
+    _load_rate_limit_backend(app.config["RATE_LIMIT_BACKEND"]),
+    {
+        "login_ip": _parse_rate_limit(app.config["RATE_LIMIT_LOGIN_PER_IP"]),
+        "login_identifier": _parse_rate_limit(app.config["RATE_LIMIT_LOGIN_PER_IDENTIFIER"]),
+        "forgot_password_ip": _parse_rate_limit(app.config["RATE_LIMIT_FORGOT_PASSWORD_PER_IP"]),
+        "forgot_password_email": _parse_rate_limit(app.config["RATE_LIMIT_FORGOT_PASSWORD_PER_EMAIL"]),
+    },
+)
+
+
+def client_ip():
+    """用戶端 IP：信任 RATE_LIMIT_TRUSTED_PROXIES 層代理時取 X-Forwarded-For 對應位置"""
+    trusted = app.config["RATE_LIMIT_TRUSTED_PROXIES"]
+    if trusted > 0:
+        forwarded = [part.strip() for part in request.headers.get("X-Forwarded-For", "").split(",") if part.strip()]
+        if len(forwarded) >= trusted:
+            return forwarded[-trusted]
+    return request.remote_addr or ""
+
+
+def rate_limited_response(retry_after, template=None, **context):
+    """超過頻率限制的回應（429 + Retry-After）：API 回 JSON，頁面顯示提示並重新渲染表單"""
+    message = f"嘗試次數過多，請於 {retry_after} 秒後再試"
+    if template is None:
+        response = jsonify({"ok": False, "message": message, "retry_after": retry_after})
+    else:
+        flash(message, "error")
+        response = app.make_response(render_template(template, **context))
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+@app.route("/db-manage/rate-limits")
+@admin_required
+def db_manage_rate_limits():
+    """頻率限制統計（本行程各規則的允許／拒絕／後端錯誤次數）"""
+    return jsonify({
+        "ok": True,
+        "backend": app.config["RATE_LIMIT_BACKEND"],
+        "enabled": app.config["RATE_LIMIT_ENABLED"],
+        "rules": {name: {"limit": limit, "window": window} for name, (limit, window) in rate_limiter.rules.items()},
+        "stats": rate_limiter.stats(),
+    }), 200
+
+
+# ==================== 靜態資源 ====================
+#
+# static/ 內為原始檔：css/、js/ 為本站檔案，vendor/ 為 `flask assets vendor` 下載的第三方套件與字型。
+# `flask assets build` 將它們輸出到 static/dist/：檔名加上內容雜湊、另存 .gz（安裝 brotli 時另有 .br），
+# 並寫入 manifest.json。模板以 static_url() 取得網址；dist/ 下的檔案可永久快取。
+
+# 第三方資源（本站路徑 -> 來源網址）；尚未執行 `flask assets vendor` 時 static_url() 直接回傳來源網址
+VENDOR_ASSETS = {
+    "vendor/bootstrap/bootstrap.min.css": "https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css",
+    "vendor/bootstrap/bootstrap.bundle.min.js": "https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js",
+    "vendor/bootstrap-icons/bootstrap-icons.css": "https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.1/font/bootstrap-icons.css",
+    "vendor/toastr/toastr.min.css": "https://cdnjs.cloudflare.com/ajax/libs/toastr.js/2.1.4/toastr.min.css",
+    "vendor/toastr/toastr.min.js": "https://cdnjs.cloudflare.com/ajax/libs/toastr.js/2.1.4/toastr.min.js",
+    "vendor/jquery/jquery.min.js": "https://code.jquery.com/jquery-3.7.1.min.js",
+    "vendor/fonts/fonts.css": "https://fonts.googleapis.com/css2?family=Noto+Sans+TC:wght@300;400;500;700&family=Roboto:wght@300;400;500;700&display=swap",
+}
+STATIC_DIST_DIR = "dist"
+# 缺少 static/vendor/ 的檔案時讓頁面失敗而不是改用 CDN（離線或內網部署建議開啟）
+app.config["STATIC_REQUIRE_VENDOR"] = os.environ.get("STATIC_REQUIRE_VENDOR", "False").lower() == "true"
+_vendor_fallback_warned = set()
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# 已是壓縮格式的檔案（woff2、png 等）不另存壓縮版本
+_PRECOMPRESS_SUFFIXES = {".css", ".js", ".json", ".svg", ".txt", ".map", ".ttf", ".eot", ".otf", ".html"}
+_CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+_static_manifest = None
+_static_sources = {}
+
+
+def _load_static_manifest():
+    try:
+        return json.loads((Path(app.static_folder) / STATIC_DIST_DIR / "manifest.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def static_url(path):
+    """靜態資源網址：已 build 時回傳指紋檔名（debug 模式除外，方便直接修改原始檔）；
+    原始檔不存在的第三方資源退回來源 CDN 網址"""
+    global _static_manifest
+    if not app.debug:
+        if _static_manifest is None:
+            _static_manifest = _load_static_manifest()
+        hashed = _static_manifest.get(path)
+        if hashed:
+            return url_for("static", filename=f"{STATIC_DIST_DIR}/{hashed}")
+    exists = _static_sources.get(path)
+    if exists is None or app.debug:
+        exists = _static_sources[path] = (Path(app.static_folder) / path).is_file()
+    if not exists and path in VENDOR_ASSETS:
+        _vendor_fallback(path)
+        return VENDOR_ASSETS[path]
+    return url_for("static", filename=path)
+
+
+def _vendor_fallback(path):
+    """第三方資源尚未下載：STATIC_REQUIRE_VENDOR 時直接失敗，否則每個檔案記錄一次 warning 後改用 CDN"""
+    if app.config["STATIC_REQUIRE_VENDOR"]:
+        raise RuntimeError(f"缺少 static/{path}，請先執行 `flask assets vendor`（STATIC_REQUIRE_VENDOR 開啟時不使用 CDN）")
+    if path not in _vendor_fallback_warned:
+        _vendor_fallback_warned.add(path)
+        app.logger.warning("缺少 static/%s，頁面改用 CDN：%s（執行 `flask assets vendor` 後即不依賴外部網路）", path, VENDOR_ASSETS[path])
+
+
+app.add_template_global(static_url)
+
+
+def send_static_asset(filename):
+    """static 路由：dist/ 下的指紋檔設定一年且 immutable 的快取，並依 Accept-Encoding 送出預先壓縮的 .br / .gz"""
+    if not filename.startswith(STATIC_DIST_DIR + "/"):
+        return app.send_static_file(filename)
+    import mimetypes
+    from flask import send_from_directory
+    from werkzeug.security import safe_join
+    response = None
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        compressed = safe_join(app.static_folder, filename + suffix)
+        if request.accept_encodings[encoding] and compressed and os.path.isfile(compressed):
+            response = send_from_directory(
+                app.static_folder, filename + suffix,
+                mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+                max_age=STATIC_IMMUTABLE_MAX_AGE,
+            )
+            response.headers["Content-Encoding"] = encoding
+            response.headers.pop("Content-Disposition", None)
+            break
+    if response is None:
+        response = send_from_directory(app.static_folder, filename, max_age=STATIC_IMMUTABLE_MAX_AGE)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+app.view_functions["static"] = send_static_asset
+
+
+def _download_asset(url):
+    from urllib.request import Request, urlopen
+    # Google Fonts 依 User-Agent 決定字型格式，以現代瀏覽器的 UA 取得 woff2
+    request_ = Request(url, headers={
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+    })
+    with urlopen(request_, timeout=30) as response:
+        return response.read()
+
+
+def _vendor_css_resources(css, source_url, target, echo):
+    """下載 CSS 內 url() 引用的檔案（字型等）存到 CSS 旁，並改寫為相對路徑"""
+    import posixpath
+    from urllib.parse import urljoin
+    downloaded = {}
+
+    def replace(match):
+        ref = match.group(2).strip()
+        if ref.startswith(("data:", "#")):
+            return match.group(0)
+        absolute = urljoin(source_url, ref)
+        if ref.startswith(("http:", "https:", "//")):
+            local = "files/" + posixpath.basename(urlparse(absolute).path)
+        else:
+            local = posixpath.normpath(ref.split("?", 1)[0].split("#", 1)[0])
+            if local.startswith(".."):
+                local = "files/" + posixpath.basename(local)
+        if local not in downloaded:
+            path = target.parent / local
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(_download_asset(absolute))
+            downloaded[local] = True
+        return f'url("{local}")'
+
+    css = _CSS_URL_RE.sub(replace, css)
+    if downloaded:
+        echo(f"    另下載 {len(downloaded)} 個引用檔")
+    return css
+
+
+def vendor_static_assets(echo=print):
+    """下載 VENDOR_ASSETS 到 static/vendor/（CSS 引用的字型一併下載），之後頁面不再依賴外部 CDN"""
+    static_dir = Path(app.static_folder)
+    for path, url in VENDOR_ASSETS.items():
+        echo(f"下載 {url}")
+        target = static_dir / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        data = _download_asset(url)
+        if target.suffix == ".css":
+            data = _vendor_css_resources(data.decode("utf-8"), url, target, echo).encode("utf-8")
+        target.write_bytes(data)
+    _static_sources.clear()
+
+
+def _precompress(path, data):
+    """寫出 .gz（以及安裝 brotli 時的 .br），壓縮後沒有變小則略過"""
+    import gzip
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+        path.with_name(path.name + ".gz").write_bytes(gz)
+    try:
+        import brotli
+    except ImportError:
+        return
+    br = brotli.compress(data, quality=11)
+    if len(br) < len(data):
+        path.with_name(path.name + ".br").write_bytes(br)
 
 
-def admin_required(f):
-    """管理者驗證裝飾器（須為登入且 role 為管理者）"""
-    @wraps(f)
-    @login_required
-    def decorated_function(*args, **kwargs):
-        db = get_db()
-        row = db.execute("SELECT role FROM users WHERE id = ?", (session["user_id"],)).fetchone()
-        if not row or row["role"] != "管理者":
-            flash("僅管理者可存取此功能", "error")
-            return redirect(url_for("home"))
-        return f(*args, **kwargs)
-    return decorated_function
+def build_static_assets(public_dir=None):
+    """輸出 static/dist/（指紋檔名 + 預先壓縮 + manifest.json），回傳 manifest；
+    public_dir 指定時另複製到 <public_dir>/static/dist/（Vercel 由 public/ 直接提供靜態檔）"""
+    import posixpath
+    import shutil
+    global _static_manifest
+    static_dir = Path(app.static_folder)
+    dist_dir = static_dir / STATIC_DIST_DIR
+    shutil.rmtree(dist_dir, ignore_errors=True)
+    sources = [
+        p for p in static_dir.rglob("*")
+        if p.is_file() and dist_dir not in p.parents and not p.name.startswith(".")
+    ]
+    manifest = {}
 
+    def rewrite_css(css, css_rel):
+        base = posixpath.dirname(css_rel)
 
-def email_verified_required(f):
-    """信箱驗證裝飾器"""
-    @wraps(f)
-    @login_required
-    def decorated_function(*args, **kwargs):
-        db = get_db()
-        user = db.execute(
-            "SELECT email_verified FROM users WHERE id = ?", (session["user_id"],)
-        ).fetchone()
-        if not user or not user["email_verified"]:
-            flash("請先驗證您的電子信箱", "warning")
-            return redirect(url_for("verify_email"))
-        return f(*args, **kwargs)
-    return decorated_function
+        def replace(match):
+            ref = match.group(2).strip()
+            if ref.startswith(("data:", "#", "http:", "https:", "//", "/")):
+                return match.group(0)
+            path, sep, fragment = ref.partition("#")
+            target = posixpath.normpath(posixpath.join(base, path.split("?", 1)[0]))
+            if target not in manifest:
+                return match.group(0)
+            return f'url("{posixpath.relpath(manifest[target], base)}{sep}{fragment}")'
+        return _CSS_URL_RE.sub(replace, css)
 
+    # 先處理字型等非 CSS 檔，CSS 內的 url() 才能改寫為指紋檔名
+    for source in sorted(sources, key=lambda p: (p.suffix == ".css", str(p))):
+        rel = source.relative_to(static_dir).as_posix()
+        data = source.read_bytes()
+        if source.suffix == ".css":
+            data = rewrite_css(data.decode("utf-8"), rel).encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        hashed = posixpath.join(posixpath.dirname(rel), f"{source.stem}.{digest}{source.suffix}")
+        manifest[rel] = hashed
+        output = dist_dir / hashed
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_bytes(data)
+        if source.suffix in _PRECOMPRESS_SUFFIXES:
+            _precompress(output, data)
+    (dist_dir / "manifest.json").write_text(json.dumps(manifest, indent=2, sort_keys=True), encoding="utf-8")
+    if public_dir:
+        public_dist = Path(public_dir) / "static" / STATIC_DIST_DIR
+        shutil.rmtree(public_dist, ignore_errors=True)
+        shutil.copytree(dist_dir, public_dist)
+    _static_manifest = manifest
+    return manifest
 
-def send_email(to_email, subject, html_body, text_body=None):
-    """發送電子郵件"""
-    # 如果沒有設定郵件帳號，則不發送（開發環境）
-    if not app.config["MAIL_USERNAME"] or not app.config["MAIL_PASSWORD"]:
-        print(f"[開發模式] 郵件不會實際發送")
-        print(f"收件人: {to_email}")
-        print(f"主旨: {subject}")
-        print(f"內容: {text_body or html_body}")
-        return True
-    
-    try:
-        # 建立郵件
-        msg = MIMEMultipart("alternative")
-        msg["Subject"] = subject
-        msg["From"] = app.config["MAIL_FROM"]
-        msg["To"] = to_email
-        
-        # 添加文字和 HTML 內容
-        if text_body:
-            part1 = MIMEText(text_body, "plain", "utf-8")
-            msg.attach(part1)
-        
-        part2 = MIMEText(html_body, "html", "utf-8")
-        msg.attach(part2)
-        
-        # 發送郵件
-        with smtplib.SMTP(app.config["MAIL_SERVER"], app.config["MAIL_PORT"]) as server:
-            if app.config["MAIL_USE_TLS"]:
-                server.starttls()
-            server.login(app.config["MAIL_USERNAME"], app.config["MAIL_PASSWORD"])
-            server.send_message(msg)
-        
-        return True
-    except Exception as e:
-        print(f"發送郵件失敗: {e}")
-        return False
 
+@app.cli.group("assets")
+def assets_cli():
+    """靜態資源（下載第三方套件、指紋檔名、預先壓縮）"""
 
-def send_verification_email(email, username, verification_token):
-    """發送驗證郵件"""
-    verification_url = url_for("verify_email", token=verification_token, _external=True)
-    
-    subject = "請驗證您的電子信箱 - Flask 登入系統"
-    
-    html_body = f"""
-    <html>
-    <body style="font-family: 'Noto Sans TC', Arial, sans-serif; line-height: 1.6; color: #333;">
-        <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
-            <h2 style="color: #007bff;">歡迎加入 Flask 登入系統！</h2>
-            <p>親愛的 {username}，</p>
-            <p>感謝您註冊我們的服務。請點擊下方的按鈕來驗證您的電子信箱：</p>
-            <div style="text-align: center; margin: 30px 0;">
-                <a href="{verification_url}" style="background-color: #007bff; color: white; padding: 12px 30px; text-decoration: none; border-radius: 5px; display: inline-block;">驗證電子信箱</a>
-            </div>
-            <p>或者複製以下連結到瀏覽器：</p>
-            <p style="word-break: break-all; color: #666;">{verification_url}</p>
-            <p style="color: #999; font-size: 12px; margin-top: 30px;">此連結將在 24 小時後過期。</p>
-            <p style="color: #999; font-size: 12px;">如果您沒有註冊此帳號，請忽略此郵件。</p>
-        </div>
-    </body>
-    </html>
-    """
-    
-    text_body = f"""
-    歡迎加入 Flask 登入系統！
-    
-    親愛的 {username}，
-    
-    感謝您註冊我們的服務。請點擊以下連結來驗證您的電子信箱：
-    
-    {verification_url}
-    
-    此連結將在 24 小時後過期。
-    
-    如果您沒有註冊此帳號，請忽略此郵件。
-    """
-    
-    return send_email(email, subject, html_body, text_body)
 
+@assets_cli.command("vendor")
+def assets_vendor_command():
+    """下載 Bootstrap、bootstrap-icons、toastr、jQuery 與字型到 static/vendor/"""
+    try:
+        vendor_static_assets(echo=click.echo)
+    except OSError as e:
+        raise click.ClickException(f"下載第三方資源失敗：{e}")
+    click.echo("完成；請執行 `flask assets build --require-vendor`，頁面即改用 static/vendor/ 的檔案")
 
-def send_password_reset_email(email, username, reset_token):
-    """發送重設密碼郵件"""
-    reset_url = url_for("reset_password", token=reset_token, _external=True)
-    
-    subject = "重設您的密碼 - Flask 登入系統"
-    
-    html_body = f"""
-    <html>
-    <body style="font-family: 'Noto Sans TC', Arial, sans-serif; line-height: 1.6; color: #333;">
-        <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
-            <h2 style="color: #dc3545;">重設密碼請求</h2>
-            <p>親愛的 {username}，</p>
-            <p>我們收到了您重設密碼的請求。請點擊下方的按鈕來重設您的密碼：</p>
-            <div style="text-align: center; margin: 30px 0;">
-                <a href="{reset_url}" style="background-color: #dc3545; color: white; padding: 12px 30px; text-decoration: none; border-radius: 5px; display: inline-block;">重設密碼</a>
-            </div>
-            <p>或者複製以下連結到瀏覽器：</p>
-            <p style="word-break: break-all; color: #666;">{reset_url}</p>
-            <p style="color: #999; font-size: 12px; margin-top: 30px;">此連結將在 1 小時後過期。</p>
-            <p style="color: #999; font-size: 12px;">如果您沒有請求重設密碼，請忽略此郵件。您的密碼將不會被更改。</p>
-        </div>
-    </body>
-    </html>
-    """
-    
-    text_body = f"""
-    重設密碼請求
-    
-    親愛的 {username}，
-    
-    我們收到了您重設密碼的請求。請點擊以下連結來重設您的密碼：
-    
-    {reset_url}
-    
-    此連結將在 1 小時後過期。
-    
-    如果您沒有請求重設密碼，請忽略此郵件。您的密碼將不會被更改。
-    """
-    
-    return send_email(email, subject, html_body, text_body)
+
+@assets_cli.command("build")
+@click.option("--public", "public_dir", default=None, help="另複製到 <目錄>/static/dist/（Vercel 部署時用 public）")
+@click.option("--require-vendor", is_flag=True, help="缺少 static/vendor/ 的第三方資源時失敗（部署用，避免頁面退回 CDN）")
+def assets_build_command(public_dir, require_vendor):
+    """輸出 static/dist/：指紋檔名、.gz／.br 與 manifest.json"""
+    missing = [path for path in VENDOR_ASSETS if not (Path(app.static_folder) / path).is_file()]
+    if missing and require_vendor:
+        raise click.ClickException(f"尚未下載的第三方資源：{', '.join(missing)}；請先執行 `flask assets vendor`")
+    manifest = build_static_assets(public_dir)
+    click.echo(f"已輸出 {len(manifest)} 個檔案到 static/{STATIC_DIST_DIR}/")
+    if missing:
+        click.echo(f"尚未下載的第三方資源（頁面將使用 CDN）：{', '.join(missing)}；可執行 `flask assets vendor`")
 
 
 # ==================== 路由 ====================
@@ -439,11 +3156,44 @@ def index():
     return render_template("login.html")
 
 
+page_cache = LruTtlCache(app.config["PAGE_CACHE_SIZE"], app.config["PAGE_CACHE_TTL"])
+page_cache_events = _Counter("app_page_cache_events_total", "頁面快取略過（有 flash 訊息）與 304 回應次數", ("event",))
+
+
+def render_cached_page(template, **context):
+    """渲染只取決於模板參數與 session 內 username／role 的頁面，結果依使用者資料版本快取；
+    有待顯示的 flash 訊息（或 debug 模式）時照常渲染。回應帶 ETag／Last-Modified，瀏覽器重新驗證時回傳 304"""
+    if "_flashes" in session or app.debug:
+        page_cache_events.inc(("bypass",))
+        return render_template(template, **context)
+    user_id = session.get("user_id")
+    key = (
+        template, tuple(sorted(context.items())),
+        user_id, session.get("username"), session.get("role"), user_version(user_id),
+    )
+    entry = page_cache.get(key)
+    if entry is None:
+        body = render_template(template, **context)
+        etag = hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+        entry = (body, etag, datetime.now(timezone.utc).replace(microsecond=0))
+        page_cache.set(key, entry)
+    response = Response(entry[0], mimetype="text/html")
+    response.set_etag(entry[1])
+    response.last_modified = entry[2]
+    # 內容因人而異：只允許瀏覽器快取，且每次使用前須重新驗證（登出或角色變更後不會看到舊頁面）
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        page_cache_events.inc(("not_modified",))
+    return response
+
+
 @app.route("/home")
 @login_required
 def home():
     """登入後的主畫面（4x5 按鈕）"""
-    return render_template("index.html")
+    return render_cached_page("index.html")
 
 
 @app.route("/option/<int:num>")
@@ -453,7 +3203,7 @@ def option_page(num):
     if num < 1 or num > 20:
         flash("無此選項", "error")
         return redirect(url_for("home"))
-    return render_template("option.html", option_num=num)
+    return render_cached_page("option.html", option_num=num)
 
 
 # ==================== 資料庫管理（僅管理者） ====================
@@ -467,6 +3217,129 @@ def _user_columns():
     ]
 
 
+# 可排序欄位（keyset 以 (欄位, id) 為游標）
+USER_LIST_SORTS = ["id", "username", "created_at"]
+USER_LIST_COLUMNS = "id, username, email, email_verified, birthday, phone, address, work_region, role, created_at"
+
+
+def _encode_cursor(value, row_id):
+    return base64.urlsafe_b64encode(json.dumps([value, row_id], default=str).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor):
+    """解析分頁游標，格式錯誤時回傳 None（視為第一頁）"""
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return value, int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def _user_list_params(args):
+    """從 query string 取出篩選、排序、分頁參數"""
+    sort = args.get("sort", "id")
+    desc = sort.startswith("-")
+    sort = sort.lstrip("-")
+    if sort not in USER_LIST_SORTS:
+        sort, desc = "id", False
+    per_page = args.get("per_page", type=int) or app.config["DB_MANAGE_PAGE_SIZE"]
+    email_verified = args.get("email_verified", "")
+    return {
+        "q": args.get("q", "").strip(),
+        "work_region": args.get("work_region", "").strip(),
+        "role": args.get("role", "").strip(),
+        "email_verified": email_verified if email_verified in ("0", "1") else "",
+        "sort": sort,
+        "desc": desc,
+        "per_page": max(1, min(per_page, app.config["DB_MANAGE_MAX_PAGE_SIZE"])),
+        "cursor": args.get("cursor", ""),
+    }
+
+
+def _prefix_condition(column, prefix, params):
+    """前綴比對：SQLite 用範圍條件（BINARY collation 可走索引），Postgres 用 LIKE（text_pattern_ops 索引）"""
+    if USE_POSTGRES:
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        params.append(escaped + "%")
+        return f"{column} LIKE ?"
+    params.extend([prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)])
+    return f"({column} >= ? AND {column} < ?)"
+
+
+def _user_page_sql(params_in):
+    """依篩選條件產生 keyset 分頁查詢（多取一筆判斷是否還有下一頁）"""
+    where, params = [], []
+    if params_in["q"]:
+        cond_username = _prefix_condition("username", params_in["q"], params)
+        cond_email = _prefix_condition("lower(email)", params_in["q"].lower(), params)
+        where.append(f"({cond_username} OR {cond_email})")
+    if params_in["work_region"]:
+        where.append("work_region = ?")
+        params.append(params_in["work_region"])
+    if params_in["role"]:
+        where.append("role = ?")
+        params.append(params_in["role"])
+    if params_in["email_verified"]:
+        where.append("email_verified = ?")
+        params.append(int(params_in["email_verified"]))
+    sort, op, direction = params_in["sort"], "<" if params_in["desc"] else ">", "DESC" if params_in["desc"] else "ASC"
+    cursor = _decode_cursor(params_in["cursor"]) if params_in["cursor"] else None
+    if cursor:
+        if sort == "id":
+            where.append(f"id {op} ?")
+            params.append(cursor[1])
+        else:
+            where.append(f"({sort}, id) {op} (?, ?)")
+            params.extend(cursor)
+    order = f"id {direction}" if sort == "id" else f"{sort} {direction}, id {direction}"
+    sql = f"SELECT {USER_LIST_COLUMNS} FROM users"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order} LIMIT ?"
+    params.append(params_in["per_page"] + 1)
+    return sql, params
+
+
+def query_user_page(db, params_in):
+    """取得一頁 users，回傳 (rows, next_cursor)"""
+    sql, params = _user_page_sql(params_in)
+    rows = db.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > params_in["per_page"]:
+        rows = rows[: params_in["per_page"]]
+        last = rows[-1]
+        next_cursor = _encode_cursor(last[params_in["sort"]], last["id"])
+    return rows, next_cursor
+
+
+def _user_json(row):
+    return {
+        "id": row["id"],
+        "username": row["username"],
+        "email": row["email"],
+        "email_verified": bool(row["email_verified"]),
+        "birthday": str(row["birthday"]) if row["birthday"] else None,
+        "phone": row["phone"],
+        "address": row["address"],
+        "work_region": row["work_region"],
+        "role": row["role"] or DEFAULT_ROLE,
+        "created_at": str(row["created_at"]) if row["created_at"] else None,
+    }
+
+
+def _hot_user_page_query(name, args):
+    from werkzeug.datastructures import MultiDict
+    sql, params = _user_page_sql(_user_list_params(MultiDict(args)))
+    return name, sql, tuple(params)
+
+
+HOT_QUERIES.extend([
+    _hot_user_page_query("db_manage_page", {"cursor": _encode_cursor(1, 1)}),
+    _hot_user_page_query("db_manage_role_filter", {"role": DEFAULT_ROLE, "cursor": _encode_cursor(1, 1)}),
+    _hot_user_page_query("db_manage_prefix_search", {"q": "ab"}),
+])
+
+
 @app.route("/db-manage", methods=["GET", "POST"])
 @admin_required
 def db_manage():
@@ -492,30 +3365,47 @@ def db_manage():
                     db.commit()
                     flash("已新增使用者", "success")
                 except DBIntegrityError:
+                    db.rollback()
                     flash("使用者名稱或電子信箱已存在", "error")
         elif action == "delete":
             uid = request.form.get("user_id", type=int)
             if uid and uid != session.get("user_id"):
                 db.execute("DELETE FROM users WHERE id = ?", (uid,))
                 db.commit()
+                invalidate_user_auth(uid)
+                invalidate_user_sessions(uid)
                 flash("已刪除該筆資料", "success")
             elif uid == session.get("user_id"):
                 flash("無法刪除目前登入者", "error")
             else:
                 flash("無效的刪除請求", "error")
         return redirect(url_for("db_manage"))
-    users = db.execute(
-        """SELECT id, username, email, email_verified, birthday, phone, address, work_region, role, created_at
-           FROM users ORDER BY id"""
-    ).fetchall()
+    params = _user_list_params(request.args)
+    users, next_cursor = query_user_page(db, params)
     return render_template(
         "db_manage.html",
         users=users,
+        params=params,
+        next_cursor=next_cursor,
+        job_id=request.args.get("job", type=int),
         work_region_choices=WORK_REGION_CHOICES,
         role_choices=ROLE_CHOICES,
     )
 
 
+@app.route("/db-manage/users")
+@admin_required
+def db_manage_users_api():
+    """資料庫管理頁的 JSON 分頁列表（參數同 /db-manage：q、work_region、role、email_verified、sort、per_page、cursor）"""
+    params = _user_list_params(request.args)
+    users, next_cursor = query_user_page(get_db(), params)
+    return jsonify({
+        "ok": True,
+        "users": [_user_json(u) for u in users],
+        "next_cursor": next_cursor,
+    }), 200
+
+
 @app.route("/db-manage/edit/<int:user_id>", methods=["GET", "POST"])
 @admin_required
 def db_manage_edit(user_id):
@@ -555,9 +3445,13 @@ def db_manage_edit(user_id):
                     (username, email, birthday, phone, address, work_region, role, user_id),
                 )
             db.commit()
+            invalidate_user_auth(user_id)
+            if password or username != user["username"] or role != (user["role"] or DEFAULT_ROLE):
+                invalidate_user_sessions(user_id)
             flash("已更新資料", "success")
             return redirect(url_for("db_manage"))
         except DBIntegrityError:
+            db.rollback()
             flash("使用者名稱或電子信箱已被其他帳號使用", "error")
     return render_template(
         "db_manage_edit.html",
@@ -567,46 +3461,366 @@ def db_manage_edit(user_id):
     )
 
 
+EXPORT_COLUMNS = "id, username, email, email_verified, birthday, phone, address, work_region, role, created_at, updated_at"
+
+
+def iter_export_rows(db, batch_size=None):
+    """以 keyset（id > 上一批最後一筆）分批讀取 users，逐筆產生匯出欄位（順序同 _user_columns()）"""
+    batch_size = batch_size or app.config["EXPORT_BATCH_SIZE"]
+    last_id = 0
+    while True:
+        rows = db.execute(
+            f"SELECT {EXPORT_COLUMNS} FROM users WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        ).fetchall()
+        for r in rows:
+            yield [
+                r["id"], r["username"], r["email"], "", r["email_verified"],
+                r["birthday"] or "", r["phone"] or "", r["address"] or "", r["work_region"] or "", r["role"] or "",
+                r["created_at"] or "", r["updated_at"] or "",
+            ]
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1]["id"]
+
+
+def _export_filename(ext):
+    return f"users_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}"
+
+
+def _stream_csv(rows):
+    """CSV 串流：每批資料寫成一個 chunk（開頭加 BOM 讓 Excel 正確辨識 UTF-8）"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write("\ufeff")
+    writer.writerow(_user_columns())
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % 500 == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+
+def _stream_ndjson(rows):
+    """NDJSON 串流：每列一個 JSON 物件"""
+    cols = _user_columns()
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(dict(zip(cols, row)), ensure_ascii=False, default=str))
+        if len(chunk) >= 500:
+            yield ("\n".join(chunk) + "\n").encode("utf-8")
+            chunk = []
+    if chunk:
+        yield ("\n".join(chunk) + "\n").encode("utf-8")
+
+
+def write_users_xlsx(db, fileobj, on_progress=None):
+    """以 openpyxl write_only 模式逐列寫入（不在記憶體中保留整張工作表）；on_progress(已寫入筆數) 每批呼叫一次"""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("users")
+    ws.append(_user_columns())
+    batch_size = app.config["EXPORT_BATCH_SIZE"]
+    count = 0
+    for row in iter_export_rows(db, batch_size):
+        ws.append(row)
+        count += 1
+        if on_progress and count % batch_size == 0:
+            on_progress(count)
+    wb.save(fileobj)
+    if on_progress:
+        on_progress(count)
+    return count
+
+
 @app.route("/db-manage/export")
 @admin_required
+@allow_query_repeats
 def db_manage_export():
-    """匯出 users 表為 Excel"""
+    """匯出 users 表（?format=xlsx 預設 / csv / ndjson）；資料分批讀取，記憶體用量固定"""
+    fmt = request.args.get("format", "xlsx").lower()
+    db = get_db()
+    if fmt == "csv":
+        return Response(
+            stream_with_context(_stream_csv(iter_export_rows(db))),
+            mimetype="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f"attachment; filename={_export_filename('csv')}"},
+        )
+    if fmt == "ndjson":
+        return Response(
+            stream_with_context(_stream_ndjson(iter_export_rows(db))),
+            mimetype="application/x-ndjson",
+            headers={"Content-Disposition": f"attachment; filename={_export_filename('ndjson')}"},
+        )
     try:
-        from openpyxl import Workbook
+        import openpyxl  # noqa: F401
     except ImportError:
         flash("請安裝 openpyxl：pip install openpyxl", "error")
         return redirect(url_for("db_manage"))
-    db = get_db()
-    rows = db.execute(
-        """SELECT id, username, email, email_verified, birthday, phone, address, work_region, role, created_at, updated_at
-           FROM users ORDER BY id"""
-    ).fetchall()
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "users"
-    headers = _user_columns()
-    ws.append(headers)
-    for r in rows:
-        ws.append([
-            r["id"], r["username"], r["email"], "", r["email_verified"],
-            r["birthday"] or "", r["phone"] or "", r["address"] or "", r["work_region"] or "", r["role"] or "",
-            r["created_at"] or "", r["updated_at"] or "",
-        ])
-    buf = io.BytesIO()
-    wb.save(buf)
-    buf.seek(0)
+    if app.config["JOBS_MODE"] != "off":
+        job_id = create_job(db, "export")
+        return _job_created_response(job_id, "已建立匯出工作，完成後可下載")
+    tmp = tempfile.TemporaryFile()
+    write_users_xlsx(db, tmp)
+    tmp.seek(0)
     return send_file(
-        buf,
+        tmp,
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         as_attachment=True,
-        download_name=f"users_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+        download_name=_export_filename("xlsx"),
     )
 
 
+# 多列 INSERT 每句最多列數（10 欄 × 90 列，低於舊版 SQLite 999 個參數上限）
+IMPORT_ROWS_PER_STATEMENT = 90
+IMPORT_FIELDS = ["username", "email", "password_hash", "email_verified", "birthday", "phone", "address", "work_region", "role"]
+IMPORT_MAX_LENGTHS = {"username": 255, "email": 255, "phone": 50, "work_region": 50, "role": 50}  # 同 Postgres users 欄位長度
+
+
+def _cell_str(val):
+    if val is None:
+        return None
+    if hasattr(val, "strftime"):
+        return val.strftime("%Y-%m-%d")
+    s = str(val).strip()
+    return s if s else None
+
+
+def _parse_import_row(row):
+    """將 Excel 一列轉為匯入資料；回傳 (資料 dict, 錯誤訊息)，空白列回傳 (None, None)"""
+    cols = _user_columns()
+    if not row or not any(v not in (None, "") for v in row):
+        return None, None
+    if len(row) < 3:
+        return None, "欄位不足"
+    row = list(row)[: len(cols)]
+    while len(row) < len(cols):
+        row.append(None)
+    try:
+        uid = int(row[0]) if row[0] is not None else None
+    except (TypeError, ValueError):
+        uid = None
+    if uid is not None and not -2**31 <= uid < 2**31:
+        return None, f"id {uid} 超出範圍"
+    username = _cell_str(row[1]) or ""
+    email = (_cell_str(row[2]) or "").lower()
+    if not username or not email:
+        return None, "缺少使用者名稱或電子信箱"
+    birthday = _cell_str(row[5])
+    if birthday:
+        try:
+            birthday = date.fromisoformat(birthday.replace("/", "-")).isoformat()
+        except ValueError:
+            return None, f"生日格式錯誤：{birthday}（請使用 YYYY-MM-DD）"
+    rec = {
+        "id": uid,
+        "username": username,
+        "email": email,
+        "password": _cell_str(row[3]) or "",
+        "email_verified": 1 if row[4] in (1, "1", True, "True") else 0,
+        "birthday": birthday,
+        "phone": _cell_str(row[6]),
+        "address": _cell_str(row[7]),
+        "work_region": _cell_str(row[8]),
+        "role": _cell_str(row[9]) or DEFAULT_ROLE,
+    }
+    for field, limit in IMPORT_MAX_LENGTHS.items():
+        if rec[field] and len(rec[field]) > limit:
+            return None, f"{field} 超過 {limit} 個字元"
+    return rec, None
+
+
+def _select_in(db, sql_prefix, values):
+    """SELECT ... WHERE col IN (...)；values 為空時不查詢"""
+    values = list(values)
+    if not values:
+        return []
+    return db.execute(f"{sql_prefix} IN ({', '.join('?' * len(values))})", values).fetchall()
+
+
+def _multi_row_insert(db, sql_head, columns, records, sql_tail=""):
+    """以多列 VALUES 分句寫入 records（每句最多 IMPORT_ROWS_PER_STATEMENT 列）"""
+    placeholder = "(" + ", ".join("?" * len(columns)) + ")"
+    for i in range(0, len(records), IMPORT_ROWS_PER_STATEMENT):
+        part = records[i:i + IMPORT_ROWS_PER_STATEMENT]
+        params = [rec[c] for rec in part for c in columns]
+        db.execute(f"{sql_head} ({', '.join(columns)}) VALUES {', '.join([placeholder] * len(part))}{sql_tail}", params)
+
+
+def _upsert_sql(with_password):
+    """依 id 更新既有使用者（INSERT ... ON CONFLICT (id) DO UPDATE，SQLite / Postgres 皆支援）"""
+    fields = [f for f in IMPORT_FIELDS if with_password or f != "password_hash"]
+    updates = ", ".join(f"{f} = excluded.{f}" for f in fields)
+    return f" ON CONFLICT (id) DO UPDATE SET {updates}, updated_at = CURRENT_TIMESTAMP"
+
+
+def _begin_transaction(db):
+    """SQLite 需先明確 BEGIN，SAVEPOINT 的 RELEASE 才不會直接 commit"""
+    if not USE_POSTGRES and not db.in_transaction:
+        db.execute("BEGIN")
+
+
+def _hash_import_passwords(recs, result, row_numbers):
+    """以匯入專用的執行緒池平行雜湊各列密碼（寫入 rec["password_hash"]），回傳成功列的 id(rec) 集合；
+    排隊逾時（PasswordHashBusyError）或計算失敗的列記為錯誤列，不寫入"""
+    hasher = PASSWORD_HASHERS[app.config["PASSWORD_HASHER"]]
+    pending, done = [], set()
+    for rec in recs:
+        try:
+            pending.append((rec, _import_kdf_pool.submit(hasher.hash, rec["password"])))
+        except PasswordHashBusyError:
+            result["errors"].append((row_numbers[id(rec)], "密碼雜湊忙碌逾時，此列未寫入"))
+    for rec, future in pending:
+        try:
+            rec["password_hash"] = future.result()
+            done.add(id(rec))
+        except Exception as e:
+            result["errors"].append((row_numbers[id(rec)], f"密碼雜湊失敗：{e}"))
+    return done
+
+
+def _apply_import_chunk(db, chunk, result):
+    """驗證並寫入一批資料：以 3 次 IN 查詢預先取得既有 id / username / email，再以多列語句寫入。
+    回傳 username、role 或密碼有變更的既有使用者 id（其 session 須失效）"""
+    existing_ids = {
+        r["id"]: r for r in _select_in(db, "SELECT id, username, role FROM users WHERE id", {rec["id"] for _, rec in chunk if rec["id"]})
+    }
+    owner_by_username = {r["username"]: r["id"] for r in _select_in(db, "SELECT id, username FROM users WHERE username", {rec["username"] for _, rec in chunk})}
+    owner_by_email = {r["email"]: r["id"] for r in _select_in(db, "SELECT id, email FROM users WHERE email", {rec["email"] for _, rec in chunk})}
+
+    updates_pw, updates, inserts = [], [], []
+    seen_ids = set()
+    for row_no, rec in chunk:
+        is_update = rec["id"] in existing_ids
+        if is_update:
+            # 同一個多列 ON CONFLICT DO UPDATE 不可更新同一列兩次（Postgres 會整句失敗），後出現的列記為錯誤
+            if rec["id"] in seen_ids:
+                result["errors"].append((row_no, f"id {rec['id']} 在檔案中重複，此列未寫入"))
+                continue
+            seen_ids.add(rec["id"])
+        owner = rec["id"] if is_update else None
+        if owner_by_username.get(rec["username"], owner) != owner:
+            result["errors"].append((row_no, f"使用者名稱 {rec['username']} 已被其他帳號使用"))
+            continue
+        if owner_by_email.get(rec["email"], owner) != owner:
+            result["errors"].append((row_no, f"電子信箱 {rec['email']} 已被其他帳號使用"))
+            continue
+        # 同一批內後續列也不可重複使用
+        owner_by_username[rec["username"]] = owner if is_update else -row_no
+        owner_by_email[rec["email"]] = owner if is_update else -row_no
+        if rec["password"]:
+            rec["password_hash"] = None  # 驗證完整批後再以 _import_kdf_pool 平行計算
+        elif not is_update:
+            # 新增且未提供密碼：存入隨機值（無任何密碼能雜湊成此值），使用者需以忘記密碼設定
+            rec["password_hash"] = secrets.token_hex(32)
+        else:
+            rec["password_hash"] = ""  # ON CONFLICT 更新時不會寫入此欄
+        (updates_pw if is_update and rec["password"] else updates if is_update else inserts).append((row_no, rec))
+
+    hashed = _hash_import_passwords([rec for _, rec in updates_pw + inserts if rec["password"]], result, {
+        id(rec): row_no for row_no, rec in updates_pw + inserts
+    })
+    updates_pw = [(row_no, rec) for row_no, rec in updates_pw if id(rec) in hashed]
+    inserts = [(row_no, rec) for row_no, rec in inserts if not rec["password"] or id(rec) in hashed]
+
+    def write(batch_updates_pw, batch_updates, batch_inserts):
+        if batch_updates_pw:
+            _multi_row_insert(db, "INSERT INTO users", ["id"] + IMPORT_FIELDS, [r for _, r in batch_updates_pw], _upsert_sql(True))
+        if batch_updates:
+            _multi_row_insert(db, "INSERT INTO users", ["id"] + IMPORT_FIELDS, [r for _, r in batch_updates], _upsert_sql(False))
+        if batch_inserts:
+            _multi_row_insert(db, "INSERT INTO users", IMPORT_FIELDS, [r for _, r in batch_inserts])
+
+    def identity_changed(rec):
+        old = existing_ids[rec["id"]]
+        return bool(rec["password"]) or rec["username"] != old["username"] or rec["role"] != (old["role"] or DEFAULT_ROLE)
+
+    changed_ids = set()
+    db.execute("SAVEPOINT import_chunk")
+    try:
+        write(updates_pw, updates, inserts)
+        result["updated"] += len(updates_pw) + len(updates)
+        result["added"] += len(inserts)
+        changed_ids.update(rec["id"] for _, rec in updates_pw + updates if identity_changed(rec))
+    except DBDatabaseError as e:
+        # 預先檢查後仍衝突（例如同時有其他寫入）或資料庫拒絕某列的值：改為逐列寫入以找出問題列
+        if not is_data_error(e):
+            raise
+        db.execute("ROLLBACK TO SAVEPOINT import_chunk")
+        for kind, items in (("updated", updates_pw), ("updated", updates), ("added", inserts)):
+            for row_no, rec in items:
+                db.execute("SAVEPOINT import_row")
+                try:
+                    if kind == "added":
+                        write([], [], [(row_no, rec)])
+                    elif rec["password"]:
+                        write([(row_no, rec)], [], [])
+                    else:
+                        write([], [(row_no, rec)], [])
+                    result[kind] += 1
+                    if kind == "updated" and identity_changed(rec):
+                        changed_ids.add(rec["id"])
+                except DBDatabaseError as e:
+                    if not is_data_error(e):
+                        raise
+                    db.execute("ROLLBACK TO SAVEPOINT import_row")
+                    result["errors"].append((row_no, f"寫入失敗：{e}"))
+                db.execute("RELEASE SAVEPOINT import_row")
+    db.execute("RELEASE SAVEPOINT import_chunk")
+    return changed_ids
+
+
+def import_users(db, rows, chunk_size=None, dry_run=False, on_chunk=None):
+    """匯入 users：rows 為 (列號, 儲存格值 tuple) 的可迭代物件，逐批驗證與寫入
+
+    每批各自 commit；dry_run 時整個匯入在同一交易內執行後 rollback，不寫入任何資料。
+    on_chunk(result) 於每批完成後呼叫（供背景工作回報進度）。
+    回傳 {"added", "updated", "errors": [(列號, 訊息)], "processed"}。
+    """
+    chunk_size = chunk_size or app.config["IMPORT_CHUNK_SIZE"]
+    result = {"added": 0, "updated": 0, "errors": [], "processed": 0}
+
+    def flush(chunk):
+        _begin_transaction(db)
+        changed_ids = _apply_import_chunk(db, chunk, result)
+        if not dry_run:
+            db.commit()
+            invalidate_user_sessions(*changed_ids)
+        if on_chunk:
+            on_chunk(result)
+
+    chunk = []
+    try:
+        for row_no, values in rows:
+            rec, error = _parse_import_row(values)
+            if rec is None and error is None:
+                continue
+            result["processed"] += 1
+            if error:
+                result["errors"].append((row_no, error))
+                continue
+            chunk.append((row_no, rec))
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+    finally:
+        if dry_run:
+            db.rollback()
+        elif result["updated"]:
+            invalidate_user_auth()
+    result["errors"].sort()
+    return result
+
+
 @app.route("/db-manage/import", methods=["POST"])
 @admin_required
+@allow_query_repeats
 def db_manage_import():
-    """從 Excel 匯入 users（依 id 更新或依 username/email 新增）"""
+    """從 Excel 匯入 users（依 id 更新或依 username/email 新增；勾選試跑時只驗證不寫入）"""
     if "file" not in request.files:
         flash("請選擇要匯入的 Excel 檔案", "error")
         return redirect(url_for("db_manage"))
@@ -619,74 +3833,306 @@ def db_manage_import():
     except ImportError:
         flash("請安裝 openpyxl：pip install openpyxl", "error")
         return redirect(url_for("db_manage"))
+    dry_run = request.form.get("dry_run") == "1"
+    if app.config["JOBS_MODE"] != "off":
+        # 上傳檔先存到磁碟，由背景工作處理，請求立即回應
+        upload_path = _job_file_path(f"upload_{secrets.token_hex(8)}.xlsx")
+        f.save(str(upload_path))
+        job_id = create_job(get_db(), "import", file_path=str(upload_path), dry_run=dry_run)
+        return _job_created_response(job_id, "已建立匯入工作，處理進度顯示於下方")
     wb = load_workbook(f, read_only=True, data_only=True)
     ws = wb.active
     if not ws:
         flash("Excel 無有效工作表", "error")
         return redirect(url_for("db_manage"))
-    def _cell_str(val):
-        if val is None:
-            return None
-        if hasattr(val, "strftime"):
-            return val.strftime("%Y-%m-%d")
-        s = str(val).strip()
-        return s if s else None
+    result = import_users(
+        get_db(),
+        enumerate(ws.iter_rows(min_row=2, values_only=True), start=2),
+        dry_run=dry_run,
+    )
+    wb.close()
+    prefix = "試跑完成（未寫入資料）" if dry_run else "匯入完成"
+    flash(
+        f"{prefix}：新增 {result['added']} 筆，更新 {result['updated']} 筆，錯誤 {len(result['errors'])} 筆",
+        "warning" if result["errors"] else "success",
+    )
+    for row_no, message in result["errors"][:10]:
+        flash(f"第 {row_no} 列：{message}", "error")
+    if len(result["errors"]) > 10:
+        flash(f"另有 {len(result['errors']) - 10} 筆錯誤未列出", "error")
+    return redirect(url_for("db_manage"))
+
+
+# ==================== 匯入／匯出背景工作 ====================
+
+JOB_ERRORS_KEPT = 100  # jobs.errors 只保留前 100 筆錯誤明細
+_job_progress = {}  # thread 模式下的即時進度（試跑時資料庫交易尚未結束，無法寫入 jobs）
+
+
+def _job_file_path(name):
+    jobs_dir = app.config["JOBS_DIR"]
+    jobs_dir.mkdir(parents=True, exist_ok=True)
+    return jobs_dir / name
+
+
+def create_job(db, kind, file_path=None, dry_run=False):
+    """建立工作並交給背景處理，回傳 job id"""
+    job_id = insert_returning_id(
+        db,
+        "INSERT INTO jobs (kind, status, file_path, dry_run, created_by) VALUES (?, 'queued', ?, ?, ?)",
+        (kind, file_path, 1 if dry_run else 0, session.get("user_id")),
+    )
+    db.commit()
+    if app.config["JOBS_MODE"] == "thread":
+        sweep_stale_jobs(db)
+        _get_job_executor().submit(run_job, job_id)
+    return job_id
+
+
+def _job_created_response(job_id, message):
+    """建立工作後的回應：API 呼叫回傳 JSON，表單送出則導回管理頁顯示進度"""
+    if request.accept_mimetypes.best == "application/json" or request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        return jsonify({"ok": True, "job_id": job_id, "status_url": url_for("db_manage_job", job_id=job_id)}), 202
+    flash(message, "info")
+    return redirect(url_for("db_manage", job=job_id))
+
+
+def _update_job(db, job_id, **fields):
+    assignments = ", ".join(f"{k} = ?" for k in fields)
+    db.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+    db.commit()
+
+
+def _run_import_job(db, job):
+    from openpyxl import load_workbook
+    wb = load_workbook(job["file_path"], read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        if not ws:
+            raise ValueError("Excel 無有效工作表")
+        total = (ws.max_row - 1) if ws.max_row else None
+        dry_run = bool(job["dry_run"])
+        _update_job(db, job["id"], total=total)
+
+        def on_chunk(result):
+            progress = {"processed": result["processed"], "added": result["added"],
+                        "updated": result["updated"], "error_count": len(result["errors"])}
+            _job_progress[job["id"]] = progress
+            if not dry_run:
+                _update_job(db, job["id"], **progress)
+
+        result = import_users(
+            db, enumerate(ws.iter_rows(min_row=2, values_only=True), start=2),
+            dry_run=dry_run, on_chunk=on_chunk,
+        )
+    finally:
+        wb.close()
+    prefix = "試跑完成（未寫入資料）" if job["dry_run"] else "匯入完成"
+    return {
+        "processed": result["processed"],
+        "added": result["added"],
+        "updated": result["updated"],
+        "error_count": len(result["errors"]),
+        "errors": json.dumps(result["errors"][:JOB_ERRORS_KEPT], ensure_ascii=False),
+        "message": f"{prefix}：新增 {result['added']} 筆，更新 {result['updated']} 筆，錯誤 {len(result['errors'])} 筆",
+    }
+
+
+def _run_export_job(db, job):
+    total = db.execute("SELECT COUNT(*) AS n FROM users").fetchone()["n"]
+    _update_job(db, job["id"], total=total)
+    result_path = _job_file_path(f"export_{job['id']}_{secrets.token_hex(8)}.xlsx")
+
+    def on_progress(count):
+        _job_progress[job["id"]] = {"processed": count}
+        _update_job(db, job["id"], processed=count)
+
+    with open(result_path, "wb") as fh:
+        count = write_users_xlsx(db, fh, on_progress)
+    return {"processed": count, "result_path": str(result_path), "message": f"匯出完成：共 {count} 筆"}
+
+
+def _claim_job(db, job_id):
+    """領取工作（queued → running，以狀態為條件更新）：同一工作同時被執行緒池與 `flask jobs worker` 領取時只有一個成功"""
+    cur = db.execute(
+        "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ? AND status = 'queued'",
+        (_db_timestamp(datetime.utcnow()), job_id),
+    )
+    db.commit()
+    return cur.rowcount == 1
+
+
+def run_job(job_id):
+    """領取並執行一個排入的工作（於背景執行緒或 `flask jobs worker` 中呼叫）；已被其他地方領取時回傳 False"""
+    with app.app_context():
+        db = get_db()
+        if not _claim_job(db, job_id):
+            return False
+        job = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        try:
+            runner = _run_import_job if job["kind"] == "import" else _run_export_job
+            fields = runner(db, job)
+            fields["status"] = "done"
+        except Exception as e:
+            db.rollback()
+            fields = {"status": "failed", "message": f"工作失敗：{e}"}
+        fields["finished_at"] = _db_timestamp(datetime.utcnow())
+        _update_job(db, job_id, **fields)
+        _job_progress.pop(job_id, None)
+        if job["kind"] == "import" and job["file_path"]:
+            try:
+                os.remove(job["file_path"])
+            except OSError:
+                pass
+        _cleanup_job_files(db)
+        return True
+
+
+def sweep_stale_jobs(db):
+    """處理行程中止後殘留的工作：執行中超過 JOBS_STALE_MINUTES 者標記為失敗（已分批寫入的資料不會回復，
+    不自動重跑以免重複匯入）；thread 模式下排入已久仍未開始者重新交給執行緒池。回傳 (標記失敗數, 重新排入數)"""
+    now = datetime.utcnow()
+    cutoff = _db_timestamp(now - timedelta(minutes=app.config["JOBS_STALE_MINUTES"]))
+    failed = db.execute(
+        "UPDATE jobs SET status = 'failed', message = ?, finished_at = ? WHERE status = 'running' AND started_at < ?",
+        ("工作逾時：執行的行程可能已中止，請確認資料後重新建立工作", _db_timestamp(now), cutoff),
+    ).rowcount
+    db.commit()
+    requeued = 0
+    if app.config["JOBS_MODE"] == "thread":
+        rows = db.execute("SELECT id FROM jobs WHERE status = 'queued' AND created_at < ?", (cutoff,)).fetchall()
+        for row in rows:
+            _get_job_executor().submit(run_job, row["id"])  # 仍在其他執行緒池等待的工作由 _claim_job 擋下重複執行
+        requeued = len(rows)
+    return max(failed, 0), requeued
+
+
+def _cleanup_job_files(db):
+    """刪除完成超過 JOBS_RETENTION_HOURS 的匯出檔"""
+    cutoff = _db_timestamp(datetime.utcnow() - timedelta(hours=app.config["JOBS_RETENTION_HOURS"]))
+    rows = db.execute(
+        "SELECT id, result_path FROM jobs WHERE result_path IS NOT NULL AND finished_at < ?", (cutoff,)
+    ).fetchall()
+    for row in rows:
+        try:
+            os.remove(row["result_path"])
+        except OSError:
+            pass
+        db.execute("UPDATE jobs SET result_path = NULL WHERE id = ?", (row["id"],))
+    if rows:
+        db.commit()
+
+
+_job_executor = None
+_job_executor_pid = None
+_job_executor_lock = threading.Lock()
+
+
+def _get_job_executor():
+    """行程內的工作執行緒池（thread 模式）；fork 後的子行程會重新建立"""
+    global _job_executor, _job_executor_pid
+    from concurrent.futures import ThreadPoolExecutor
+    pid = os.getpid()
+    if _job_executor is None or _job_executor_pid != pid:
+        with _job_executor_lock:
+            if _job_executor is None or _job_executor_pid != pid:
+                _job_executor = ThreadPoolExecutor(max_workers=app.config["JOBS_MAX_WORKERS"], thread_name_prefix="job")
+                _job_executor_pid = pid
+    return _job_executor
+
+
+def _next_queued_job(db):
+    """最早排入、尚未開始的工作 id（由 run_job 領取）"""
+    row = db.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+    return row["id"] if row else None
+
+
+def _job_json(job):
+    progress = _job_progress.get(job["id"], {})
+    data = {
+        "id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "dry_run": bool(job["dry_run"]),
+        "total": job["total"],
+        "processed": progress.get("processed", job["processed"]),
+        "added": progress.get("added", job["added"]),
+        "updated": progress.get("updated", job["updated"]),
+        "error_count": progress.get("error_count", job["error_count"]),
+        "errors": json.loads(job["errors"]) if job["errors"] else [],
+        "message": job["message"],
+        "created_at": str(job["created_at"]) if job["created_at"] else None,
+        "finished_at": str(job["finished_at"]) if job["finished_at"] else None,
+        "download_url": None,
+    }
+    if job["kind"] == "export" and job["status"] == "done" and job["result_path"]:
+        data["download_url"] = url_for("db_manage_job_download", job_id=job["id"])
+    return data
+
+
+@app.route("/db-manage/jobs/<int:job_id>")
+@admin_required
+def db_manage_job(job_id):
+    """背景工作進度（JSON，供管理頁輪詢）"""
+    job = get_db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if not job:
+        return jsonify({"ok": False, "message": "無此工作"}), 404
+    return jsonify({"ok": True, "job": _job_json(job)}), 200
+
+
+@app.route("/db-manage/jobs/<int:job_id>/download")
+@admin_required
+def db_manage_job_download(job_id):
+    """下載匯出工作的結果檔"""
+    job = get_db().execute("SELECT kind, status, result_path, finished_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if not job or job["kind"] != "export" or job["status"] != "done" or not job["result_path"] or not os.path.exists(job["result_path"]):
+        flash("匯出檔不存在或已過期", "error")
+        return redirect(url_for("db_manage"))
+    return send_file(
+        job["result_path"],
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        as_attachment=True,
+        download_name=f"users_export_job{job_id}.xlsx",
+    )
+
+
+@app.cli.group("jobs")
+def jobs_cli():
+    """匯入／匯出背景工作"""
+
+
+@jobs_cli.command("worker")
+def jobs_worker_command():
+    """持續處理排入的工作（前景執行，Ctrl+C 結束）"""
+    import click
+    click.echo("背景工作 worker 已啟動")
+    try:
+        while True:
+            with app.app_context():
+                db = get_db()
+                failed, _ = sweep_stale_jobs(db)
+                if failed:
+                    click.echo(f"已將 {failed} 個逾時的工作標記為失敗")
+                job_id = _next_queued_job(db)
+            if job_id is None:
+                time.sleep(2)
+                continue
+            if run_job(job_id):
+                click.echo(f"已處理工作 #{job_id}")
+    except KeyboardInterrupt:
+        pass
+
 
-    rows = list(ws.iter_rows(min_row=2, values_only=True))
-    db = get_db()
-    cols = _user_columns()
-    added, updated = 0, 0
-    for row in rows:
-        if not row or len(row) < 3:
-            continue
-        row = list(row)[: len(cols)]
-        while len(row) < len(cols):
-            row.append(None)
-        try:
-            uid = int(row[0]) if row[0] is not None else None
-        except (TypeError, ValueError):
-            uid = None
-        username = (row[1] or "").strip() if row[1] is not None else ""
-        email = (row[2] or "").strip().lower() if row[2] is not None else ""
-        password_cell = row[3]
-        password = (password_cell or "").strip() if password_cell is not None else ""
-        email_verified = 1 if row[4] in (1, "1", True, "True") else 0
-        birthday = _cell_str(row[5])
-        phone = (row[6] or "").strip() or None if row[6] is not None else None
-        address = (row[7] or "").strip() or None if row[7] is not None else None
-        work_region = (row[8] or "").strip() or None if row[8] is not None else None
-        role = (row[9] or "").strip() or DEFAULT_ROLE if row[9] is not None else DEFAULT_ROLE
-        if not username or not email:
-            continue
-        existing = db.execute("SELECT id, password_hash FROM users WHERE id = ?", (uid,)).fetchone() if uid else None
-        if existing:
-            if password:
-                db.execute(
-                    """UPDATE users SET username=?, email=?, password_hash=?, email_verified=?, birthday=?, phone=?, address=?, work_region=?, role=?, updated_at=CURRENT_TIMESTAMP WHERE id=?""",
-                    (username, email, hash_password(password), email_verified, birthday, phone, address, work_region, role, uid),
-                )
-            else:
-                db.execute(
-                    """UPDATE users SET username=?, email=?, email_verified=?, birthday=?, phone=?, address=?, work_region=?, role=?, updated_at=CURRENT_TIMESTAMP WHERE id=?""",
-                    (username, email, email_verified, birthday, phone, address, work_region, role, uid),
-                )
-            updated += 1
-        else:
-            pwd_hash = hash_password(password) if password else hash_password(secrets.token_urlsafe(8))
-            db.execute(
-                """INSERT INTO users (username, email, password_hash, email_verified, birthday, phone, address, work_region, role)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (username, email, pwd_hash, email_verified, birthday, phone, address, work_region, role),
-            )
-            added += 1
-    db.commit()
-    flash(f"匯入完成：新增 {added} 筆，更新 {updated} 筆", "success")
-    return redirect(url_for("db_manage"))
+@jobs_cli.command("sweep")
+def jobs_sweep_command():
+    """將執行中逾時（JOBS_STALE_MINUTES）的工作標記為失敗；thread 模式下重新排入久未開始的工作"""
+    failed, requeued = sweep_stale_jobs(get_db())
+    click.echo(f"標記失敗 {failed} 個，重新排入 {requeued} 個")
 
 
 @app.route("/register", methods=["GET", "POST"])
-def register():
-    """註冊"""
+async def register():
+    """註冊（async view：等待資料庫、密碼雜湊與寄信時不佔用執行緒）"""
     if request.method == "POST":
         username = request.form.get("username", "").strip()
         email = request.form.get("email", "").strip().lower()
@@ -706,31 +4152,31 @@ def register():
             flash("密碼長度至少 6 個字元", "error")
             return render_template("register.html")
         
-        db = get_db()
+        db = await get_async_db()
         
         # 檢查使用者名稱是否已存在
-        if db.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone():
+        if (await db.execute(USERNAME_TAKEN_SQL, (username,))).fetchone():
             flash("使用者名稱已存在", "error")
             return render_template("register.html")
         
         # 檢查電子信箱是否已存在
-        if db.execute("SELECT id FROM users WHERE email = ?", (email,)).fetchone():
+        if (await db.execute(EMAIL_TAKEN_SQL, (email,))).fetchone():
             flash("電子信箱已被註冊", "error")
             return render_template("register.html")
         
         # 建立使用者
-        password_hash = hash_password(password)
+        password_hash = await run_sync(hash_password, password)
         verification_token = generate_token()
         
-        db.execute(
+        await db.execute(
             """INSERT INTO users (username, email, password_hash, verification_token, role)
                VALUES (?, ?, ?, ?, ?)""",
             (username, email, password_hash, verification_token, DEFAULT_ROLE)
         )
-        db.commit()
+        await db.commit()
         
         # 發送驗證郵件
-        if send_verification_email(email, username, verification_token):
+        if await run_sync(send_verification_email, email, username, verification_token):
             flash("註冊成功！我們已發送驗證郵件至您的電子信箱，請查收並點擊連結完成驗證。", "success")
         else:
             verification_url = url_for("verify_email", token=verification_token, _external=True)
@@ -757,13 +4203,12 @@ def login():
         flash("請填寫所有欄位", "error")
         return render_template("login.html")
     
-    db = get_db()
-    password_hash = hash_password(password)
+    retry_after = rate_limiter.check(("login_ip", client_ip()), ("login_identifier", username.lower()))
+    if retry_after:
+        return rate_limited_response(retry_after, "login.html")
     
-    user = db.execute(
-        "SELECT id, username, email, email_verified, role FROM users WHERE (username = ? OR email = ?) AND password_hash = ?",
-        (username, username, password_hash)
-    ).fetchone()
+    db = get_db()
+    user = find_login_user(db, username, password, "id, username, email, email_verified, role")
     
     if user:
         session["user_id"] = user["id"]
@@ -808,10 +4253,7 @@ def verify_email():
     
     # 驗證 token
     db = get_db()
-    user = db.execute(
-        "SELECT id, email_verified FROM users WHERE verification_token = ?",
-        (token,)
-    ).fetchone()
+    user = db.execute(USER_BY_VERIFICATION_TOKEN_SQL, (token,)).fetchone()
     
     if not user:
         flash("無效的驗證連結", "error")
@@ -827,6 +4269,7 @@ def verify_email():
         (user["id"],)
     )
     db.commit()
+    invalidate_user_auth(user["id"])
     
     flash("電子信箱驗證成功！", "success")
     return redirect(url_for("index"))
@@ -874,8 +4317,12 @@ def forgot_password():
             flash("請輸入電子信箱", "error")
             return render_template("forgot_password.html")
         
+        retry_after = rate_limiter.check(("forgot_password_ip", client_ip()), ("forgot_password_email", email))
+        if retry_after:
+            return rate_limited_response(retry_after, "forgot_password.html")
+        
         db = get_db()
-        user = db.execute("SELECT id, username FROM users WHERE email = ?", (email,)).fetchone()
+        user = db.execute(USER_BY_EMAIL_SQL, (email,)).fetchone()
         
         if user:
             reset_token = generate_token()
@@ -912,10 +4359,7 @@ def reset_password():
         return redirect(url_for("forgot_password"))
     
     db = get_db()
-    user = db.execute(
-        "SELECT id, reset_token_expires FROM users WHERE reset_token = ?",
-        (token,)
-    ).fetchone()
+    user = db.execute(USER_BY_RESET_TOKEN_SQL, (token,)).fetchone()
     
     if not user:
         flash("無效的重設密碼連結", "error")
@@ -955,7 +4399,9 @@ def reset_password():
             "UPDATE users SET password_hash = ?, reset_token = NULL, reset_token_expires = NULL WHERE id = ?",
             (password_hash, user["id"])
         )
+        revoke_user_tokens(db, user["id"])
         db.commit()
+        invalidate_user_sessions(user["id"])
         
         flash("密碼重設成功！請使用新密碼登入", "success")
         return redirect(url_for("index"))
@@ -996,7 +4442,7 @@ def edit_profile():
         confirm_password = request.form.get("confirm_password", "")
         
         user = db.execute(
-            "SELECT username, email, password_hash FROM users WHERE id = ?",
+            "SELECT username, email, password_hash, role FROM users WHERE id = ?",
             (session["user_id"],)
         ).fetchone()
         
@@ -1006,7 +4452,7 @@ def edit_profile():
                 flash("請輸入目前密碼", "error")
                 return redirect(url_for("edit_profile"))
             
-            if hash_password(current_password) != user["password_hash"]:
+            if not verify_password(current_password, user["password_hash"]):
                 flash("目前密碼錯誤", "error")
                 return redirect(url_for("edit_profile"))
             
@@ -1018,19 +4464,26 @@ def edit_profile():
                 flash("密碼長度至少 6 個字元", "error")
                 return redirect(url_for("edit_profile"))
         
-        # 檢查使用者名稱是否已被其他人使用
+        # 檢查使用者名稱／電子信箱是否已被其他人使用（兩者皆變更時以一個查詢完成）
+        email_changed = email != user["email"]
+        checks = []
         if username != user["username"]:
-            if db.execute("SELECT id FROM users WHERE username = ? AND id != ?", (username, session["user_id"])).fetchone():
+            checks.append(("SELECT 'username' AS field FROM users WHERE username = ? AND id != ?", username))
+        if email_changed:
+            checks.append(("SELECT 'email' AS field FROM users WHERE email = ? AND id != ?", email))
+        if checks:
+            taken = {
+                row["field"] for row in db.execute(
+                    " UNION ALL ".join(sql for sql, _ in checks),
+                    [p for _, value in checks for p in (value, session["user_id"])],
+                ).fetchall()
+            }
+            if "username" in taken:
                 flash("使用者名稱已被使用", "error")
                 return redirect(url_for("edit_profile"))
-        
-        # 檢查電子信箱是否已被其他人使用
-        email_changed = False
-        if email != user["email"]:
-            if db.execute("SELECT id FROM users WHERE email = ? AND id != ?", (email, session["user_id"])).fetchone():
+            if "email" in taken:
                 flash("電子信箱已被使用", "error")
                 return redirect(url_for("edit_profile"))
-            email_changed = True
         
         # 更新資料
         update_fields = []
@@ -1067,7 +4520,13 @@ def edit_profile():
             
             query = f"UPDATE users SET {', '.join(update_fields)} WHERE id = ?"
             db.execute(query, update_values)
+            if new_password:
+                revoke_user_tokens(db, session["user_id"])
             db.commit()
+            invalidate_user_auth(session["user_id"])
+            if new_password or username != user["username"] or role != (user["role"] or DEFAULT_ROLE):
+                # 其他裝置的 session 仍是舊資料（或舊密碼登入），一併登出
+                invalidate_user_sessions(session["user_id"], keep_current=True)
             session["role"] = role
             if email_changed:
                 flash("個人資料已更新！請重新驗證您的電子信箱", "success")
@@ -1104,39 +4563,103 @@ def generate_token_api():
         if not username or not password:
             return jsonify({"ok": False, "message": "請提供使用者名稱和密碼"}), 400
         
-        db = get_db()
-        password_hash = hash_password(password)
+        retry_after = rate_limiter.check(("login_ip", client_ip()), ("login_identifier", username.lower()))
+        if retry_after:
+            return rate_limited_response(retry_after)
         
-        user = db.execute(
-            "SELECT id, username FROM users WHERE (username = ? OR email = ?) AND password_hash = ?",
-            (username, username, password_hash)
-        ).fetchone()
+        db = get_db()
+        columns = "id, username, email, email_verified, created_at" if app.config["JWT_EMBED_PROFILE_CLAIMS"] else "id, username"
+        user = find_login_user(db, username, password, columns)
         
         if not user:
             return jsonify({"ok": False, "message": "使用者名稱或密碼錯誤"}), 401
         
-        token = generate_jwt_token(user["id"], user["username"])
+        token = generate_jwt_token(
+            user["id"], user["username"], user if app.config["JWT_EMBED_PROFILE_CLAIMS"] else None
+        )
+        refresh_token = issue_refresh_token(db, user["id"])
+        db.commit()
         
         return jsonify({
             "ok": True,
             "token": token,
-            "expires_in": int(app.config["JWT_EXPIRATION_DELTA"].total_seconds())
+            "expires_in": int(app.config["JWT_EXPIRATION_DELTA"].total_seconds()),
+            "refresh_token": refresh_token,
+            "refresh_expires_in": int(app.config["JWT_REFRESH_EXPIRATION_DELTA"].total_seconds()),
         }), 200
 
 
-@app.route("/api/verify-token", methods=["POST"])
-def verify_token_api():
-    """驗證 API Token"""
-    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+@app.route("/api/token/refresh", methods=["POST"])
+def refresh_token_api():
+    """以 refresh token 換發新的 access token 與 refresh token（舊 refresh token 立即失效）"""
+    raw = request.form.get("refresh_token", "").strip()
+    if not raw:
+        return jsonify({"ok": False, "message": "請提供 refresh_token"}), 400
     
-    if not token:
-        return jsonify({"ok": False, "message": "請提供 token"}), 400
+    db = get_db()
+    row = db.execute(
+        """SELECT t.id, t.user_id, t.expires_at, t.revoked_at, u.username, u.email, u.email_verified, u.created_at
+           FROM tokens t JOIN users u ON u.id = t.user_id
+           WHERE t.token = ? AND t.kind = 'refresh'""",
+        (_hash_refresh_token(raw),)
+    ).fetchone()
     
-    payload = verify_jwt_token(token)
+    if not row or _parse_db_datetime(row["expires_at"]) < datetime.now(timezone.utc):
+        return jsonify({"ok": False, "message": "無效或過期的 refresh token"}), 401
     
-    if not payload:
-        return jsonify({"ok": False, "message": "無效或過期的 token"}), 401
+    if row["revoked_at"]:
+        # 已換發過的 refresh token 再次出現，視為外洩：撤銷該使用者所有 token
+        revoke_user_tokens(db, row["user_id"])
+        db.commit()
+        return jsonify({"ok": False, "message": "無效或過期的 refresh token"}), 401
+    
+    cur = db.execute(
+        "UPDATE tokens SET revoked_at = ? WHERE id = ? AND revoked_at IS NULL",
+        (_db_timestamp(datetime.utcnow()), row["id"])
+    )
+    if cur.rowcount != 1:
+        db.rollback()
+        return jsonify({"ok": False, "message": "無效或過期的 refresh token"}), 401
+    refresh_token = issue_refresh_token(db, row["user_id"])
+    db.commit()
     
+    token = generate_jwt_token(
+        row["user_id"], row["username"], row if app.config["JWT_EMBED_PROFILE_CLAIMS"] else None
+    )
+    return jsonify({
+        "ok": True,
+        "token": token,
+        "expires_in": int(app.config["JWT_EXPIRATION_DELTA"].total_seconds()),
+        "refresh_token": refresh_token,
+        "refresh_expires_in": int(app.config["JWT_REFRESH_EXPIRATION_DELTA"].total_seconds()),
+    }), 200
+
+
+@app.route("/api/token/revoke", methods=["POST"])
+@token_required
+def revoke_token_api():
+    """撤銷目前的 access token（表單可附 refresh_token 一併撤銷；all=1 撤銷該使用者所有 token）"""
+    payload = g.jwt_payload
+    db = get_db()
+    if request.form.get("all") == "1":
+        revoke_user_tokens(db, payload["user_id"])
+    else:
+        revoke_access_token(db, payload)
+        raw = request.form.get("refresh_token", "").strip()
+        if raw:
+            db.execute(
+                "UPDATE tokens SET revoked_at = ? WHERE token = ? AND user_id = ? AND kind = 'refresh' AND revoked_at IS NULL",
+                (_db_timestamp(datetime.utcnow()), _hash_refresh_token(raw), payload["user_id"])
+            )
+    db.commit()
+    return jsonify({"ok": True}), 200
+
+
+@app.route("/api/verify-token", methods=["POST"])
+@token_required
+def verify_token_api():
+    """驗證 API Token"""
+    payload = g.jwt_payload
     return jsonify({
         "ok": True,
         "user_id": payload["user_id"],
@@ -1144,44 +4667,774 @@ def verify_token_api():
     }), 200
 
 
-@app.route("/api/user-info", methods=["GET"])
-def user_info_api():
-    """取得使用者資訊 (需要 Token)"""
-    token = request.headers.get("Authorization", "").replace("Bearer ", "")
-    
-    if not token:
-        return jsonify({"ok": False, "message": "請提供 token"}), 400
-    
-    payload = verify_jwt_token(token)
-    
-    if not payload:
-        return jsonify({"ok": False, "message": "無效或過期的 token"}), 401
-    
-    db = get_db()
-    user = db.execute(
-        "SELECT id, username, email, email_verified, created_at FROM users WHERE id = ?",
-        (payload["user_id"],)
-    ).fetchone()
-    
-    if not user:
-        return jsonify({"ok": False, "message": "使用者不存在"}), 404
+def _batch_items(key):
+    """讀取批次請求的 JSON 陣列（可為 {key: [...]} 或直接傳陣列），格式錯誤時回傳 (None, 錯誤回應)"""
+    data = request.get_json(silent=True)
+    items = data.get(key) if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return None, (jsonify({"ok": False, "message": f"請以 JSON 陣列提供 {key}"}), 400)
+    if len(items) > app.config["TOKEN_BATCH_MAX_SIZE"]:
+        return None, (jsonify({"ok": False, "message": f"單次最多 {app.config['TOKEN_BATCH_MAX_SIZE']} 筆"}), 413)
+    return items, None
+
+
+@app.route("/api/verify-token/batch", methods=["POST"])
+def verify_token_batch_api():
+    """批次驗證 API Token：依輸入順序回傳每個 token 的結果"""
+    tokens, error = _batch_items("tokens")
+    if error:
+        return error
+    results = []
+    for token in tokens:
+        payload = verify_jwt_token(token) if isinstance(token, str) and token else None
+        if payload:
+            results.append({"ok": True, "user_id": payload["user_id"], "username": payload["username"], "exp": payload["exp"]})
+        else:
+            results.append({"ok": False, "message": "無效或過期的 token"})
+    return jsonify({"ok": True, "results": results}), 200
+
+
+@app.route("/api/token/batch", methods=["POST"])
+@token_required
+def generate_token_batch_api():
+    """批次簽發 API Token（僅管理者）：以單一 IN 查詢取得所有使用者後逐一簽發"""
+    auth = get_user_auth(g.jwt_payload["user_id"])
+    if not auth or auth["role"] != "管理者":
+        return jsonify({"ok": False, "message": "僅管理者可存取此功能"}), 403
+    user_ids, error = _batch_items("user_ids")
+    if error:
+        return error
+    try:
+        user_ids = list(dict.fromkeys(int(uid) for uid in user_ids))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "message": "user_ids 必須為整數"}), 400
     
+    columns = "id, username, email, email_verified, created_at" if app.config["JWT_EMBED_PROFILE_CLAIMS"] else "id, username"
+    rows = get_db().execute(
+        f"SELECT {columns} FROM users WHERE id IN ({', '.join('?' * len(user_ids))})", user_ids
+    ).fetchall()
+    users = {row["id"]: row for row in rows}
+    expires_in = int(app.config["JWT_EXPIRATION_DELTA"].total_seconds())
+    tokens = [
+        {"user_id": uid, "token": generate_jwt_token(uid, users[uid]["username"], users[uid]), "expires_in": expires_in}
+        for uid in user_ids if uid in users
+    ]
+    app.logger.info("管理者 %s 批次簽發 %d 個 token", g.jwt_payload["user_id"], len(tokens))
     return jsonify({
+        "ok": True,
+        "tokens": tokens,
+        "missing": [uid for uid in user_ids if uid not in users],
+    }), 200
+
+
+def _user_info_entry(user):
+    """建立 /api/user-info 回應內容與 ETag"""
+    body = {
         "ok": True,
         "user": {
             "id": user["id"],
             "username": user["username"],
             "email": user["email"],
             "email_verified": bool(user["email_verified"]),
-            "created_at": user["created_at"]
+            "created_at": _json_datetime(user["created_at"]),
         }
-    }), 200
+    }
+    etag = hashlib.sha1(json.dumps(body, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    return body, etag
+
+
+def _user_info_response(body, etag):
+    """回傳 JSON；If-None-Match 相符時回傳 304"""
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify(body)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+
+@app.route("/api/user-info", methods=["GET"])
+@token_required
+async def user_info_api():
+    """取得使用者資訊 (需要 Token)；支援 ETag / If-None-Match（async view：查詢資料庫時不佔用執行緒）"""
+    payload = g.jwt_payload
+    user_id = payload["user_id"]
+    # 快速路徑一：token 內已有個人資料，完全不查資料庫
+    profile = payload.get("profile") if app.config["JWT_EMBED_PROFILE_CLAIMS"] else None
+    if profile:
+        body, etag = _user_info_entry({"id": user_id, "username": payload["username"], **profile})
+        return _user_info_response(body, etag)
+    
+    # 快速路徑二：版本相符的快取回應
+    version = user_version(user_id)
+    cached = user_info_cache.get(user_id)
+    if cached and cached[0] == version:
+        return _user_info_response(cached[1], cached[2])
+    
+    db = await get_async_db()
+    user = (await db.execute(
+        "SELECT id, username, email, email_verified, created_at FROM users WHERE id = ?",
+        (user_id,)
+    )).fetchone()
+    
+    if not user:
+        return jsonify({"ok": False, "message": "使用者不存在"}), 404
+    
+    body, etag = _user_info_entry(user)
+    user_info_cache.set(user_id, (version, body, etag))
+    return _user_info_response(body, etag)
+
+
+# ==================== 監控指標 ====================
+
+def _is_local_request():
+    """請求是否由本機直接連入：同機的反向代理會帶 X-Forwarded-For，視為外部請求"""
+    if "X-Forwarded-For" in request.headers or "Forwarded" in request.headers:
+        return False
+    try:
+        return ipaddress.ip_address(request.remote_addr or "").is_loopback
+    except ValueError:
+        return False
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus 文字格式的指標（METRICS_ENABLED 開啟時提供；設定 METRICS_TOKEN 時須帶 Bearer token，否則僅限本機）"""
+    if not app.config["METRICS_ENABLED"]:
+        abort(404)
+    if app.config["METRICS_TOKEN"]:
+        if not secrets.compare_digest(_bearer_token(), app.config["METRICS_TOKEN"]):
+            abort(401)
+    elif not _is_local_request():
+        abort(403)
+    lines = []
+    for metric in (
+        request_duration_histogram, query_duration_histogram, query_rows_counter, operation_duration_histogram,
+        page_cache_events,
+    ):
+        lines.extend(metric.render())
+    caches = {"user_auth": user_auth_cache, "user_info": user_info_cache, "jwt": jwt_cache, "page": page_cache}
+    cache_stats = {name: cache.stats() for name, cache in caches.items()}
+    for key, metric_type in (("hits", "counter"), ("misses", "counter"), ("size", "gauge")):
+        lines.extend(_metrics_gauge(
+            f"app_cache_{key}" + ("_total" if metric_type == "counter" else ""), f"行程內快取 {key}", metric_type,
+            [(("cache",), (name,), stats[key]) for name, stats in cache_stats.items()],
+        ))
+    lines.extend(_metrics_gauge(
+        "rate_limit_requests_total", "頻率限制判定次數", "counter",
+        [(("rule", "outcome"), (rule, outcome), count)
+         for rule, counts in rate_limiter.stats().items() for outcome, count in counts.items()],
+    ))
+    if USE_POSTGRES and _pg_pool is not None:
+        gauges = {"size", "idle", "in_use", "min_size", "max_size"}
+        for key, value in _pg_pool.stats().items():
+            metric_type = "gauge" if key in gauges else "counter"
+            name = f"db_pool_{key}" + ("" if metric_type == "gauge" else "_total")
+            lines.extend(_metrics_gauge(name, f"Postgres 連線池 {key}", metric_type, [((), (), value)]))
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+# ==================== 回應壓縮 ====================
+
+class _GzipCompressor:
+    def __init__(self, level):
+        import zlib
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31：gzip 格式
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
 
+class _BrotliCompressor:
+    def __init__(self, level):
+        import brotli
+        # quality 11 太慢不適合即時壓縮；gzip 6 約對應 brotli 5
+        self._obj = brotli.Compressor(quality=min(max(level - 1, 0), 11))
 
-# 模組載入時即初始化資料表（Vercel 等環境不會執行 __main__，須在此執行）
+    def compress(self, data):
+        return self._obj.process(data)
+
+    def flush(self):
+        return self._obj.finish()
+
+
+class _ZstdCompressor:
+    def __init__(self, level):
+        import zstandard
+        self._obj = zstandard.ZstdCompressor(level=max(level - 3, 1)).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+def _available_compressors(names):
+    """依設定順序回傳可用的壓縮演算法（未安裝的選用套件略過）"""
+    factories = {"br": ("brotli", _BrotliCompressor), "zstd": ("zstandard", _ZstdCompressor), "gzip": (None, _GzipCompressor)}
+    available = {}
+    for name in names:
+        if name not in factories:
+            continue
+        module, factory = factories[name]
+        if module:
+            try:
+                __import__(module)
+            except ImportError:
+                continue
+        available[name] = factory
+    return available
+
+
+class _CompressedBody:
+    """逐塊壓縮原始回應的 iterable：不整份緩衝，串流回應（CSV／NDJSON 匯出）照樣邊產生邊送出"""
+
+    def __init__(self, app_iter, compressor):
+        self._app_iter = app_iter
+        self._compressor = compressor
+
+    def __iter__(self):
+        for chunk in self._app_iter:
+            if chunk:
+                data = self._compressor.compress(chunk)
+                if data:
+                    yield data
+        yield self._compressor.flush()
+
+    def close(self):
+        # 一定要關閉原始 iterable，stream_with_context 與請求 teardown 才會執行
+        close = getattr(self._app_iter, "close", None)
+        if close is not None:
+            close()
+
+
+class CompressionMiddleware:
+    """依 Accept-Encoding 壓縮回應的 WSGI middleware。
+
+    跳過：HEAD、1xx 與沒有完整本文的狀態（204／206／304）、已有 Content-Encoding（如 /static/dist/ 的預先壓縮檔）、
+    Cache-Control: no-transform、不在 mimetypes 內的類型（.xlsx 等本身已壓縮的格式），以及 Content-Length 小於 min_size 者。
+    沒有 Content-Length 的串流回應一律壓縮。壓縮後 ETag 改為弱 ETag，條件式請求仍可比對。
+    """
+
+    def __init__(self, wsgi_app, algorithms, mimetypes, min_size=500, level=6):
+        self.wsgi_app = wsgi_app
+        self.compressors = _available_compressors(algorithms)
+        self.mimetypes = set(mimetypes)
+        self.min_size = min_size
+        self.level = level
+
+    def negotiate(self, accept_encoding):
+        """用戶端 q 值最高者優先，同分時依伺服器設定順序"""
+        from werkzeug.http import parse_accept_header
+        accept = parse_accept_header(accept_encoding)
+        best, best_q = None, 0
+        for name in self.compressors:
+            q = accept[name]
+            if q > best_q:
+                best, best_q = name, q
+        return best
+
+    def _should_compress(self, status, headers):
+        code = int(status.split(" ", 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        content_type = content_length = None
+        for key, value in headers:
+            key = key.lower()
+            if key == "content-encoding":
+                return False
+            if key == "cache-control" and "no-transform" in value.lower():
+                return False
+            if key == "content-type":
+                content_type = value.split(";", 1)[0].strip().lower()
+            elif key == "content-length":
+                content_length = value
+        if content_type not in self.mimetypes:
+            return False
+        return content_length is None or int(content_length) >= self.min_size
+
+    def __call__(self, environ, start_response):
+        return self.wrap(self.wsgi_app, environ, start_response)
+
+    def wrap(self, wsgi_app, environ, start_response):
+        """以壓縮規則執行任一 WSGI app（ASGI 模式的 async view 回應也經過這裡）"""
+        encoding = None
+        if self.compressors and environ.get("REQUEST_METHOD") != "HEAD":
+            encoding = self.negotiate(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if encoding is None:
+            return wsgi_app(environ, start_response)
+        compress = []
+
+        def _start_response(status, headers, exc_info=None):
+            if self._should_compress(status, headers):
+                compress.append(True)
+                rewritten = []
+                vary = None
+                for key, value in headers:
+                    lower = key.lower()
+                    if lower == "content-length":
+                        continue
+                    if lower == "etag" and not value.startswith("W/"):
+                        value = "W/" + value
+                    if lower == "vary":
+                        vary = value
+                        continue
+                    rewritten.append((key, value))
+                rewritten.append(("Content-Encoding", encoding))
+                if vary and "accept-encoding" not in vary.lower():
+                    vary = f"{vary}, Accept-Encoding"
+                rewritten.append(("Vary", vary or "Accept-Encoding"))
+                headers = rewritten
+            return start_response(status, headers, exc_info) if exc_info else start_response(status, headers)
+
+        app_iter = wsgi_app(environ, _start_response)
+        if not compress:
+            return app_iter
+        return _CompressedBody(app_iter, self.compressors[encoding](self.level))
+
+
+compression_middleware = None
+if app.config["COMPRESS_ENABLED"]:
+    app.wsgi_app = compression_middleware = CompressionMiddleware(
+        app.wsgi_app,
+        app.config["COMPRESS_ALGORITHMS"],
+        app.config["COMPRESS_MIMETYPES"],
+        min_size=app.config["COMPRESS_MIN_SIZE"],
+        level=app.config["COMPRESS_LEVEL"],
+    )
+
+
+# ==================== 非同步（ASGI）模式 ====================
+#
+# `uvicorn app:asgi_app --workers N` 以 ASGI 執行時，async def 的 view（/register、/api/user-info）直接在事件迴圈上執行：
+# 等待資料庫（Postgres 用 asyncpg；SQLite 交給執行緒）、密碼雜湊與寄信時不佔用任何執行緒，同一個 worker 可同時處理大量這類請求。
+# 其他同步 view 在 ASGI_SYNC_THREADS 個執行緒中以 WSGI 方式執行（含 CompressionMiddleware）。
+# 以 WSGI 執行（flask run、gunicorn、Vercel）時，async view 由 Flask 在請求執行緒內跑完（需安裝 asgiref），結果相同但沒有並行上的好處。
+
+_native_asgi = ContextVar("native_asgi", default=False)  # 目前請求是否在 asgi_app 的事件迴圈上執行
+
+
+async def run_sync(fn, *args):
+    """在執行緒中執行同步函式（密碼雜湊、寄信等），期間不阻塞事件迴圈。
+    ASGI 模式使用獨立的 app context，資料庫連線為該執行緒自己的，不與目前請求共用；請求的量測資料照常記錄。
+    WSGI 模式下請求執行緒本來就在等待這個 view，直接回到該執行緒、沿用請求的 app context 與資料庫連線執行"""
+    if not _native_asgi.get():
+        from asgiref.sync import sync_to_async
+        return await sync_to_async(fn, thread_sensitive=True)(*args)
+    perf = g.get("perf")
+
+    def call():
+        with app.app_context():
+            if perf is not None:
+                g.perf = perf
+            return fn(*args)
+
+    return await asyncio.to_thread(call)
+
+
+def _returns_rows(sql):
+    head = sql.lstrip().upper()
+    return head.startswith(("SELECT", "WITH", "VALUES", "PRAGMA", "EXPLAIN")) or " RETURNING " in head
+
+
+class _AsyncResult:
+    """非同步查詢結果（資料列已全部取回），介面同 cursor 的 fetchone／fetchall／rowcount"""
+
+    def __init__(self, rows, rowcount):
+        self._rows = list(rows)
+        self._pos = 0
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    def fetchall(self):
+        rows, self._pos = self._rows[self._pos:], len(self._rows)
+        return rows
+
+
+class _ThreadedAsyncDb:
+    """以執行緒執行同步連線的操作，同一連線的操作依序執行
+
+    - ASGI 模式的 SQLite：自有連線，操作交給 asyncio.to_thread
+    - WSGI 模式（borrowed=True）：借用請求的 get_db() 連線，操作以 asgiref 的 sync_to_async(thread_sensitive=True)
+      回到等待中的請求執行緒執行（持久 SQLite 連線屬於該執行緒），連線由 close_db() 照常歸還
+    """
+
+    def __init__(self, conn, borrowed=False):
+        self._conn = conn
+        self._borrowed = borrowed
+        self._lock = asyncio.Lock()
+
+    async def _run(self, fn, *args):
+        async with self._lock:
+            if self._borrowed:
+                from asgiref.sync import sync_to_async
+                return await sync_to_async(fn, thread_sensitive=True)(*args)
+            return await asyncio.to_thread(fn, *args)
+
+    async def execute(self, sql, params=()):
+        def run():
+            cur = self._conn.execute(sql, params)
+            return _AsyncResult(cur.fetchall() if _returns_rows(sql) else [], cur.rowcount)
+        return await self._run(run)
+
+    async def commit(self):
+        await self._run(self._conn.commit)
+
+    async def rollback(self):
+        await self._run(self._conn.rollback)
+
+    def close(self):
+        if not self._borrowed:
+            self._conn.close()
+
+    async def aclose(self):
+        await asyncio.to_thread(self.close)
+
+
+class _AsyncpgDb:
+    """asyncpg 連線包裝：? 轉為 $1、$2…，第一次執行時開始交易，commit／rollback 結束交易"""
+
+    def __init__(self, conn, pool):
+        self._conn = conn
+        self._pool = pool
+        self._transaction = None
+
+    async def execute(self, sql, params=()):
+        if self._transaction is None:
+            self._transaction = self._conn.transaction()
+            await self._transaction.start()
+        counter = iter(range(1, len(params) + 1))
+        sql = re.sub(r"\?", lambda _: f"${next(counter)}", sql)
+        if _returns_rows(sql):
+            rows = await self._conn.fetch(sql, *params)
+            return _AsyncResult(rows, len(rows))
+        status = (await self._conn.execute(sql, *params)).split()
+        return _AsyncResult([], int(status[-1]) if status and status[-1].isdigit() else -1)
+
+    async def commit(self):
+        transaction, self._transaction = self._transaction, None
+        if transaction is not None:
+            await transaction.commit()
+
+    async def rollback(self):
+        transaction, self._transaction = self._transaction, None
+        if transaction is not None:
+            await transaction.rollback()
+
+    def close(self):
+        # 正常情況由 asgi_app 在請求結束時 aclose()；此處僅為保險，直接中斷連線（連線池會補上新連線）
+        self._conn.terminate()
+
+    async def aclose(self):
+        await self.rollback()
+        await self._pool.release(self._conn)
+
+
+def _require_asyncpg():
+    """ASGI 模式使用 Postgres 時必須安裝 asyncpg（requirements.txt 已列出），不靜默退回以執行緒執行 pg8000"""
+    try:
+        import asyncpg  # noqa: F401
+    except ImportError as e:
+        raise RuntimeError("ASGI 模式（asgi_app）使用 Postgres 需要 asyncpg：pip install -r requirements.txt") from e
+
+
+_asyncpg_pools = {}  # 事件迴圈 -> 建立連線池的 Task（asyncpg 連線池綁定建立時的事件迴圈）
+
+
+async def _get_asyncpg_pool():
+    loop = asyncio.get_running_loop()
+    task = _asyncpg_pools.get(loop)
+    if task is None:
+        import asyncpg
+        task = _asyncpg_pools[loop] = loop.create_task(asyncpg.create_pool(
+            **_parse_postgres_url(_postgres_url),
+            min_size=app.config["PG_POOL_MIN_SIZE"],
+            max_size=app.config["PG_POOL_MAX_SIZE"],
+            max_inactive_connection_lifetime=app.config["PG_POOL_IDLE_TIMEOUT"],
+        ))
+    try:
+        return await task
+    except Exception:
+        _asyncpg_pools.pop(loop, None)
+        raise
+
+
+async def get_async_db():
+    """get_db() 的非同步版本（供 async view 使用），每個請求一條連線：
+    `(await db.execute(sql, params)).fetchone()`、`await db.commit()`，SQL 一樣以 ? 為參數符號。
+    WSGI 模式下就是請求的 get_db() 連線（不另外取用連線池或開新的 SQLite 連線）；
+    ASGI 模式的 SQLite 每個語句各自 commit，需要多個語句構成同一交易時請以 run_sync() 交給同步的 get_db() 處理"""
+    db = g.get("async_db")
+    if db is None:
+        if not _native_asgi.get():
+            from asgiref.sync import sync_to_async
+            db = _ThreadedAsyncDb(await sync_to_async(get_db, thread_sensitive=True)(), borrowed=True)
+        elif USE_POSTGRES:
+            _require_asyncpg()
+            pool = await _get_asyncpg_pool()
+            db = _AsyncpgDb(await pool.acquire(timeout=app.config["PG_POOL_CHECKOUT_TIMEOUT"]), pool)
+        else:
+            conn = await asyncio.to_thread(_connect_sqlite, False)
+            # autocommit：每個寫入語句在同一次執行緒呼叫內完成並釋放寫入鎖。若交易跨越 await，事件迴圈上同步寫入
+            # session 的請求會等待這個鎖，而持有鎖的請求又要等事件迴圈才能 commit，只能等 busy timeout 後失敗
+            conn.isolation_level = None
+            db = _ThreadedAsyncDb(conn)
+        g.async_db = db
+    return db
+
+
+@app.teardown_appcontext
+def close_async_db(exception=None):
+    """WSGI 模式下 async view 借用的連線（本身即 get_db()，由 close_db() 歸還，此處只丟棄包裝；
+    ASGI 模式由 asgi_app 在請求結束前以 aclose() 歸還）"""
+    db = g.pop("async_db", None)
+    if db is not None:
+        db.close()
+
+
+@app.before_request
+def load_session_for_async_view():
+    """WSGI 模式下 async view 在 asgiref 的另一個執行緒上執行，先在請求執行緒載入 session，
+    避免 view 內第一次讀取 session 時在該執行緒以同步連線查詢資料庫（ASGI 模式已由 _dispatch_async_view 載入）"""
+    if SERVER_SIDE_SESSIONS and inspect.iscoroutinefunction(app.view_functions.get(request.endpoint)):
+        session.get("user_id")
+
+
+def _asgi_environ(scope, body):
+    """ASGI scope + 請求本文轉為 WSGI environ"""
+    script_name = scope.get("root_path", "").encode("utf-8").decode("latin-1")
+    path_info = scope["path"].encode("utf-8").decode("latin-1")
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name,
+        "PATH_INFO": path_info,
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{name}"
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _asgi_response_start(status, headers):
+    return {
+        "type": "http.response.start",
+        "status": int(status.split(" ", 1)[0]),
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    }
+
+
+async def _dispatch_async_view(flask_app, environ):
+    """在目前的 Task 內完成一個 async view 請求（對應 Flask.wsgi_app + full_dispatch_request），回傳 Response。
+    Flask 的 context 以 contextvars 保存，每個 Task 各自獨立；before／after_request 等同步 hook 在事件迴圈上執行，
+    session 的後端讀寫（資料庫等）則以 run_sync() 在執行緒中進行"""
+    ctx = flask_app.request_context(environ)
+    error = None
+    try:
+        try:
+            ctx.push()
+            try:
+                request_started.send(flask_app, _async_wrapper=flask_app.ensure_sync)
+                if SERVER_SIDE_SESSIONS and flask_app.session_interface.blocking:
+                    await run_sync(session.get, "user_id")  # 先載入 session，之後的 hook 與 view 讀取時不再查詢
+                rv = flask_app.preprocess_request()
+                if rv is None:
+                    req = ctx.request
+                    if req.routing_exception is not None:
+                        flask_app.raise_routing_exception(req)
+                    rv = await flask_app.view_functions[req.url_rule.endpoint](**req.view_args)
+            except Exception as e:
+                rv = flask_app.handle_user_exception(e)
+            response = flask_app.finalize_request(rv)
+            deferred, ctx.session.deferred_save = getattr(ctx.session, "deferred_save", None), None
+            if deferred is not None:
+                await run_sync(flask_app.session_interface.write_session, deferred[0], ctx.session, deferred[1])
+            return response
+        except Exception as e:
+            error = e
+            response = flask_app.handle_exception(e)
+            ctx.session.deferred_save = None  # 寫回失敗或請求出錯時不再寫入 session
+            return response
+        finally:
+            db = g.pop("async_db", None)
+            if db is not None:
+                await db.aclose()
+    finally:
+        if error is not None and flask_app.should_ignore_error(error):
+            error = None
+        ctx.pop(error)
+
+
+class AsgiApp:
+    """Flask 的 ASGI 進入點：async view 在事件迴圈上執行，同步 view 交給有界的執行緒池"""
+
+    def __init__(self, flask_app, sync_threads):
+        self.flask_app = flask_app
+        self.sync_threads = sync_threads
+        self._executor = None
+        self._executor_pid = None
+        self._async_endpoints = {}
+
+    def _executor_for_pid(self):
+        if self._executor is None or self._executor_pid != os.getpid():
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.sync_threads, thread_name_prefix="asgi-sync")
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _is_async_view(self, environ):
+        from werkzeug.exceptions import HTTPException
+        from werkzeug.routing import RequestRedirect
+        try:
+            endpoint, _ = self.flask_app.url_map.bind_to_environ(environ).match()
+        except (HTTPException, RequestRedirect):
+            return False  # 404／405／轉址等交給 Flask 照常處理
+        if endpoint not in self._async_endpoints:
+            self._async_endpoints[endpoint] = inspect.iscoroutinefunction(self.flask_app.view_functions.get(endpoint))
+        return self._async_endpoints[endpoint]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return await send({"type": "websocket.close", "code": 1000})
+        body = tempfile.SpooledTemporaryFile(max_size=65536)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                body.write(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            body.seek(0)
+            environ = _asgi_environ(scope, body)
+            if self._is_async_view(environ):
+                await self._run_async(environ, send)
+            else:
+                await self._run_sync(environ, send)
+        finally:
+            body.close()
+
+    async def _run_async(self, environ, send):
+        _native_asgi.set(True)  # 只影響目前這個請求的 Task
+        response = await _dispatch_async_view(self.flask_app, environ)
+        start = []
+
+        def start_response(status, headers, exc_info=None):
+            start[:] = [status, headers]
+
+        if compression_middleware is not None:
+            app_iter = compression_middleware.wrap(response, environ, start_response)
+        else:
+            app_iter = response(environ, start_response)
+        try:
+            await send(_asgi_response_start(*start))
+            for chunk in app_iter:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            close = getattr(app_iter, "close", None)
+            if close is not None:
+                close()
+
+    async def _run_sync(self, environ, send):
+        loop = asyncio.get_running_loop()
+
+        def send_sync(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            start = []
+
+            def start_response(status, headers, exc_info=None):
+                start[:] = [status, headers]
+
+            app_iter = self.flask_app(environ, start_response)
+            try:
+                started = False
+                for chunk in app_iter:  # 串流回應（CSV 匯出等）逐塊送出
+                    if not started:
+                        send_sync(_asgi_response_start(*start))
+                        started = True
+                    if chunk:
+                        send_sync({"type": "http.response.body", "body": chunk, "more_body": True})
+                if not started:
+                    send_sync(_asgi_response_start(*start))
+                send_sync({"type": "http.response.body", "body": b""})
+            finally:
+                close = getattr(app_iter, "close", None)
+                if close is not None:
+                    close()
+
+        await loop.run_in_executor(self._executor_for_pid(), run)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if USE_POSTGRES:
+                    try:
+                        _require_asyncpg()
+                    except RuntimeError as e:
+                        await send({"type": "lifespan.startup.failed", "message": str(e)})
+                        return
+                # run_sync 與 SQLite 查詢使用事件迴圈的預設執行緒池（asyncio.to_thread），大小同 ASGI_SYNC_THREADS
+                from concurrent.futures import ThreadPoolExecutor
+                asyncio.get_running_loop().set_default_executor(
+                    ThreadPoolExecutor(max_workers=self.sync_threads, thread_name_prefix="asgi-offload")
+                )
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                task = _asyncpg_pools.pop(asyncio.get_running_loop(), None)
+                if task is not None and task.done() and not task.exception():
+                    await task.result().close()
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+asgi_app = AsgiApp(app, app.config["ASGI_SYNC_THREADS"])
+
+
+# 模組載入時只讀取一次結構版本（Vercel 等環境不會執行 __main__，須在此執行）；
+# 有待套用的遷移時，DB_AUTO_MIGRATE 開啟則直接套用，否則提示執行 `flask db upgrade`
 with app.app_context():
     try:
-        init_db()
+        if app.config["DB_CHECK_ON_LOAD"] and get_schema_version() < SCHEMA_VERSION:
+            if app.config["DB_AUTO_MIGRATE"]:
+                init_db()
+            else:
+                import sys
+                print(f"[init_db] 資料庫結構版本落後（最新 {SCHEMA_VERSION}），請執行 `flask db upgrade`", file=sys.stderr)
     except Exception as e:
         import sys
         print(f"[init_db] {e}", file=sys.stderr)
@@ -0,0 +1,240 @@
+"""
+同步（WSGI）與非同步（ASGI）部署的並行量測：以相同的 worker 數與執行緒數分別啟動
+    基準：gunicorn -w W --threads T app:app（T 預設為 ASGI_SYNC_THREADS；--threads 1 且未安裝 gunicorn 時
+          改用 werkzeug 的 W 個單執行緒行程）
+    非同步：uvicorn app:asgi_app --workers W（ASGI_SYNC_THREADS=T）
+兩邊可用的執行緒數相同，差異來自 async view 等待 I/O 時不佔用執行緒，而不是執行緒數多寡。
+在高並行下量測 /api/user-info（資料庫查詢）與 /register POST（資料庫寫入 + 密碼雜湊 + 寄送驗證信）
+的吞吐量與 p50/p95/p99 延遲。寄信對象是本腳本內建、每封延遲 --smtp-delay 秒的假 SMTP 伺服器，
+模擬實際 SMTP 的網路延遲（MAIL_QUEUE_MODE=off，請求內同步寄送）。
+
+資料庫使用暫存 SQLite 檔（每次執行前清空）；設定 POSTGRES_URL 時須加上 --reset，會清空 users 等資料表，
+請只對測試用資料庫執行。結果寫入 benchmarks/results/async_*.json。
+
+用法：
+    python benchmarks/async_serving.py [--workers 2] [--threads 32] [--concurrency 64] [--requests 400]
+                                       [--smtp-delay 0.2] [--modes wsgi,asgi] [--output 結果.json] [--reset]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "benchmarks"))
+if not (os.environ.get("POSTGRES_URL") or os.environ.get("DATABASE_URL")):
+    os.environ.setdefault("DATABASE_PATH", os.path.join(os.environ.get("TMPDIR", "/tmp"), "bench_async.db"))
+# 伺服器與本行程共用的設定：關閉頻率限制與快取，降低密碼雜湊成本，讓 I/O 等待成為主要耗時
+SERVER_ENV = {
+    "RATE_LIMIT_ENABLED": "False",
+    "USER_CACHE_TTL": "0",
+    "JWT_EMBED_PROFILE_CLAIMS": "False",
+    "PASSWORD_PBKDF2_ITERATIONS": "1000",
+    "PASSWORD_HASHER": "pbkdf2_sha256",
+    "JOBS_MODE": "off",
+    "MAIL_QUEUE_MODE": "off",
+    "MAIL_SERVER": "127.0.0.1",
+    "MAIL_USE_TLS": "False",
+    "MAIL_USERNAME": "bench",
+    "MAIL_PASSWORD": "bench",
+    "MAIL_FROM": "bench@example.com",
+}
+for _key, _value in SERVER_ENV.items():
+    os.environ.setdefault(_key, _value)
+
+from load_test import BENCH_PASSWORD, HttpDriver, git_commit, reset_database, run_endpoint, seed_users  # noqa: E402
+
+MODES = ["wsgi", "asgi"]
+
+
+class FakeSmtpServer:
+    """最小的 SMTP 伺服器（EHLO、AUTH PLAIN、MAIL/RCPT/DATA、QUIT），收到每封郵件後延遲 delay 秒才回覆"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.port = None
+        self.received = 0
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait()
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        server = self._loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _handle(self, reader, writer):
+        writer.write(b"220 bench ESMTP\r\n")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode("latin-1").strip().upper()
+                if command.startswith(("EHLO", "HELO")):
+                    writer.write(b"250-bench\r\n250-AUTH PLAIN\r\n250 8BITMIME\r\n")
+                elif command.startswith("AUTH"):
+                    writer.write(b"235 2.7.0 Authentication successful\r\n")
+                elif command == "DATA":
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    await writer.drain()
+                    while (await reader.readline()) not in (b".\r\n", b""):
+                        pass
+                    await asyncio.sleep(self.delay)
+                    self.received += 1
+                    writer.write(b"250 OK\r\n")
+                elif command == "QUIT":
+                    writer.write(b"221 Bye\r\n")
+                    break
+                else:
+                    writer.write(b"250 OK\r\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_command(mode, port, workers, threads):
+    if mode == "asgi":
+        return [sys.executable, "-m", "uvicorn", "app:asgi_app", "--host", "127.0.0.1", "--port", str(port),
+                "--workers", str(workers), "--log-level", "warning"], "uvicorn"
+    if shutil.which("gunicorn"):
+        return ["gunicorn", "-w", str(workers), "--threads", str(threads), "-b", f"127.0.0.1:{port}",
+                "--log-level", "warning", "app:app"], "gunicorn"
+    if threads > 1:
+        raise SystemExit("多執行緒的 WSGI 基準需要 gunicorn（pip install gunicorn），或指定 --threads 1")
+    code = ("import logging; from werkzeug.serving import run_simple; import app; "
+            "logging.getLogger('werkzeug').setLevel(logging.WARNING); "
+            f"run_simple('127.0.0.1', {port}, app.app, threaded=False, processes={workers})")
+    return [sys.executable, "-c", code], "werkzeug"
+
+
+def start_server(mode, workers, threads, smtp_port):
+    """啟動伺服器並等待可連線，回傳 (行程, base_url, 伺服器名稱)"""
+    port = free_port()
+    command, name = server_command(mode, port, workers, threads)
+    env = dict(os.environ, MAIL_PORT=str(smtp_port), FLASK_DEBUG="0", ASGI_SYNC_THREADS=str(threads))
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"{name} 啟動失敗（結束碼 {process.returncode}）")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return process, f"http://127.0.0.1:{port}", name
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"{name} 在 30 秒內未開始接受連線")
+
+
+def bench_mode(mode, args, smtp):
+    process, base_url, server = start_server(mode, args.workers, args.threads, smtp.port)
+    try:
+        driver = HttpDriver(base_url)
+        status, body = driver.request("POST", "/api/token", data={"username": "bench_user000001", "password": BENCH_PASSWORD})
+        if status != 200:
+            raise SystemExit(f"無法取得 token（HTTP {status}）")
+        token = json.loads(body)["token"]
+        prefix = uuid.uuid4().hex[:8]
+        requests = {
+            "user_info": lambda i: driver.request("GET", "/api/user-info", headers={"Authorization": f"Bearer {token}"}),
+            "register": lambda i: driver.request("POST", "/register", data={
+                "username": f"async_{prefix}_{i}", "email": f"async_{prefix}_{i}@example.com",
+                "password": BENCH_PASSWORD, "confirm_password": BENCH_PASSWORD,
+            }),
+        }
+        results = []
+        for name, make_request in requests.items():
+            sent_before = smtp.received
+            result = run_endpoint(driver, name, args.requests, args.concurrency, make_request)
+            result.update(mode=mode, server=server, workers=args.workers, threads=args.threads,
+                          concurrency=args.concurrency)
+            if name == "register":
+                result["emails_sent"] = smtp.received - sent_before
+            results.append(result)
+            lat = result["latency_ms"]
+            print(f"  {mode:<5} {name:<10} {result['throughput_rps']:>9.1f} req/s  p50 {lat['p50']:>9.2f} ms  "
+                  f"p95 {lat['p95']:>9.2f} ms  p99 {lat['p99']:>9.2f} ms  errors {result['errors']}")
+        return results
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WSGI 與 ASGI 部署的並行量測")
+    parser.add_argument("--workers", type=int, default=2, help="兩種伺服器的 worker 行程數")
+    parser.add_argument("--threads", type=int, help="每個 worker 的執行緒數（gunicorn --threads 與 ASGI_SYNC_THREADS，預設為 ASGI_SYNC_THREADS）")
+    parser.add_argument("--concurrency", type=int, default=64, help="同時送出請求的執行緒數")
+    parser.add_argument("--requests", type=int, default=400, help="每個端點的請求數")
+    parser.add_argument("--smtp-delay", type=float, default=0.2, help="假 SMTP 伺服器每封郵件的延遲（秒）")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"要量測的部署方式（{','.join(MODES)}）")
+    parser.add_argument("--output", help="結果 JSON 路徑（預設 benchmarks/results/async_<commit>_<時間>.json）")
+    parser.add_argument("--reset", action="store_true", help="開始前清空資料（Postgres 必須指定）")
+    args = parser.parse_args()
+    modes = [m for m in args.modes.split(",") if m]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"未知的部署方式：{', '.join(sorted(unknown))}")
+
+    import app as app_module
+    args.threads = args.threads or app_module.app.config["ASGI_SYNC_THREADS"]
+    if app_module.USE_POSTGRES and not args.reset:
+        parser.error("使用 Postgres 時須加上 --reset（會清空 users 等資料表，請只對測試用資料庫執行）")
+    reset_database(app_module)
+    seed_users(app_module, 1000)
+    smtp = FakeSmtpServer(args.smtp_delay).start()
+    print(f"worker {args.workers}，每個 worker {args.threads} 執行緒，並行 {args.concurrency}，每封郵件延遲 {args.smtp_delay} 秒")
+
+    results = []
+    for mode in modes:
+        results.extend(bench_mode(mode, args, smtp))
+
+    commit = git_commit()
+    meta = {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "database": "postgres" if app_module.USE_POSTGRES else "sqlite",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "workers": args.workers,
+        "concurrency": args.concurrency,
+        "smtp_delay": args.smtp_delay,
+        "threads": args.threads,
+    }
+    output = Path(args.output) if args.output else (
+        ROOT / "benchmarks" / "results" / f"async_{commit or 'unknown'}_{datetime.now():%Y%m%d_%H%M%S}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({"meta": meta, "results": results}, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"結果已寫入 {output}")
+
+
+if __name__ == "__main__":
+    main()
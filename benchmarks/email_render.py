@@ -0,0 +1,91 @@
+"""
+郵件產生微基準測試：比較舊版（每封以 f-string 組 HTML/文字 + 新建 MIMEMultipart）
+與目前做法（預編譯 Jinja 模板 + 快取的 MIME 骨架）每封郵件的 CPU 成本。
+
+用法：python benchmarks/email_render.py [封數]
+"""
+import os
+import sys
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DATABASE_PATH", os.path.join(os.environ.get("TMPDIR", "/tmp"), "bench_email.db"))
+
+import app as app_module  # noqa: E402
+
+SUBJECT = "請驗證您的電子信箱 - Flask 登入系統"
+MAIL_FROM = "noreply@example.com"
+
+
+def legacy_message(to_email, username, url):
+    """舊版做法：f-string 內文 + 每封新建 MIME 樹"""
+    html_body = f"""
+    <html>
+    <body style="font-family: 'Noto Sans TC', Arial, sans-serif; line-height: 1.6; color: #333;">
+        <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
+            <h2 style="color: #007bff;">歡迎加入 Flask 登入系統！</h2>
+            <p>親愛的 {username}，</p>
+            <p>感謝您註冊我們的服務。請點擊下方的按鈕來驗證您的電子信箱：</p>
+            <div style="text-align: center; margin: 30px 0;">
+                <a href="{url}" style="background-color: #007bff; color: white; padding: 12px 30px; text-decoration: none; border-radius: 5px; display: inline-block;">驗證電子信箱</a>
+            </div>
+            <p>或者複製以下連結到瀏覽器：</p>
+            <p style="word-break: break-all; color: #666;">{url}</p>
+            <p style="color: #999; font-size: 12px; margin-top: 30px;">此連結將在 24 小時後過期。</p>
+            <p style="color: #999; font-size: 12px;">如果您沒有註冊此帳號，請忽略此郵件。</p>
+        </div>
+    </body>
+    </html>
+    """
+    text_body = f"""
+    歡迎加入 Flask 登入系統！
+
+    親愛的 {username}，
+
+    感謝您註冊我們的服務。請點擊以下連結來驗證您的電子信箱：
+
+    {url}
+
+    此連結將在 24 小時後過期。
+
+    如果您沒有註冊此帳號，請忽略此郵件。
+    """
+    msg = MIMEMultipart("alternative")
+    msg["Subject"] = SUBJECT
+    msg["From"] = MAIL_FROM
+    msg["To"] = to_email
+    msg.attach(MIMEText(text_body, "plain", "utf-8"))
+    msg.attach(MIMEText(html_body, "html", "utf-8"))
+    return msg.as_bytes()
+
+
+def current_message(to_email, username, url):
+    """目前做法：預編譯模板 + 快取骨架"""
+    html_body, text_body = app_module.render_email("verification", username=username, url=url)
+    return app_module._email_skeleton(SUBJECT, MAIL_FROM).render(to_email, html_body, text_body)
+
+
+def bench(fn, n):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(f"user{i}@example.com", f"user{i}", f"https://example.com/verify-email?token=tok{i:032d}")
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with app_module.app.app_context():
+        current_message("warmup@example.com", "warmup", "https://example.com")  # 編譯模板
+        legacy_us = bench(legacy_message, n)
+        current_us = bench(current_message, n)
+    print(f"封數: {n}")
+    print(f"舊版 f-string + MIMEMultipart: {legacy_us:8.1f} µs/封")
+    print(f"預編譯模板 + MIME 骨架:        {current_us:8.1f} µs/封")
+    print(f"加速: {legacy_us / current_us:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+認證相關端點的負載測試：依序將使用者數灌到 1k / 10k / 100k（可調），在每個規模下量測
+/login、/api/token、/api/verify-token、/api/user-info、/db-manage 與匯出／匯入的吞吐量與 p50/p95/p99 延遲，
+結果寫成 JSON 以便跨 commit 比較。
+
+預設以 Flask test client 在同一行程內執行（不含網路與 WSGI 伺服器成本）；
+指定 --base-url 時改對實際啟動的伺服器發送 HTTP 請求（伺服器須使用同一個資料庫，並關閉頻率限制）：
+
+    DATABASE_PATH=/tmp/bench.db RATE_LIMIT_ENABLED=False gunicorn -w 4 app:app
+    DATABASE_PATH=/tmp/bench.db python benchmarks/load_test.py --base-url http://127.0.0.1:8000
+
+資料庫：未設定 POSTGRES_URL 時使用暫存 SQLite 檔（每次執行前清空）；使用 Postgres 時須加上 --reset，
+會刪除 users 表的所有資料，請只對測試用資料庫執行。
+
+用法：
+    python benchmarks/load_test.py [--users 1000,10000,100000] [--requests 200] [--concurrency 1]
+                                   [--endpoints login,api_token,...] [--output 結果.json] [--reset]
+    python benchmarks/load_test.py --compare 舊結果.json 新結果.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.cookiejar import CookieJar
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, Request, build_opener
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+if not (os.environ.get("POSTGRES_URL") or os.environ.get("DATABASE_URL")):
+    os.environ.setdefault("DATABASE_PATH", os.path.join(os.environ.get("TMPDIR", "/tmp"), "bench_load.db"))
+os.environ.setdefault("RATE_LIMIT_ENABLED", "False")  # 同一 IP 大量登入會被節流，量測時關閉
+os.environ.setdefault("JOBS_MODE", "off")  # 匯入／匯出在請求內完成，才能量到完整耗時
+os.environ.setdefault("MAIL_USERNAME", "")
+
+BENCH_PASSWORD = "bench-password"
+ADMIN_USERNAME = "bench_admin"
+ENDPOINTS = ["login", "api_token", "verify_token", "user_info", "db_manage", "export_csv", "export_xlsx", "import"]
+# 匯出／匯入每次處理整張表，次數另計
+HEAVY_ENDPOINTS = {"export_csv", "export_xlsx", "import"}
+# 需要管理者 session 的端點，計時前先登入
+ADMIN_ENDPOINTS = {"db_manage", "export_csv", "export_xlsx", "import"}
+
+
+def percentile(sorted_values, pct):
+    """最近排名法百分位數"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class TestClientDriver:
+    """以 Flask test client 發送請求（每個執行緒各自一個 client 與 cookie）"""
+
+    def __init__(self, flask_app):
+        self._app = flask_app
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+        return client
+
+    def request(self, method, path, data=None, headers=None, files=None):
+        payload = dict(data or {})
+        if files:
+            payload.update({name: (io.BytesIO(content), filename) for name, (filename, content) in files.items()})
+        response = self._client().open(path, method=method, data=payload or None, headers=headers or {})
+        body = response.get_data()  # 串流回應也讀到結束
+        return response.status_code, body
+
+
+class _NoRedirect(HTTPRedirectHandler):
+    """不跟隨轉址（與 test client 一致，只量測單一請求）"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class HttpDriver:
+    """以 urllib 對實際伺服器發送請求（每個執行緒各自一組 cookie）"""
+
+    def __init__(self, base_url):
+        self._base_url = base_url.rstrip("/")
+        self._local = threading.local()
+
+    def _opener(self):
+        opener = getattr(self._local, "opener", None)
+        if opener is None:
+            opener = self._local.opener = build_opener(HTTPCookieProcessor(CookieJar()), _NoRedirect())
+        return opener
+
+    def request(self, method, path, data=None, headers=None, files=None):
+        headers = dict(headers or {})
+        body = None
+        if files:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for name, value in (data or {}).items():
+                parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+            for name, (filename, content) in files.items():
+                parts.append(
+                    f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                    f"Content-Type: application/octet-stream\r\n\r\n".encode() + content + b"\r\n"
+                )
+            parts.append(f"--{boundary}--\r\n".encode())
+            body = b"".join(parts)
+            headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+        elif data is not None:
+            body = urlencode(data).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        req = Request(self._base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self._opener().open(req) as response:
+                return response.status, response.read()
+        except HTTPError as e:
+            return e.code, e.read()
+
+
+def seed_users(app_module, target):
+    """補足使用者到 target 筆（全部共用同一個密碼雜湊，避免灌資料時計算大量 KDF），回傳新增筆數"""
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        current = db.execute("SELECT COUNT(*) AS n FROM users").fetchone()["n"]
+        if current >= target:
+            return 0
+        password_hash = app_module.hash_password(BENCH_PASSWORD)
+        regions = app_module.WORK_REGION_CHOICES[1:]
+        records = []
+        for i in range(current, target):
+            records.append({
+                "username": ADMIN_USERNAME if i == 0 else f"bench_user{i:06d}",
+                "email": f"bench_user{i:06d}@example.com",
+                "password_hash": password_hash,
+                "email_verified": 1,
+                "work_region": regions[i % len(regions)],
+                "role": "管理者" if i == 0 else app_module.DEFAULT_ROLE,
+            })
+        for start in range(0, len(records), 5000):
+            app_module._multi_row_insert(db, "INSERT INTO users", list(records[0]), records[start:start + 5000])
+            db.commit()
+        return len(records)
+
+
+def reset_database(app_module):
+    """清空 users 與相關資料表"""
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        for table in ("sessions", "tokens", "jobs", "email_outbox", "users"):
+            db.execute(f"DELETE FROM {table}")
+        db.commit()
+        app_module.invalidate_user_auth()
+
+
+def import_workbook(app_module, rows):
+    """產生匯入用 xlsx：依 id 更新隨機使用者的電話（不含密碼，量測的是資料庫寫入而非 KDF）"""
+    from openpyxl import Workbook
+    with app_module.app.app_context():
+        users = app_module.get_db().execute(
+            "SELECT id, username, email, email_verified, work_region, role FROM users WHERE username <> ?",
+            (ADMIN_USERNAME,),
+        ).fetchall()
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(app_module._user_columns())
+    for user in random.sample(users, min(rows, len(users))):
+        ws.append([user["id"], user["username"], user["email"], None, user["email_verified"], None,
+                   f"09{random.randint(0, 99999999):08d}", None, user["work_region"], user["role"]])
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def run_endpoint(driver, name, count, concurrency, make_request, setup=None):
+    """以 concurrency 個執行緒共送出 count 個請求，回傳統計；
+    setup（例如管理者登入）在計時前於每個執行緒各執行一次，不計入延遲"""
+    def one(i):
+        start = time.perf_counter()
+        status, _ = make_request(i)
+        return time.perf_counter() - start, status
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if setup is not None:
+            # 以 barrier 讓 concurrency 個工作同時佔住不同執行緒，確保每個執行緒都恰好執行一次
+            barrier = threading.Barrier(concurrency)
+
+            def warm(_):
+                setup()
+                barrier.wait()
+            list(pool.map(warm, range(concurrency)))
+        wall_start = time.perf_counter()
+        samples = list(pool.map(one, range(count)))
+        wall = time.perf_counter() - wall_start
+    latencies = sorted(duration * 1000 for duration, _ in samples)
+    errors = sum(1 for _, status in samples if status >= 400)
+    return {
+        "endpoint": name,
+        "requests": count,
+        "errors": errors,
+        "throughput_rps": round(count / wall, 2) if wall else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 3),
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(latencies[-1], 3),
+        },
+    }
+
+
+def bench_size(app_module, driver, user_count, args):
+    """在目前的資料量下量測所有選定端點"""
+    usernames = [f"bench_user{i:06d}" for i in random.sample(range(1, user_count), min(1000, user_count - 1))]
+    tokens = []
+    for username in usernames[:100]:
+        status, body = driver.request("POST", "/api/token", data={"username": username, "password": BENCH_PASSWORD})
+        if status == 200:
+            tokens.append(json.loads(body)["token"])
+    if not tokens:
+        raise SystemExit("無法取得 token，請確認伺服器使用同一個資料庫且已關閉頻率限制")
+
+    def admin_login():
+        """管理者 session：每個執行緒的 client 在計時前各自登入一次（登入本身要計算一次密碼雜湊）"""
+        status, _ = driver.request("POST", "/login", data={"username": ADMIN_USERNAME, "password": BENCH_PASSWORD})
+        if status != 302:
+            raise SystemExit(f"管理者登入失敗（HTTP {status}）")
+
+    workbook = import_workbook(app_module, args.import_rows) if "import" in args.endpoints else None
+    requests = {
+        "login": lambda i: driver.request(
+            "POST", "/login", data={"username": usernames[i % len(usernames)], "password": BENCH_PASSWORD}),
+        "api_token": lambda i: driver.request(
+            "POST", "/api/token", data={"username": usernames[i % len(usernames)], "password": BENCH_PASSWORD}),
+        "verify_token": lambda i: driver.request(
+            "POST", "/api/verify-token", headers={"Authorization": f"Bearer {tokens[i % len(tokens)]}"}),
+        "user_info": lambda i: driver.request(
+            "GET", "/api/user-info", headers={"Authorization": f"Bearer {tokens[i % len(tokens)]}"}),
+        "db_manage": lambda i: driver.request("GET", "/db-manage"),
+        "export_csv": lambda i: driver.request("GET", "/db-manage/export?format=csv"),
+        "export_xlsx": lambda i: driver.request("GET", "/db-manage/export?format=xlsx"),
+        "import": lambda i: driver.request("POST", "/db-manage/import", files={"file": ("bench.xlsx", workbook)}),
+    }
+    results = []
+    for name in args.endpoints:
+        count = args.heavy_requests if name in HEAVY_ENDPOINTS else args.requests
+        concurrency = 1 if name in HEAVY_ENDPOINTS else args.concurrency
+        setup = admin_login if name in ADMIN_ENDPOINTS else None
+        result = run_endpoint(driver, name, count, concurrency, requests[name], setup)
+        result["users"] = user_count
+        results.append(result)
+        lat = result["latency_ms"]
+        print(f"  {name:<13} {result['throughput_rps']:>9.1f} req/s  p50 {lat['p50']:>9.2f} ms  "
+              f"p95 {lat['p95']:>9.2f} ms  p99 {lat['p99']:>9.2f} ms  errors {result['errors']}")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    """比較兩次結果的 p50 / p95 / 吞吐量"""
+    def load(path):
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+        return data["meta"], {(r["users"], r["endpoint"]): r for r in data["results"]}
+
+    old_meta, old = load(old_path)
+    new_meta, new = load(new_path)
+    print(f"舊：{old_meta.get('commit')} {old_meta.get('timestamp')}  新：{new_meta.get('commit')} {new_meta.get('timestamp')}")
+    for key in sorted(set(old) & set(new)):
+        a, b = old[key], new[key]
+
+        def delta(x, y):
+            return f"{(y - x) / x * 100:+6.1f}%" if x else "   n/a"
+        print(f"{key[0]:>7} {key[1]:<13} p50 {a['latency_ms']['p50']:>9.2f} → {b['latency_ms']['p50']:>9.2f} ms "
+              f"({delta(a['latency_ms']['p50'], b['latency_ms']['p50'])})  p95 {delta(a['latency_ms']['p95'], b['latency_ms']['p95'])}  "
+              f"吞吐 {delta(a['throughput_rps'], b['throughput_rps'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="認證端點負載測試")
+    parser.add_argument("--users", default="1000,10000,100000", help="使用者數（逗號分隔，由小到大依序灌入）")
+    parser.add_argument("--requests", type=int, default=200, help="一般端點每個規模的請求數")
+    parser.add_argument("--heavy-requests", type=int, default=3, help="匯出／匯入每個規模的請求數")
+    parser.add_argument("--import-rows", type=int, default=1000, help="匯入檔的列數")
+    parser.add_argument("--concurrency", type=int, default=1, help="同時送出請求的執行緒數（匯出／匯入固定為 1）")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"要量測的端點（{','.join(ENDPOINTS)}）")
+    parser.add_argument("--base-url", help="對實際伺服器量測（例如 http://127.0.0.1:8000）")
+    parser.add_argument("--output", help="結果 JSON 路徑（預設 benchmarks/results/load_<commit>_<時間>.json）")
+    parser.add_argument("--reset", action="store_true", help="開始前清空資料（Postgres 必須指定）")
+    parser.add_argument("--seed", type=int, default=42, help="亂數種子")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="比較兩個結果檔")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    args.endpoints = [e for e in args.endpoints.split(",") if e]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"未知的端點：{', '.join(sorted(unknown))}")
+    sizes = sorted(int(n) for n in args.users.split(","))
+    random.seed(args.seed)
+
+    import app as app_module
+    if app_module.USE_POSTGRES and not args.reset:
+        parser.error("使用 Postgres 時須加上 --reset（會清空 users 等資料表，請只對測試用資料庫執行）")
+    if args.reset or not app_module.USE_POSTGRES:
+        reset_database(app_module)
+    driver = HttpDriver(args.base_url) if args.base_url else TestClientDriver(app_module.app)
+
+    results = []
+    for size in sizes:
+        started = time.perf_counter()
+        added = seed_users(app_module, size)
+        print(f"使用者 {size} 筆（新增 {added} 筆，{time.perf_counter() - started:.1f} 秒）")
+        results.extend(bench_size(app_module, driver, size, args))
+
+    commit = git_commit()
+    meta = {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "mode": "http" if args.base_url else "test_client",
+        "base_url": args.base_url,
+        "database": "postgres" if app_module.USE_POSTGRES else "sqlite",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "concurrency": args.concurrency,
+        "password_hasher": app_module.app.config["PASSWORD_HASHER"],
+        "pbkdf2_iterations": app_module.app.config["PASSWORD_PBKDF2_ITERATIONS"],
+        "sqlite_persistent": app_module.app.config["SQLITE_PERSISTENT"],
+    }
+    output = Path(args.output) if args.output else (
+        ROOT / "benchmarks" / "results" / f"load_{commit or 'unknown'}_{datetime.now():%Y%m%d_%H%M%S}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({"meta": meta, "results": results}, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"結果已寫入 {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+密碼雜湊成本基準測試：在目標機器上量測 pbkdf2_sha256 / scrypt 各成本參數的單次耗時，
+並以 PASSWORD_HASH_WORKERS 個執行緒同時計算估算每秒可處理的登入數，協助選擇
+PASSWORD_PBKDF2_ITERATIONS 與 PASSWORD_SCRYPT_N。
+
+用法：python benchmarks/password_hash.py [目標毫秒數，預設 250] [每組重複次數，預設 5]
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DATABASE_PATH", os.path.join(os.environ.get("TMPDIR", "/tmp"), "bench_password.db"))
+
+import app as app_module  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+PBKDF2_ITERATIONS = [100_000, 200_000, 300_000, 600_000, 1_000_000]
+SCRYPT_N = [2 ** 13, 2 ** 14, 2 ** 15, 2 ** 16]
+
+
+def time_hash(hasher, repeat):
+    """單執行緒下每次雜湊的平均毫秒數"""
+    hasher.hash(PASSWORD)  # 暖機
+    start = time.perf_counter()
+    for _ in range(repeat):
+        hasher.hash(PASSWORD)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def throughput(hasher, workers, repeat):
+    """workers 個執行緒同時雜湊時每秒完成的次數"""
+    total = workers * repeat
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda _: hasher.hash(PASSWORD), range(total)))
+    return total / (time.perf_counter() - start)
+
+
+def main():
+    target_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 250
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    workers = app_module.app.config["PASSWORD_HASH_WORKERS"]
+    print(f"目標：單次 ≤ {target_ms:.0f} ms；並行執行緒 {workers}（PASSWORD_HASH_WORKERS）")
+
+    candidates = [
+        (f"PASSWORD_HASHER=pbkdf2_sha256 PASSWORD_PBKDF2_ITERATIONS={it}", app_module._Pbkdf2Sha256Hasher(it))
+        for it in PBKDF2_ITERATIONS
+    ] + [
+        (f"PASSWORD_HASHER=scrypt PASSWORD_SCRYPT_N={n}", app_module._ScryptHasher(n, 8, 1))
+        for n in SCRYPT_N
+    ]
+    best = {}
+    for label, hasher in candidates:
+        ms = time_hash(hasher, repeat)
+        rate = throughput(hasher, workers, repeat)
+        print(f"{label:<58} {ms:8.1f} ms/次  {rate:8.1f} 次/秒（並行）")
+        if ms <= target_ms:
+            best[hasher.algorithm] = label
+    print()
+    for algorithm in ("pbkdf2_sha256", "scrypt"):
+        print(f"建議 {algorithm}: {best.get(algorithm, '所有候選值皆超過目標，請降低成本或提高目標')}")
+
+
+if __name__ == "__main__":
+    main()
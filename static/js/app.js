@@ -0,0 +1,76 @@
+// 全站共用腳本（原 base.html 內嵌 <script>；需在 toastr 之後載入）
+
+// Toastr 設定
+toastr.options = {
+    "closeButton": true,
+    "debug": false,
+    "newestOnTop": true,
+    "progressBar": true,
+    "positionClass": "toast-top-right",
+    "preventDuplicates": false,
+    "onclick": null,
+    "showDuration": "300",
+    "hideDuration": "1000",
+    "timeOut": "5000",
+    "extendedTimeOut": "1000",
+    "showEasing": "swing",
+    "hideEasing": "linear",
+    "showMethod": "fadeIn",
+    "hideMethod": "fadeOut"
+};
+
+// 側邊欄收合/展開（用於 components/sideBar.html）
+(function() {
+    var sidebar = document.getElementById('app-sidebar');
+    var toggleBtn = document.getElementById('sidebarToggle');
+    var openBtn = document.getElementById('sidebarOpenBtn');
+    var body = document.body;
+    if (!sidebar || !body) return;
+    var storageKey = 'sidebar-collapsed';
+    function collapse() {
+        sidebar.classList.add('collapsed');
+        body.classList.remove('sidebar-visible');
+        if (openBtn) openBtn.style.display = 'flex';
+        if (toggleBtn) {
+            toggleBtn.setAttribute('aria-label', '展開側邊欄');
+            toggleBtn.setAttribute('title', '展開側邊欄');
+        }
+        localStorage.setItem(storageKey, '1');
+    }
+    function expand() {
+        sidebar.classList.remove('collapsed');
+        body.classList.add('sidebar-visible');
+        if (openBtn) openBtn.style.display = 'none';
+        if (toggleBtn) {
+            toggleBtn.setAttribute('aria-label', '收合側邊欄');
+            toggleBtn.setAttribute('title', '收合側邊欄');
+        }
+        localStorage.setItem(storageKey, '0');
+    }
+    if (localStorage.getItem(storageKey) === '1') collapse();
+    if (toggleBtn) toggleBtn.addEventListener('click', collapse);
+    if (openBtn) openBtn.addEventListener('click', expand);
+})();
+
+// 密碼顯示/隱藏切換（用於 components/passwordInput.html）
+document.addEventListener('click', function(e) {
+    var btn = e.target.closest('.password-toggle-btn');
+    if (!btn) return;
+    var inputId = btn.getAttribute('data-password-target');
+    var input = document.getElementById(inputId);
+    if (!input) return;
+    var icon = btn.querySelector('.password-toggle-icon');
+    if (input.type === 'password') {
+        input.type = 'text';
+        icon.classList.remove('bi-eye');
+        icon.classList.add('bi-eye-slash');
+        btn.setAttribute('aria-label', '隱藏密碼');
+        btn.setAttribute('title', '隱藏密碼');
+    } else {
+        input.type = 'password';
+        icon.classList.remove('bi-eye-slash');
+        icon.classList.add('bi-eye');
+        btn.setAttribute('aria-label', '顯示密碼');
+        btn.setAttribute('title', '顯示密碼');
+    }
+});
@@ -0,0 +1,17 @@
+"""測試共用設定：app 於第一次 import 時讀取環境變數，須在任何測試模組 import app 之前設定"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "test.db"))
+os.environ.setdefault("RATE_LIMIT_ENABLED", "False")
+os.environ.setdefault("JOBS_MODE", "off")
+os.environ.setdefault("MAIL_QUEUE_MODE", "off")
+os.environ.setdefault("MAIL_USERNAME", "")
+os.environ.setdefault("PASSWORD_HASHER", "pbkdf2_sha256")
+os.environ.setdefault("PASSWORD_PBKDF2_ITERATIONS", "1000")
+# N+1 偵測設為 raise，任何路由的重複查詢都會讓測試失敗
+os.environ.setdefault("QUERY_REPEAT_THRESHOLD", "5")
+os.environ.setdefault("QUERY_REPEAT_ACTION", "raise")
@@ -0,0 +1,32 @@
+"""Excel 匯入：資料庫會拒絕的值（格式、長度、範圍）記為該列錯誤，其餘列照常寫入"""
+import secrets
+
+import app as app_module
+from app import app
+
+
+def _row(username, **values):
+    row = {column: None for column in app_module._user_columns()}
+    row.update(username=username, email=f"{username}@example.com", email_verified=1)
+    row.update(values)
+    return tuple(row[column] for column in app_module._user_columns())
+
+
+def test_invalid_values_become_row_errors():
+    prefix = f"imp_{secrets.token_hex(3)}"
+    rows = [
+        (2, _row(f"{prefix}_ok", birthday="1990/05/06")),
+        (3, _row(f"{prefix}_date", birthday="1990-13-45")),
+        (4, _row(f"{prefix}_long", phone="0" * 51)),
+        (5, _row(f"{prefix}_id", id=2**31)),
+        (6, _row(f"{prefix}_" + "x" * 260)),
+    ]
+    with app.app_context():
+        db = app_module.get_db()
+        result = app_module.import_users(db, rows)
+        written = db.execute(
+            "SELECT username, birthday FROM users WHERE username LIKE ?", (f"{prefix}_%",)
+        ).fetchall()
+    assert result["added"] == 1
+    assert [row_no for row_no, _ in result["errors"]] == [3, 4, 5, 6]
+    assert [(r["username"], str(r["birthday"])) for r in written] == [(f"{prefix}_ok", "1990-05-06")]
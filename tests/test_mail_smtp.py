@@ -0,0 +1,78 @@
+"""SMTP 連線：對要求 AUTH 的伺服器（本機 aiosmtpd）必須先登入才能寄信"""
+import os
+import socket
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+aiosmtpd_controller = pytest.importorskip("aiosmtpd.controller")
+from aiosmtpd.smtp import AuthResult  # noqa: E402
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "test_mail.db"))
+
+import app as app_module  # noqa: E402
+
+USERNAME = "mailer"
+PASSWORD = "s3cret"
+
+
+class _Handler:
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((session.authenticated, envelope.rcpt_tos))
+        return "250 OK"
+
+
+def _authenticator(server, session, envelope, mechanism, auth_data):
+    ok = auth_data.login == USERNAME.encode() and auth_data.password == PASSWORD.encode()
+    return AuthResult(success=ok)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server():
+    handler = _Handler()
+    controller = aiosmtpd_controller.Controller(
+        handler, hostname="127.0.0.1", port=_free_port(),
+        authenticator=_authenticator, auth_required=True, auth_require_tls=False,
+    )
+    controller.start()
+    config = app_module.app.config
+    saved = {key: config[key] for key in ("MAIL_SERVER", "MAIL_PORT", "MAIL_USE_TLS", "MAIL_USERNAME",
+                                          "MAIL_PASSWORD", "MAIL_FROM", "MAIL_QUEUE_MODE")}
+    config.update(
+        MAIL_SERVER="127.0.0.1", MAIL_PORT=controller.port, MAIL_USE_TLS=False,
+        MAIL_USERNAME=USERNAME, MAIL_PASSWORD=PASSWORD, MAIL_FROM="noreply@example.com", MAIL_QUEUE_MODE="off",
+    )
+    try:
+        yield handler
+    finally:
+        config.update(saved)
+        controller.stop()
+
+
+def test_smtp_session_logs_in_when_server_requires_auth(smtp_server):
+    with app_module.app.app_context():
+        assert app_module.send_email("user@example.com", "測試", "<p>hi</p>", "hi")
+    assert smtp_server.messages == [(True, ["user@example.com"])]
+
+
+def test_smtp_session_reuses_authenticated_connection(smtp_server):
+    session = app_module._SmtpSession()
+    with app_module.app.app_context():
+        try:
+            for to in ("a@example.com", "b@example.com"):
+                session.send(to, app_module._build_email_message(to, "測試", "<p>hi</p>", "hi"))
+        finally:
+            session.close()
+    assert smtp_server.messages == [(True, ["a@example.com"]), (True, ["b@example.com"])]
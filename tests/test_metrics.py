@@ -0,0 +1,30 @@
+"""/metrics 存取控制：設定 METRICS_TOKEN 時須帶 token，未設定時僅限本機直接連線"""
+import pytest
+
+from app import app
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setitem(app.config, "METRICS_ENABLED", True)
+    monkeypatch.setitem(app.config, "METRICS_TOKEN", "")
+    return app.test_client()
+
+
+def test_metrics_without_token_is_local_only(client):
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "127.0.0.1"}).status_code == 200
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "203.0.113.5"}).status_code == 403
+    # 同機反向代理轉送的外部請求
+    forwarded = client.get(
+        "/metrics", environ_base={"REMOTE_ADDR": "127.0.0.1"}, headers={"X-Forwarded-For": "203.0.113.5"}
+    )
+    assert forwarded.status_code == 403
+
+
+def test_metrics_token_required_when_set(client, monkeypatch):
+    monkeypatch.setitem(app.config, "METRICS_TOKEN", "metrics-secret")
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "127.0.0.1"}).status_code == 401
+    response = client.get(
+        "/metrics", environ_base={"REMOTE_ADDR": "203.0.113.5"}, headers={"Authorization": "Bearer metrics-secret"}
+    )
+    assert response.status_code == 200
@@ -0,0 +1,81 @@
+"""各路由的查詢次數與 N+1 偵測（conftest 設定 QUERY_REPEAT_THRESHOLD=5、QUERY_REPEAT_ACTION=raise）"""
+import io
+import secrets
+
+import pytest
+from flask import Response
+
+import app as app_module
+from app import app, capture_queries
+
+PASSWORD = "query-count-pw"
+
+
+def _create_user(role=app_module.DEFAULT_ROLE):
+    name = f"qc_{secrets.token_hex(4)}"
+    with app.app_context():
+        db = app_module.get_db()
+        db.execute(
+            "INSERT INTO users (username, email, password_hash, email_verified, role) VALUES (?, ?, ?, ?, ?)",
+            (name, f"{name}@example.com", app_module.hash_password(PASSWORD), 1, role),
+        )
+        db.commit()
+    return name
+
+
+@pytest.fixture
+def admin_client():
+    client = app.test_client()
+    response = client.post("/login", data={"username": _create_user("管理者"), "password": PASSWORD})
+    assert response.status_code == 302
+    return client
+
+
+def test_login_query_count():
+    username = _create_user()
+    client = app.test_client()
+    with capture_queries() as queries:
+        response = client.post("/login", data={"username": username, "password": PASSWORD})
+    assert response.status_code == 302
+    # 帳號查詢（索引探查）＋ 寫入 session
+    assert len(queries) <= 2, [shape for shape, _, _ in queries]
+
+
+def test_db_manage_query_count(admin_client):
+    with capture_queries() as queries:
+        response = admin_client.get("/db-manage")
+    assert response.status_code == 200
+    # 讀取 session ＋ 一頁使用者 ＋ 更新 session 到期時間；權限走快取
+    assert len(queries) <= 3, [shape for shape, _, _ in queries]
+
+
+def test_repeated_query_in_request_raises():
+    with app.test_request_context("/n-plus-one"):
+        app.preprocess_request()
+        db = app_module.get_db()
+        for user_id in range(10):
+            db.execute("SELECT username FROM users WHERE id = ?", (user_id,)).fetchone()
+        with pytest.raises(app_module.QueryRepeatError, match="SELECT username FROM users WHERE id = \\?"):
+            app.process_response(Response())
+
+
+def test_chunked_import_is_not_reported_as_n_plus_one(admin_client):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(app_module._user_columns())
+    prefix = secrets.token_hex(3)
+    for i in range(3000):
+        ws.append([None, f"imp_{prefix}_{i}", f"imp_{prefix}_{i}@example.com", None, 1, None, None, None, None, None])
+    buf = io.BytesIO()
+    wb.save(buf)
+    response = admin_client.post(
+        "/db-manage/import", data={"file": (io.BytesIO(buf.getvalue()), "users.xlsx")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 302
+    with app.app_context():
+        count = app_module.get_db().execute(
+            "SELECT COUNT(*) AS n FROM users WHERE username LIKE ?", (f"imp_{prefix}_%",)
+        ).fetchone()["n"]
+    assert count == 3000
@@ -0,0 +1,33 @@
+"""伺服器端 session（database 後端）寫入不影響視圖的交易"""
+import secrets
+
+from flask import Response, session
+
+import app as app_module
+from app import app
+
+
+def _user_exists(username):
+    with app.app_context():
+        row = app_module.get_db().execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone()
+    return row is not None
+
+
+def test_session_save_does_not_commit_view_transaction():
+    assert isinstance(app.session_interface.backend, app_module._DatabaseSessionBackend)
+    username = f"sess_{secrets.token_hex(4)}"
+    with app.test_request_context("/"):
+        app.preprocess_request()
+        session["note"] = "hello"
+        db = app_module.get_db()
+        # 視圖寫入後未提交（例如中途出錯）：請求結束時應被捨棄，不能被 session 寫入一併提交
+        db.execute(
+            "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)",
+            (username, f"{username}@example.com", "x"),
+        )
+        response = app.process_response(Response())
+    assert not _user_exists(username)
+    sid = response.headers["Set-Cookie"].split(";", 1)[0].split("=", 1)[1]
+    with app.app_context():
+        loaded = app.session_interface.backend.load(app.session_interface.storage_key(sid))
+    assert loaded is not None